@@ -0,0 +1,104 @@
+import torch
+import sys, time, math
+import argparse
+
+sys.path.append('./src/')
+import forward_maps as fwd_maps
+from operators import GaussianBlurOperator, MotionBlurOperator, adjoint_error
+from jpeg import JPEGEngine
+
+# Create an ArgumentParser object
+parser = argparse.ArgumentParser(description="Throughput of the corruption forward maps")
+parser.add_argument("--which", type=str, nargs='+', default=['blur', 'jpeg', 'motion'], help="benchmarks to run")
+parser.add_argument("--batch_size", type=int, default=256, help="batch size")
+parser.add_argument("-D", type=int, default=32, help="image size")
+parser.add_argument("--channels", type=int, default=3, help="image channels")
+parser.add_argument("--sigmas", type=float, nargs='+', default=[0.5, 1., 2., 4., 8.], help="blur widths")
+parser.add_argument("--repeats", type=int, default=20, help="timed repeats")
+parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+args = parser.parse_args()
+print(args)
+device = args.device
+
+
+def timeit(fn, repeats=args.repeats):
+    """Median seconds per call, after one warmup call."""
+    fn()
+    times = []
+    for _ in range(repeats):
+        if device.startswith('cuda'): torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        if device.startswith('cuda'): torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def reference_blur(x, sigma):
+    """The previous forward map: transforms.GaussianBlur rebuilds a dense 2D kernel on every call."""
+    import torchvision.transforms as transforms
+    kernel_size = int(2 * math.ceil(3*sigma) + 1)
+    return transforms.GaussianBlur(kernel_size=kernel_size, sigma=sigma)(x)
+
+
+def bench_blur():
+    N, C, D = args.batch_size, args.channels, args.D
+    x = torch.randn(N, C, D, D, device=device)
+    print(f"\nGaussian blur, {N}x{C}x{D}x{D} on {device}, images/s")
+    print(f"{'sigma':>6} {'torchvision':>12} {'separable':>12} {'fft':>12} {'per-image':>12} {'max err':>9} {'adj err':>9}")
+    for sigma in args.sigmas:
+        if math.ceil(3*sigma) >= D:
+            print(f"{sigma:6.2f}  skipped, kernel radius exceeds image size")
+            continue
+        separable = GaussianBlurOperator(sigma, 0., use_fft=False)
+        fft = GaussianBlurOperator(sigma, 0., use_fft=True)
+        ref = reference_blur(x, sigma)
+        err = max((separable.apply(x) - ref).abs().max().item(), (fft.apply(x) - ref).abs().max().item())
+        # <A x, y> == <x, A^T y> for both branches
+        adj_err = max(adjoint_error(separable, x), adjoint_error(fft, x))
+        t_ref = timeit(lambda: reference_blur(x, sigma))
+        t_sep = timeit(lambda: separable.apply(x))
+        t_fft = timeit(lambda: fft.apply(x))
+        # CorruptedDataset path: one (C, D, D) image per call
+        fwd = fwd_maps.gaussian_blur(sigma, 0.1)
+        xs = x[:64]
+        t_img = timeit(lambda: [fwd(xi) for xi in xs]) / len(xs) * N
+        print(f"{sigma:6.2f} {N/t_ref:12.0f} {N/t_sep:12.0f} {N/t_fft:12.0f} {N/t_img:12.0f} {err:9.2e} {adj_err:9.2e}")
+        assert adj_err < 1e-4, f"adjoint mismatch {adj_err:.2e} for sigma={sigma}"
+
+
+def bench_jpeg():
+    N, D = args.batch_size, args.D
+    x = torch.randn(N, 3, D, D, device=device)
+    quality = torch.randint(1, 101, (N,), device=device)
+    print(f"\nJPEG round trip, {N}x3x{D}x{D} on {device}, images/s")
+    for chroma_subsampling in [False, True]:
+        engine = JPEGEngine(chroma_subsampling=chroma_subsampling)
+        t_batch = timeit(lambda: engine(x, quality))
+        # CorruptedDataset path: one image per call through the forward map
+        fwd = fwd_maps.jpeg_compression(1, 100, 0.01, chroma_subsampling=chroma_subsampling)
+        xs = x[:64]
+        t_img = timeit(lambda: [fwd(xi) for xi in xs]) / len(xs) * N
+        print(f"chroma_subsampling={chroma_subsampling!s:5}  batched {N/t_batch:10.0f}  per-image {N/t_img:10.0f}")
+
+
+def bench_motion():
+    N, C, D = args.batch_size, args.channels, args.D
+    x = torch.randn(N, C, D, D, device=device)
+    print(f"\nRandom motion blur, {N}x{C}x{D}x{D} on {device}, images/s")
+    for kernel_size in [5, 9, 17]:
+        row = []
+        for angle_bins, use_fft in [(None, False), (3600, False), (3600, True)]:
+            fwd = fwd_maps.random_motion(kernel_size, 0.1, angle_bins=angle_bins, use_fft=use_fft)
+            row.append(f"bins={angle_bins!s:5} fft={use_fft!s:5} {N/timeit(lambda: fwd(x)):10.0f}")
+        # kernels from the 3600-angle table against the exact rotation (angle_bins=None, the default)
+        rads = torch.rand(N, device=device) * 2 * torch.pi
+        exact = MotionBlurOperator(kernel_size, 0.).kernels_from_angles(rads)
+        table = MotionBlurOperator(kernel_size, 0., angle_bins=3600).kernels_from_angles(rads)
+        row.append(f"table kernel err {(exact - table).abs().max().item():9.2e}")
+        print(f"kernel_size={kernel_size:3d}  " + "  ".join(row))
+
+
+benchmarks = {'blur': bench_blur, 'jpeg': bench_jpeg, 'motion': bench_motion}
+for name in args.which:
+    benchmarks[name]()
@@ -31,6 +31,9 @@ parser.add_argument("--suffix", type=str, default='', help="suffix for folder na
 parser.add_argument("--subfolder", type=str, default='', help="subfolder for folder name")
 parser.add_argument("--gated", action='store_true', help="gated convolution if provided, else not")
 parser.add_argument("--ode_steps", type=int, default=64, help="number of steps for ODE sampling")
+parser.add_argument("--dc_weight", type=float, default=0., help="data-consistency step size for reconstructions (not training targets), 0 to disable")
+parser.add_argument("--dc_tmax", type=float, default=1., help="apply data consistency only for t <= dc_tmax")
+parser.add_argument("--dc_every", type=int, default=1, help="apply data consistency every n ode steps")
 parser.add_argument("--multiview", action='store_true', help="change corruption every epoch if provided, else not")
 parser.add_argument("--max_pos_embedding", type=int, default=2, help="number of resamplings")
 args = parser.parse_args()
@@ -72,7 +75,8 @@ if use_latents:
     print("Will use latents of dimension: ", latent_dim)
 
 
-deconvolver = DeconvolvingInterpolant(fwd_func, use_latents=use_latents, n_steps=args.ode_steps).to(device)
+deconvolver = DeconvolvingInterpolant(fwd_func, use_latents=use_latents, n_steps=args.ode_steps, \
+                                      dc_weight=args.dc_weight, dc_tmax=args.dc_tmax, dc_every=args.dc_every).to(device)
 b = ConditionalDhariwalUNet(D, nc, nc, latent_dim=latent_dim, model_channels=args.channels, gated=gated, \
                             max_pos_embedding=args.max_pos_embedding, zero_emb_channels_bwd=True).to(device)
 ema_b = EMA(b)
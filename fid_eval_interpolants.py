@@ -13,6 +13,7 @@ from interpolant_utils import DeconvolvingInterpolant
 import forward_maps as fwd_maps
 from fid_evaluation import FIDEvaluation, calculate_frechet_distance
 from utils import infinite_dataloader,  num_to_groups, remove_orig_mod_prefix
+from profiling import ScheduledProfiler, record
 from tqdm.auto import tqdm
 
 
@@ -39,6 +40,7 @@ parser.add_argument("--gamma_scale", type=float, default=0., help="noise added t
 parser.add_argument("--diffusion_coeff", type=float, default=0., help="diffusion coeff for sde")
 parser.add_argument("--transport_steps", type=int, default=1, help="update transport map every n steps")
 parser.add_argument("--smodel", action='store_true', help="use sde model")
+parser.add_argument("--profile", action='store_true', default=None, help="profile a few batches, default from SI_PROFILE")
 
 args = parser.parse_args()
 print(args)
@@ -127,7 +129,8 @@ fid_scorer = FIDEvaluation(
     stats_dir=results_folder,
     device=device,
     num_fid_samples=args.n_samples,
-    inception_block_idx=2048
+    inception_block_idx=2048,
+    profile=args.profile
 )    
 if not fid_scorer.dataset_stats_loaded:
     fid_scorer.load_or_precalc_dataset_stats(force_calc=True)
@@ -135,7 +138,8 @@ if not fid_scorer.dataset_stats_loaded:
 @torch.inference_mode()
 def get_cleaned_samples():
     image = next(dl).to(device)
-    corrupted, latents = deconvolver.push_fwd(image, return_latents=True)
+    with record('push_fwd'):
+        corrupted, latents = deconvolver.push_fwd(image, return_latents=True)
     latents = latents if use_latents else None
     clean = deconvolver.transport(b, corrupted, latents)
     return clean
@@ -144,10 +148,14 @@ batches = num_to_groups(fid_scorer.n_samples, fid_scorer.batch_size)
 stacked_fake_features = []
 print(f"Stacking Inception features for {fid_scorer.n_samples} generated samples.")
 
-for batch in tqdm(batches):
-    fake_samples = get_cleaned_samples()    
-    fake_features = fid_scorer.calculate_inception_features(fake_samples)
-    stacked_fake_features.append(fake_features)
+profiler = ScheduledProfiler(os.path.join(results_folder, "profile"), name="fid",
+                             wait=1, warmup=1, active=3, enabled=args.profile)
+with profiler:
+    for batch in tqdm(batches):
+        fake_samples = get_cleaned_samples()    
+        fake_features = fid_scorer.calculate_inception_features(fake_samples)
+        stacked_fake_features.append(fake_features)
+        profiler.step()
 stacked_fake_features = torch.cat(stacked_fake_features, dim=0).cpu().numpy()
 m1 = np.mean(stacked_fake_features, axis=0)
 s1 = np.cov(stacked_fake_features, rowvar=False)
@@ -12,6 +12,8 @@ from nets import SimpleFeedForward, FeedForwardwithEMB
 from custom_datasets import ManifoldDataset, Manifold_A_Dataset
 from distribution import DistributionDataLoader, distribution_dict
 from interpolant_utils import DeconvolvingInterpolant
+from projections import SeededLatentModel
+from operators import ProjectionOperator
 from callbacks import save_fig_2dsynt_coeff, save_fig_2dsynt_vec, save_fig_manifold
 from trainer_si import Trainer
 import forward_maps as fwd_maps
@@ -154,6 +156,9 @@ valid_data_plot = (clean_data_valid, corrupted_valid_plot, latents_valid)
 # to update architecture
 # b =  SimpleFeedForward(dim_in, [args.fc_width]*args.fc_depth, latent_dim=latent_dim, use_follmer=use_follmer).to(device)
 b =  FeedForwardwithEMB(dim_in, 64, [args.fc_width]*args.fc_depth, latent_dim=latent_dim, use_follmer=use_follmer).to(device)
+if isinstance(getattr(fwd_func, 'operator', None), ProjectionOperator):
+    # seeded projections pass (N, 1) seeds as latents; expand them to A inside the model
+    b = SeededLatentModel(b, fwd_func.operator)
 print("Parameter count : ", count_parameters(b))
 
 trainer = Trainer(model=b,
@@ -45,6 +45,9 @@ parser.add_argument("--noise_masked", action='store_true', help="add noise to ma
 parser.add_argument("--max_pos_embedding", type=int, default=2, help="number of resamplings")
 parser.add_argument("--transport_steps", type=int, default=1, help="update transport map every n steps")
 parser.add_argument("--gamma_scale", type=float, default=0., help="noise added to interpolant")
+parser.add_argument("--dc_weight", type=float, default=0., help="data-consistency step size for reconstructions (not training targets), 0 to disable")
+parser.add_argument("--dc_tmax", type=float, default=1., help="apply data consistency only for t <= dc_tmax")
+parser.add_argument("--dc_every", type=int, default=1, help="apply data consistency every n ode steps")
 
 
 args = parser.parse_args()
@@ -122,7 +125,8 @@ b = DDP(b, device_ids=[local_rank], find_unused_parameters=False)
 print("Parameter count : ", count_parameters(b))
 deconvolver = DeconvolvingInterpolant(fwd_func, use_latents=use_latents, \
                                     alpha=args.alpha, resamples=args.resamples, \
-                                    n_steps=args.ode_steps, gamma_scale=args.gamma_scale).to(device)
+                                    n_steps=args.ode_steps, gamma_scale=args.gamma_scale, \
+                                    dc_weight=args.dc_weight, dc_tmax=args.dc_tmax, dc_every=args.dc_every).to(device)
 corrupt_dataset = CorruptedDataset(dataset, deconvolver.push_fwd, \
                                    tied_rng=not(args.multiview), base_seed=args.dataset_seed)
 dataset_sampler = DistributedSampler(corrupt_dataset, num_replicas=world_size, \
@@ -14,7 +14,7 @@ from karras_unet_1d import KarrasUnet1D, PixelUnShuffle1D
 from custom_datasets import  NumpyArrayDataset, CorruptedDataset
 from interpolant_utils import DeconvolvingInterpolant
 from trainer_si import Trainer, get_worker_info
-from quasars import qso_model,  qso_dataloader, qso_callback
+from quasars import qso_model,  qso_dataloader, qso_callback, SpectraStore
 import argparse
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -36,6 +36,13 @@ parser.add_argument("--resamples", type=int, default=1, help="number of resampli
 parser.add_argument("--multiview", action='store_true', help="change corruption every epoch if provided, else not")
 parser.add_argument("--transport_steps", type=int, default=1, help="update transport map every n steps")
 parser.add_argument("--gamma_scale", type=float, default=0., help="noise added to interpolant")
+parser.add_argument("--downsample_factor", type=int, default=4, help="pixel unshuffle factor for the spectra, 1 for full resolution")
+parser.add_argument("--attn_res", type=int, nargs='+', default=None, help="resolutions with attention, default the lowest one")
+parser.add_argument("--attn_backend", type=str, default='full', help="attention backend: full, sdpa or window")
+parser.add_argument("--attn_window", type=int, default=64, help="block size for windowed attention")
+parser.add_argument("--eval_offload", type=str, default=None, help="run the callback in a 'thread' worker, or a 'process' worker on CPU-only runs")
+parser.add_argument("--profile", action='store_true', default=None, help="capture profiler traces, default from SI_PROFILE")
+parser.add_argument("--profile_steps", type=int, nargs=3, default=[10, 2, 5], help="profiler wait, warmup and active steps")
 
 args = parser.parse_args()
 print(args)
@@ -59,7 +66,7 @@ print(f"DEVICE (Rank {local_rank}): {device}")
 # Parse arguments
 normalize = False
 D = 1024
-downsample_factor = 4
+downsample_factor = args.downsample_factor
 train_num_steps = args.train_steps
 save_and_sample_every = min(500, int(train_num_steps//50))
 batch_size = args.batch_size
@@ -70,25 +77,21 @@ gradient_accumulate_every = max(1, int(train_batch_size // args.mini_batch_size)
 
 
 # Load and construct dataset
-spectra_all = [np.load(f"/mnt/ceph/users/cmodi/ML_data/qsos/spectra-2.75-3.25/spectra{i}.npy")[...] \
-               for i in range(40)] 
-spectra_all = np.concatenate(spectra_all, axis=0)
-print("Loaded spectra of shape : ", spectra_all.shape)
-# Subsize 
-subs = spectra_all.shape[-1]//D
-i0, i1 = (spectra_all.shape[-1]%D)//2, -(spectra_all.shape[-1]%D)//2
-spectra = spectra_all[:, 1,  i0:i1:subs]
-wavelength = torch.from_numpy(10**spectra_all[0, 0,  i0:i1:subs])#.to(device)
-print("Shape of spectra to use : ", spectra.shape)
-transform = lambda x: PixelUnShuffle1D(downsample_factor)(x.unsqueeze(0))
-dataset = NumpyArrayDataset(spectra, transform=transform)
+unshuffle = PixelUnShuffle1D(downsample_factor)
+transform = lambda x: unshuffle(x.unsqueeze(0))
+spectra_files = [f"/mnt/ceph/users/cmodi/ML_data/qsos/spectra-2.75-3.25/spectra{i}.npy" for i in range(40)]
+dataset = SpectraStore(spectra_files, D=D, transform=transform, normalize=normalize)
+wavelength = dataset.wavelength
+print("Shape of spectra to use : ", dataset.shape)
 qdataloader = qso_dataloader(wavelength, dataset, \
-                            downsample=downsample_factor, batch_size=args.batch_size)
+                            downsample=downsample_factor, batch_size=args.batch_size, \
+                            mean_spectra=dataset.mean_spectra, std_spectra=dataset.std_spectra)
 
 
 # Parse corruption arguments
 idloglamb, min_snr, max_snr = args.corruption_levels
-fwd_func = qso_model(wavelength, downsample_factor=downsample_factor, \
+fwd_func = qso_model(wavelength, mean_spectra=dataset.mean_spectra, std_spectra=dataset.std_spectra, \
+                     downsample_factor=downsample_factor, \
                      inv_delta_loglambda=idloglamb, min_snr=min_snr, max_snr=max_snr)
 use_latents, latent_dim = False, None
 
@@ -109,8 +112,10 @@ if local_rank == 0:
 # Initialize model and train
 # b = KarrasUnet1D(seq_len=D//downsample_factor, channels=downsample_factor, \
 #                dim=16, dim_max=32, num_blocks_per_stage=1, num_downsamples=2).to(device)
+attn_res = tuple(args.attn_res) if args.attn_res is not None else (D//downsample_factor//2**3,)
 b = KarrasUnet1D(seq_len=D//downsample_factor, channels=downsample_factor, \
-                  dim=16, num_blocks_per_stage=2, num_downsamples=3, attn_res=(32)).to(device)
+                  dim=16, num_blocks_per_stage=2, num_downsamples=3, attn_res=attn_res, \
+                  attn_backend=args.attn_backend, attn_window=args.attn_window).to(device)
 print(f"Number of parameters : {count_parameters(b)[0]:0.3f} million")
 deconvolver = DeconvolvingInterpolant(fwd_func, use_latents, n_steps=args.ode_steps, 
                                    alpha=args.alpha, resamples=args.resamples, gamma_scale=args.gamma_scale).to(device)
@@ -136,7 +141,13 @@ trainer = Trainer(model=b,
             warmup_fraction=0.05,
             update_transport_every=args.transport_steps,
             callback_fn = qso_callback,
-            callback_kwargs = {"qdataloader": qdataloader}
+            callback_kwargs = {"qdataloader": qdataloader},
+            eval_offload = args.eval_offload,
+            eval_batches = 10,
+            profile = args.profile,
+            profile_wait = args.profile_steps[0],
+            profile_warmup = args.profile_steps[1],
+            profile_active = args.profile_steps[2]
             # mixed_precision_type = 'fp32',
             )
 
@@ -6,6 +6,7 @@ import seaborn
 import numpy as np
 import pandas as pd
 from utils import grab, push_to_device
+from metrics import downsample
 
 ## Expected signature of callback_fn
 # callback_fn(milestone, b, deconvolver,
@@ -43,9 +44,9 @@ def save_image(idx, b, deconvolver, dataloader, device, results_folder, losses,
     for axis in axar.flatten():
         axis.set_xticks([])
         axis.set_yticks([])
-    plt.subplots_adjust(wspace=0.0, hspace=0.0)
-    plt.savefig(f'{results_folder}/denoising_{idx}.png', dpi=300)
-    plt.close()
+    fig.subplots_adjust(wspace=0.0, hspace=0.0)
+    fig.savefig(f'{results_folder}/denoising_{idx}.png', dpi=300)
+    plt.close(fig)
 
 
 def save_mri_pix(idx, b, deconvolver, dataloader, device, results_folder, losses, validation_data, s=None, **kargs):
@@ -67,9 +68,9 @@ def save_mri_pix(idx, b, deconvolver, dataloader, device, results_folder, losses
     for axis in axar.flatten():
         axis.set_xticks([])
         axis.set_yticks([])
-    plt.subplots_adjust(wspace=0.0, hspace=0.0)
-    plt.savefig(f'{results_folder}/denoising_{idx}.png', dpi=300)
-    plt.close()
+    fig.subplots_adjust(wspace=0.0, hspace=0.0)
+    fig.savefig(f'{results_folder}/denoising_{idx}.png', dpi=300)
+    plt.close(fig)
 
 
 def save_fig_2dsynt_vec(idx, b, deconvolver, dataloader, device, results_folder, losses, validation_data, s=None, **kargs):
@@ -103,10 +104,10 @@ def save_fig_2dsynt_vec(idx, b, deconvolver, dataloader, device, results_folder,
     axes[3].set_xlim(-6,6), axes[3].set_ylim(-6,6)
     axes[3].set_xticks([-4,0,4]), axes[3].set_yticks([])
 
-    plt.subplots_adjust(wspace=0.0, hspace=0.0)  # Reduce spacing
+    fig.subplots_adjust(wspace=0.0, hspace=0.0)  # Reduce spacing
     # plt.tight_layout()
-    plt.savefig(f'{results_folder}/denoising_{idx}.png', dpi=300)
-    plt.close()
+    fig.savefig(f'{results_folder}/denoising_{idx}.png', dpi=300)
+    plt.close(fig)
 
 
 def save_fig_2dsynt_coeff(idx, b, deconvolver, dataloader, device, results_folder, losses, validation_data, s=None, **kargs):
@@ -117,6 +118,9 @@ def save_fig_2dsynt_coeff(idx, b, deconvolver, dataloader, device, results_folde
     push_fwd_func = deconvolver.push_fwd
     # latents = kargs.get('latents', None)
     assert latents is not None, "Latents should be provided for this function"
+    operator = getattr(push_fwd_func, 'operator', None)
+    if operator is not None:
+        latents = operator.matrix(latents)
     latents = latents.squeeze()
     assert latents.shape[-1] == 2, "Latents should be 2D for this function"
     angles_rad = grab(torch.atan2(latents[:, 1], latents[:, 0]))
@@ -146,6 +150,8 @@ def save_fig_2dsynt_coeff(idx, b, deconvolver, dataloader, device, results_folde
 
     generated_corrupted, latents_new = push_fwd_func(torch.from_numpy(generated), return_latents=True)
     generated_corrupted = grab(generated_corrupted)
+    if operator is not None:
+        latents_new = operator.matrix(latents_new)
     latents_new = latents_new.squeeze()
     angles_rad_new = grab(torch.atan2(latents_new[:, 1], latents_new[:, 0]))
     axes[3].scatter(generated_corrupted[:,0], angles_rad_new, alpha = 0.03, c = c)
@@ -153,9 +159,9 @@ def save_fig_2dsynt_coeff(idx, b, deconvolver, dataloader, device, results_folde
     axes[3].set_xlim(-6,6), axes[3].set_ylim(-6,6)
     axes[3].set_xticks([-4,0,4]), axes[3].set_yticks([])
 
-    plt.subplots_adjust(wspace=0.0, hspace=0.0)  # Reduce spacing
-    plt.savefig(f'{results_folder}/denoising_{idx}.png', dpi=300)
-    plt.close()
+    fig.subplots_adjust(wspace=0.0, hspace=0.0)  # Reduce spacing
+    fig.savefig(f'{results_folder}/denoising_{idx}.png', dpi=300)
+    plt.close(fig)
 
 
 def save_fig_manifold(idx, b, deconvolver, dataloader, device, results_folder, losses, validation_data, s=None, **kargs):
@@ -180,8 +186,14 @@ def save_fig_manifold(idx, b, deconvolver, dataloader, device, results_folder, l
     plt.close(pairplot_grid.fig)
 
 
-def save_losses_fig(losses, results_folder):
-    steps = np.arange(len(losses))
+def save_losses_fig(losses, results_folder, max_points=5000):
+    """losses: per-step losses, or a dict of columns with 'step' from metrics.read_metrics; plotted bin-averaged to max_points."""
+    if isinstance(losses, dict):
+        steps = downsample(losses['step'], max_points)
+        losses = downsample(np.stack([v for k, v in losses.items() if k != 'step'], axis=-1), max_points)
+    else:
+        steps = downsample(np.arange(len(losses)), max_points)
+        losses = downsample(losses, max_points)
     fig, axs = plt.subplots(1, 2, figsize=(12, 4))
     axs[0].semilogy(steps, losses, marker='.', linestyle='-', markersize=4, alpha=0.7)
     axs[0].set_xlabel("Steps")
@@ -193,7 +205,7 @@ def save_losses_fig(losses, results_folder):
     axs[1].set_ylabel("Loss (log scale)")
     axs[1].set_title("Loss Curve (Log-Log Scale)")
     axs[1].grid(True, which="both", ls="--", alpha=0.5)
-    plt.tight_layout()
+    fig.tight_layout()
     print(os.path.join(results_folder, 'losses.png'))
-    plt.savefig(os.path.join(results_folder, 'losses.png'), dpi=300, bbox_inches='tight')
-    plt.close()
+    fig.savefig(os.path.join(results_folder, 'losses.png'), dpi=300, bbox_inches='tight')
+    plt.close(fig)
@@ -0,0 +1,105 @@
+import os
+import copy
+import queue
+import shutil
+import threading
+import torch
+
+
+class AsyncCheckpointer:
+    """
+    Writes checkpoints from a background thread.
+    save() copies the tensors of a (nested) state dict into reusable pinned CPU buffers on a side
+    CUDA stream and returns; the thread waits for the copies, torch.saves to `path.tmp` and renames
+    it over `path`, so a checkpoint on disk is never partially written.
+    Saves with the same `key` as the previous one (e.g. "latest", "best" and the step checkpoint at
+    one step) are captured and written once; the others are hard links to that file.
+    With async_write=False the same steps run inline.
+    """
+    def __init__(self, async_write=True, pin_memory=True):
+        self.async_write = async_write
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+        self._buffers = {}
+        self._last_key, self._last_path = None, None
+        self.queue = queue.Queue()
+        if async_write:
+            self.thread = threading.Thread(target=self._worker, daemon=True)
+            self.thread.start()
+
+    def _copy(self, obj, prefix=()):
+        if torch.is_tensor(obj):
+            buf = self._buffers.get(prefix)
+            if buf is None or buf.shape != obj.shape or buf.dtype != obj.dtype:
+                buf = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=self.pin_memory and obj.is_cuda)
+                self._buffers[prefix] = buf
+            return buf.copy_(obj.detach(), non_blocking=True)
+        if isinstance(obj, dict):
+            return {k: self._copy(v, prefix + (k,)) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)([self._copy(v, prefix + (i,)) for i, v in enumerate(obj)])
+        return copy.deepcopy(obj)
+
+    @torch.no_grad()
+    def snapshot(self, state):
+        """CPU copy of state; the returned event (None on CPU) marks when the copies are done."""
+        if self.stream is None:
+            return self._copy(state), None
+        self.stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self.stream):
+            cpu_state = self._copy(state)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        # later in-place updates of the live tensors must wait for the copies
+        torch.cuda.current_stream().wait_event(event)
+        return cpu_state, event
+
+    def save(self, state, path, key=None):
+        path = str(path)
+        if key is not None and key == self._last_key and self._last_path != path:
+            job = ('link', self._last_path, path)
+        else:
+            self.wait()     # the buffers are reused, so the previous write must be done
+            cpu_state, event = self.snapshot(state)
+            job = ('write', (cpu_state, event), path)
+            self._last_key, self._last_path = key, path
+        if self.async_write:
+            self.queue.put(job)
+        else:
+            self._run(job)
+
+    def _run(self, job):
+        kind, src, path = job
+        tmp = f"{path}.tmp"
+        if kind == 'write':
+            cpu_state, event = src
+            if event is not None:
+                event.synchronize()
+            torch.save(cpu_state, tmp)
+        else:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            try:
+                os.link(src, tmp)
+            except OSError:
+                shutil.copyfile(src, tmp)
+        os.replace(tmp, path)
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            try:
+                self._run(job)
+            except Exception as e:
+                print(f"Exception in writing checkpoint {job[-1]}\n", e)
+            finally:
+                self.queue.task_done()
+
+    def invalidate(self):
+        """The live state no longer matches the last key, e.g. after a rollback to an earlier step."""
+        self._last_key, self._last_path = None, None
+
+    def wait(self):
+        """Blocks until all queued checkpoints are on disk."""
+        if self.async_write:
+            self.queue.join()
@@ -1,13 +1,31 @@
 import torch
 from torch.utils.data import IterableDataset, DataLoader
-from sklearn.datasets import make_moons
+
+
+def make_generator(seed, device):
+    """Seeded torch.Generator living on `device`, or None for the global RNG."""
+    if seed is None:
+        return None
+    generator = torch.Generator(device=device)
+    generator.manual_seed(seed)
+    return generator
+
 
 class DistributionDataLoader:
     _is_my_custom_distribution_data_loader = True
-    def __init__(self, distribution, batch_size, fwd_func=None, use_latents=None):
+    def __init__(self, distribution, batch_size, fwd_func=None, use_latents=None, prefetch=1):
+        """
+        Infinite loader over a synthetic distribution. If fwd_func is given, clean samples are
+        corrupted in the same no-grad call and (samples, corrupted, latents) are returned.
+        With prefetch > 1, `prefetch` batches are sampled and corrupted in one vectorized call
+        and served from a buffer.
+        """
         self.distribution = distribution
         self.batch_size = batch_size
         self.fwd_func = fwd_func
+        self.prefetch = prefetch
+        self._buffer = None
+        self._pos = 0
         if self.fwd_func is not None:
             assert isinstance(use_latents, bool), "use_latents should be a boolean when fwd_func is provided"
             self.use_latents = use_latents
@@ -15,46 +33,66 @@ class DistributionDataLoader:
     def __iter__(self):
         return self
 
-    def __next__(self):
-        samples = self.distribution.sample(self.batch_size)
+    @torch.no_grad()
+    def _refill(self):
+        samples = self.distribution.sample(self.batch_size * self.prefetch)
         if self.fwd_func is None:
-            return samples
+            self._buffer = (samples,)
         else:
             corrupted, latents = self.fwd_func(samples, return_latents=True)
             latents = latents if self.use_latents else None
-            return samples, corrupted, latents
+            self._buffer = (samples, corrupted, latents)
+        self._pos = 0
+
+    def __next__(self):
+        if self._buffer is None or self._pos >= self.prefetch:
+            self._refill()
+        sl = slice(self._pos * self.batch_size, (self._pos + 1) * self.batch_size)
+        self._pos += 1
+        batch = tuple(b[sl] if b is not None else None for b in self._buffer)
+        return batch[0] if self.fwd_func is None else batch
 
     def __len__(self):
         return float('inf')  # Infinite length, as it generates samples on-the-fly
 
 class CheckerDistribution:
-    def __init__(self, device='cpu'):
+    def __init__(self, device='cpu', seed=None):
         self.device = device
+        self.generator = make_generator(seed, device)
 
     def sample(self, n_samples):
         # Generate checkerboard pattern data
-        x1 = torch.rand(n_samples) * 4 - 2
-        x2_ = torch.rand(n_samples) - torch.randint(2, (n_samples,)) * 2
+        kwargs = dict(device=self.device, generator=self.generator)
+        x1 = torch.rand(n_samples, **kwargs) * 4 - 2
+        x2_ = torch.rand(n_samples, **kwargs) - torch.randint(2, (n_samples,), **kwargs) * 2
         x2 = x2_ + (torch.floor(x1) % 2)
-        return (torch.cat([x1[:, None], x2[:, None]], 1) * 2).to(self.device)
+        return torch.stack([x1, x2], 1) * 2
 
 class MoonDistribution:
     def __init__(self, noise=0.1, shuffle=True, random_state=None, device='cpu'):
+        """Two moons as in sklearn's make_moons, sampled on device. random_state seeds the stream."""
         super().__init__()
         self.device = device
         self.noise = noise
         self.shuffle = shuffle
         self.random_state = random_state
+        self.generator = make_generator(random_state, device)
 
     def sample(self, n_samples):
         # Generate moon-shaped data with the specified number of samples
-        X_moon, _ = make_moons(n_samples=n_samples,
-                              noise=self.noise,
-                              shuffle=self.shuffle,
-                              random_state=self.random_state)
-
-        # Convert to torch tensor with float32
-        return 4.0*(torch.tensor(X_moon, dtype=torch.float32).to(self.device)-0.5)
+        n_out = n_samples // 2
+        n_in = n_samples - n_out
+        theta_out = torch.linspace(0, torch.pi, n_out, device=self.device)
+        theta_in = torch.linspace(0, torch.pi, n_in, device=self.device)
+        X_moon = torch.cat([
+            torch.stack([torch.cos(theta_out), torch.sin(theta_out)], 1),
+            torch.stack([1 - torch.cos(theta_in), 1 - torch.sin(theta_in) - 0.5], 1),
+        ])
+        if self.shuffle:
+            X_moon = X_moon[torch.randperm(n_samples, device=self.device, generator=self.generator)]
+        if self.noise is not None:
+            X_moon += self.noise * torch.randn(X_moon.shape, device=self.device, generator=self.generator)
+        return 4.0*(X_moon-0.5)
 
 import math
 from torch.distributions.mixture_same_family import MixtureSameFamily
@@ -81,10 +119,11 @@ class Prior(torch.nn.Module):
         return self.forward(batch_size)
 
 class GMM(Prior):
-    def __init__(self, loc=None, var=None, scale = 1.0, ndim = None, nmix= None, device='cpu', requires_grad=False):
+    def __init__(self, loc=None, var=None, scale = 1.0, ndim = None, nmix= None, device='cpu', requires_grad=False, seed=None):
         super().__init__()
 
         self.device = device
+        self.generator = make_generator(seed, device)
         self.scale = scale       ### only specify if loc is None
         def _compute_mu(ndim):
             return self.scale*torch.randn((1, ndim))
@@ -110,14 +149,21 @@ class GMM(Prior):
         comp = Independent(Normal(
             self.loc, self.var), 1)
         self.dist = MixtureSameFamily(mix, comp)
+        self.requires_grad = requires_grad
+        self._loc = self.loc.detach().to(device)
+        self._var = self.var.detach().to(device)
 
     def log_prob(self, x):
         logp = self.dist.log_prob(x)
         return logp
 
     def forward(self, batch_size):
-        x = self.dist.sample((batch_size,))
-        return x
+        if self.requires_grad:
+            return self.dist.sample((batch_size,))
+        # equal-weight mixture, sampled on device: pick components, then loc + scale * z
+        k = torch.randint(self.nmix, (batch_size,), device=self.device, generator=self.generator)
+        z = torch.randn((batch_size, self.ndim), device=self.device, generator=self.generator)
+        return self._loc[k] + self._var[k] * z
 
     def rsample(self, batch_size):
         x = self.dist.rsample((batch_size,))
@@ -8,6 +8,22 @@ def grad_and_value(x_prev, x0, fwd_func, data, latents=None):
     return norm_grad, norm
 
 
+def grad_and_value_operator(x_prev, x0, operator, data, latents=None, poisson_noise=False):
+    """
+    Same gradient as grad_and_value for a linear operator: d||y - A x0|| / dx0 = -A^T r / ||r||
+    is computed in closed form and only the denoiser is differentiated.
+    """
+    with torch.no_grad():
+        difference = data - operator.apply(x0.detach().to(torch.float32), latents)
+        norm = torch.linalg.norm(difference)
+        grad_x0 = -operator.adjoint(difference, latents) / norm
+        if poisson_noise:
+            scale = (1. / data.abs()).mean()
+            norm, grad_x0 = norm * scale, grad_x0 * scale
+    norm_grad = torch.autograd.grad(outputs=x0, inputs=x_prev, grad_outputs=grad_x0.to(x0.dtype))[0]
+    return norm_grad, norm
+
+
 def edm_sampler_dps(net, latents, fwd_func, data, data_latents=None, class_labels=None,
                     num_steps=18, sigma_min=0.002, sigma_max=80, edm_sigma_min=0.002,
                     rho=7, S_churn=0, S_min=0, S_max=float('inf'), S_noise=1,
@@ -24,6 +40,9 @@ def edm_sampler_dps(net, latents, fwd_func, data, data_latents=None, class_label
     else:
         t_steps = net.round_sigma(t_steps) #t_N = t_sigma_min
 
+    # Linear corruptions carry an explicit operator; use its adjoint instead of autograd through fwd_func
+    operator = getattr(fwd_func, 'operator', None)
+
     # Main sampling loop.
     x_next = latents.to(torch.float64) * t_steps[0]
 
@@ -44,16 +63,20 @@ def edm_sampler_dps(net, latents, fwd_func, data, data_latents=None, class_label
         # DPS update here
         # norm_grad, norm = grad_and_value(x_prev=x_cur, x0=denoised.to(torch.float32), \
         #                                 fwd_func=fwd_func, data=data, latents=data_latents)
-        difference = data - fwd_func(denoised.to(torch.float32), latents=data_latents)
-        if poisson_noise:
-            norm = torch.linalg.norm(difference) / data.abs()
-            norm = norm.mean()
+        if operator is not None:
+            norm_grad, norm = grad_and_value_operator(x_prev=x_cur, x0=denoised, operator=operator, \
+                                                      data=data, latents=data_latents, poisson_noise=poisson_noise)
         else:
-            norm = torch.linalg.norm(difference)
-        norm_grad = torch.autograd.grad(outputs=norm, inputs=x_cur)[0]
+            difference = data - fwd_func(denoised.to(torch.float32), latents=data_latents)
+            if poisson_noise:
+                norm = torch.linalg.norm(difference) / data.abs()
+                norm = norm.mean()
+            else:
+                norm = torch.linalg.norm(difference)
+            norm_grad = torch.autograd.grad(outputs=norm, inputs=x_cur)[0]
         x_next -= norm_grad * conditioning_scale
         # torch.cuda.empty_cache()  # Use only for debugging; can slow down training
-        del x_cur, denoised, d_cur , norm_grad, norm, difference
+        del x_cur, denoised, d_cur , norm_grad, norm
 
     return x_next.to(torch.float32)
 
@@ -0,0 +1,210 @@
+import copy
+import torch
+from concurrent.futures import ThreadPoolExecutor
+
+
+class FusedEMA:
+    """
+    Exponential moving averages of a model with fused multi-tensor updates.
+    Every update_every steps all floating point parameters are updated with one torch._foreach_lerp_
+    per decay rate; buffers are copied. Several decay rates can be tracked at once (betas), e.g. to
+    compare EMA profiles after training; ema_model is the average for betas[0].
+    The warmup follows ema_pytorch: plain copies up to update_after_step, then the decay
+    1 - (1 + epoch / inv_gamma) ** -power clamped to [min_value, beta].
+    The averaged parameters of each EMA model are views into one flat buffer per dtype.
+    With host=True the averages live in CPU memory: the online weights are copied to flat pinned
+    buffers on a side stream and averaged with one lerp per dtype and decay rate on a background
+    thread; the next update or access waits for that thread, which has usually finished by then.
+    state_dict/load_state_dict use the ema_pytorch layout ('step', 'initted', 'ema_model.*',
+    'online_model.*'), with the extra decay rates under 'ema_models.{i}.*'.
+    """
+    def __init__(self, model, beta=0.995, betas=None, update_every=10, update_after_step=100,
+                 inv_gamma=1., power=2/3, min_value=0., host=False):
+        self.online_model = [model]     # a list, so it is not part of the state
+        self.betas = tuple(betas) if betas is not None else (beta,)
+        self.update_every = update_every
+        self.update_after_step = update_after_step
+        self.inv_gamma = inv_gamma
+        self.power = power
+        self.min_value = min_value
+        self.host = host and torch.cuda.is_available()
+        self.step = 0
+        self.initted = False
+        self.ema_models = [copy.deepcopy(model).eval().requires_grad_(False) for _ in self.betas]
+        # floating point parameters are averaged, everything else is copied
+        online = self._online()
+        num_params = len(list(model.parameters()))
+        self.lerp_idx = [i for i, t in enumerate(online) if i < num_params and t.is_floating_point()]
+        self.copy_idx = [i for i in range(len(online)) if i not in set(self.lerp_idx)]
+        self.stream = None
+        self._pending = None
+        self.stage_flat = None
+        if self.host:
+            for m in self.ema_models:
+                m.to('cpu')
+            self.stream = torch.cuda.Stream()
+            self.executor = ThreadPoolExecutor(max_workers=1)
+            self.stage_flat, views = self._flatten(online, 'cpu', pin_memory=True)
+            self.staging = [views[i] if i in views else torch.empty(t.shape, dtype=t.dtype, pin_memory=True)
+                            for i, t in enumerate(online)]
+        self._flatten_models()
+
+    @property
+    def ema_model(self):
+        self._finish()
+        return self.ema_models[0]
+
+    def to(self, device):
+        if not self.host:
+            for m in self.ema_models:
+                m.to(device)
+            self._flatten_models()
+        return self
+
+    def _flatten(self, tensors, device, pin_memory=False):
+        """One buffer per dtype for the averaged tensors of `tensors`; returns the buffers and a dict index -> view."""
+        groups = {}
+        for i in self.lerp_idx:
+            groups.setdefault(tensors[i].dtype, []).append(i)
+        flat, views = {}, {}
+        for dtype, idx in groups.items():
+            buf = torch.empty(sum(tensors[i].numel() for i in idx), dtype=dtype, device=device, pin_memory=pin_memory)
+            offset = 0
+            for i in idx:
+                views[i] = buf[offset : offset + tensors[i].numel()].view(tensors[i].shape)
+                offset += tensors[i].numel()
+            flat[dtype] = buf
+        return flat, views
+
+    @torch.no_grad()
+    def _flatten_models(self):
+        """Moves the averaged parameters of every EMA model into flat per-dtype buffers."""
+        self.flat = []
+        for m in self.ema_models:
+            params, tensors = list(m.parameters()), self._tensors(m)
+            flat, views = self._flatten(tensors, tensors[0].device)
+            for i, v in views.items():
+                v.copy_(tensors[i])
+                params[i].data = v
+            self.flat.append(flat)
+
+    @staticmethod
+    def _tensors(model):
+        return [p.detach() for p in model.parameters()] + list(model.buffers())
+
+    def _online(self):
+        return self._tensors(self.online_model[0])
+
+    def get_current_decay(self, beta):
+        epoch = max(self.step - self.update_after_step - 1, 0)
+        if epoch <= 0:
+            return 0.
+        value = 1 - (1 + epoch / self.inv_gamma) ** -self.power
+        return min(max(value, self.min_value), beta)
+
+    @torch.no_grad()
+    def _apply(self, online, decays, flat=None):
+        """
+        Averages the tensors `online` into every EMA model; decays None copies them.
+        With `flat`, the per-dtype buffers that `online` views, each average is one lerp per dtype.
+        """
+        for k, (m, decay) in enumerate(zip(self.ema_models, decays)):
+            ema = self._tensors(m)
+            if decay is None:
+                torch._foreach_copy_(ema, online)
+                continue
+            if flat is not None:
+                for dtype, buf in flat.items():
+                    self.flat[k][dtype].lerp_(buf, 1. - decay)
+            else:
+                torch._foreach_lerp_([ema[i] for i in self.lerp_idx], [online[i] for i in self.lerp_idx], 1. - decay)
+            if len(self.copy_idx) > 0:
+                torch._foreach_copy_([ema[i] for i in self.copy_idx], [online[i] for i in self.copy_idx])
+
+    def _average(self, event, decays):
+        """Background thread: waits for the copy to the staging buffers and averages on the CPU."""
+        event.synchronize()
+        self._apply(self.staging, decays, flat=self.stage_flat)
+
+    def _finish(self):
+        """Waits for the pending host update, if any."""
+        if self._pending is None:
+            return
+        pending, self._pending = self._pending, None
+        pending.result()
+
+    @torch.no_grad()
+    def update(self):
+        step = self.step
+        self.step += 1
+        if (step % self.update_every) != 0:
+            return
+        if step <= self.update_after_step or not self.initted:
+            decays = [None] * len(self.betas)
+            self.initted = step > self.update_after_step
+        else:
+            decays = [self.get_current_decay(beta) for beta in self.betas]
+
+        online = self._online()
+        if not self.host:
+            self._apply(online, decays)
+            return
+        self._finish()  # the staging buffers are free again
+        self.stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self.stream):
+            torch._foreach_copy_(self.staging, online, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        torch.cuda.current_stream().wait_event(event)
+        self._pending = self.executor.submit(self._average, event, decays)
+
+    def state_dict(self):
+        self._finish()
+        state = {'initted': torch.tensor(self.initted), 'step': torch.tensor(self.step)}
+        state.update({f'ema_model.{k}': v for k, v in self.ema_models[0].state_dict().items()})
+        # ema_pytorch registers the online model too, so its EMA(model).load_state_dict reads ours
+        state.update({f'online_model.{k}': v for k, v in self.online_model[0].state_dict().items()})
+        for i, m in enumerate(self.ema_models[1:]):
+            state.update({f'ema_models.{i}.{k}': v for k, v in m.state_dict().items()})
+        return state
+
+    @torch.no_grad()
+    def load_state_dict(self, state):
+        """Loads ema_pytorch checkpoints too; decay rates missing from state start from ema_model."""
+        self._finish()
+        self.step = int(state['step'])
+        self.initted = bool(state['initted'])
+        sub = lambda prefix: {k[len(prefix):]: v for k, v in state.items() if k.startswith(prefix)}
+        main = sub('ema_model.')
+        self.ema_models[0].load_state_dict(main)
+        for i, m in enumerate(self.ema_models[1:]):
+            extra = sub(f'ema_models.{i}.')
+            m.load_state_dict(extra if len(extra) > 0 else main)
+
+    def counters(self):
+        """The update counters as a small state_dict/load_state_dict object, e.g. for SnapshotRing."""
+        return EMACounters(self)
+
+    def ema_model_on(self, device, index=0):
+        """The EMA model for betas[index] on device; a copy when the averages live on the host."""
+        self._finish()
+        m = self.ema_models[index]
+        return copy.deepcopy(m).to(device) if self.host else m
+
+
+class EMACounters:
+    """
+    step and initted of a FusedEMA. Restoring them together with the EMA models (ema_models)
+    rolls the averages back; a pending host update is finished before saving and before loading,
+    so load them before the EMA models are restored.
+    """
+    def __init__(self, ema):
+        self.ema = ema
+
+    def state_dict(self):
+        self.ema._finish()
+        return {'step': self.ema.step, 'initted': self.ema.initted}
+
+    def load_state_dict(self, state):
+        self.ema._finish()
+        self.ema.step, self.ema.initted = state['step'], state['initted']
@@ -0,0 +1,132 @@
+import copy
+import queue
+import types
+import threading
+import torch
+import torch.multiprocessing as mp
+
+from utils import cycle
+
+
+def _load(model, state, device):
+    if model is not None and state is not None:
+        model.load_state_dict(state)
+        model.to(device).eval()
+    return model
+
+
+def _copy_forward_map(fn, memo):
+    """
+    Copy of a forward-map closure with deep copies of the objects it captures and of its attributes
+    (e.g. `operator`); copy.deepcopy returns functions unchanged, so they would stay shared.
+    """
+    if not isinstance(fn, types.FunctionType):
+        return copy.deepcopy(fn, memo)
+    cells = tuple(types.CellType(copy.deepcopy(c.cell_contents, memo)) for c in fn.__closure__ or ())
+    new = types.FunctionType(fn.__code__, fn.__globals__, fn.__name__, fn.__defaults__, cells or None)
+    new.__kwdefaults__ = fn.__kwdefaults__
+    new.__dict__.update(copy.deepcopy(fn.__dict__, memo))
+    return new
+
+
+def _copy_deconvolver(deconvolver, device):
+    """Deep copy of the deconvolver with its own forward map and operator."""
+    memo = {}
+    push_fwd = _copy_forward_map(deconvolver.push_fwd, memo)
+    worker = copy.deepcopy(deconvolver, memo).to(device).eval()
+    worker.push_fwd = push_fwd
+    worker.operator = getattr(push_fwd, 'operator', None)
+    return worker
+
+
+def _check_no_alias(worker_module, module):
+    """Raises if a parameter or buffer of worker_module shares memory with module."""
+    tensors = lambda m: list(m.parameters()) + list(m.buffers())
+    live = {(t.device, t.untyped_storage().data_ptr()) for t in tensors(module)}
+    shared = [t for t in tensors(worker_module) if (t.device, t.untyped_storage().data_ptr()) in live]
+    if len(shared) > 0:
+        raise RuntimeError(f"evaluation copy of {type(module).__name__} shares {len(shared)} tensors with the live model")
+
+
+def _run_jobs(jobs, callback_fn, model, s_model, deconvolver, device, dtype, callback_kwargs):
+    """Worker loop: loads each snapshot into the worker's models and runs the callback; None stops."""
+    device_type = torch.device(device).type
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        state, s_state, batches, kwargs = job
+        try:
+            b = _load(model, state, device)
+            s = _load(s_model, s_state, device)
+            dataloader = cycle(batches) if len(batches) > 0 else None
+            with torch.no_grad(), torch.autocast(device_type=device_type, dtype=dtype, enabled=(device_type == 'cuda') and (dtype != torch.float32)):
+                callback_fn(b = b, s = s, deconvolver = deconvolver, dataloader = dataloader,
+                            losses = None, device = device, **kwargs, **callback_kwargs)
+        except Exception as e:
+            print("Exception in executing callback function\n", e)
+
+
+class EvalWorker:
+    """
+    Runs callback_fn on snapshots of the (EMA) models away from the training loop.
+    submit() copies the weights and a few data batches to CPU and queues them; the worker loads
+    them into its own copies of the models and deconvolver on `device` and runs the callback there.
+    mode='thread' uses a background thread and can run on a spare GPU.
+    mode='process' forks a worker process on the CPU. Forking is unsafe once CUDA is initialized,
+    so it is refused then, and the forward-map closures cannot be pickled for a spawned process.
+    At most one snapshot waits in the queue; a submit while the worker is behind is skipped.
+    The callback gets the drawn batches as `dataloader` and losses=None.
+    """
+    def __init__(self, callback_fn, model, deconvolver, s_model=None, device='cpu', mode='thread',
+                 num_batches=1, dtype=torch.float32, callback_kwargs={}):
+        assert mode in ('thread', 'process'), f'unknown evaluation mode {mode}'
+        if mode == 'process' and torch.cuda.is_initialized():
+            raise RuntimeError("mode='process' forks the trainer, which is unsafe after CUDA is initialized; use mode='thread'")
+        self.mode = mode
+        self.num_batches = num_batches
+        copies = []
+        for m in (model, s_model):
+            copies.append(copy.deepcopy(m).to(device).eval() if m is not None else None)
+            if m is not None:
+                _check_no_alias(copies[-1], m)
+        worker_deconvolver = _copy_deconvolver(deconvolver, device)
+        _check_no_alias(worker_deconvolver, deconvolver)
+        args = (callback_fn, *copies, worker_deconvolver, device, dtype, callback_kwargs)
+        if mode == 'thread':
+            self.jobs = queue.Queue(maxsize=1)
+            self.worker = threading.Thread(target=_run_jobs, args=(self.jobs,) + args, daemon=True)
+        else:
+            ctx = mp.get_context('fork')
+            self.jobs = ctx.Queue(maxsize=1)
+            self.worker = ctx.Process(target=_run_jobs, args=(self.jobs,) + args, daemon=True)
+        self.worker.start()
+
+    @staticmethod
+    def _cpu(obj):
+        if torch.is_tensor(obj):
+            return obj.detach().to('cpu', copy=True)
+        if isinstance(obj, (list, tuple)):
+            return type(obj)([EvalWorker._cpu(o) for o in obj])
+        return obj
+
+    def submit(self, b, s=None, dataloader=None, block=False, **kwargs):
+        """Queues a snapshot of b (and s) with the callback kwargs; returns False if it was skipped."""
+        if not block and self.jobs.full():
+            print("Evaluation worker busy, skipping this snapshot")
+            return False
+        state = self._cpu(b.state_dict())
+        s_state = self._cpu(s.state_dict()) if s is not None else None
+        batches = [self._cpu(next(dataloader)) for _ in range(self.num_batches)] if dataloader is not None else []
+        kwargs = {k: self._cpu(v) for k, v in kwargs.items()}
+        try:
+            self.jobs.put((state, s_state, batches, kwargs), block=block)
+        except queue.Full:
+            print("Evaluation worker busy, skipping this snapshot")
+            return False
+        return True
+
+    def close(self):
+        """Waits for the queued evaluations to finish and stops the worker."""
+        self.jobs.put(None)
+        self.worker.join()
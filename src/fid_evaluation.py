@@ -10,6 +10,7 @@ from torch.nn.functional import adaptive_avg_pool2d
 from tqdm.auto import tqdm
 from generate import edm_sampler
 from utils import exists, default
+from profiling import ScheduledProfiler, record
 
 def num_to_groups(num, divisor):
     groups = num // divisor
@@ -31,6 +32,7 @@ class FIDEvaluation:
             device="cuda",
             num_fid_samples=50000,
             inception_block_idx=2048,
+            profile=None,
     ):
         self.batch_size = batch_size
         self.n_samples = num_fid_samples
@@ -46,6 +48,7 @@ class FIDEvaluation:
         block_idx = InceptionV3.BLOCK_INDEX_BY_DIM[inception_block_idx]
         self.inception_v3 = InceptionV3([block_idx]).to(device)
         self.dataset_stats_loaded = False
+        self.profile = profile    # torch.profiler traces of a few sampling batches, None reads SI_PROFILE
         #assert (exists(self.sampler) or exists(self.model)), \
         #    "Either sampler or model needs to be provided"
         
@@ -54,7 +57,8 @@ class FIDEvaluation:
             samples = repeat(samples, "b 1 ... -> b c ...", c=3)
 
         self.inception_v3.eval()
-        features = self.inception_v3(samples)[0]
+        with record('fid/inception'):
+            features = self.inception_v3(samples)[0]
 
         if features.size(2) != 1 or features.size(3) != 1:
             features = adaptive_avg_pool2d(features, output_size=(1, 1))
@@ -114,16 +118,21 @@ class FIDEvaluation:
         self.print_fn(
             f"Stacking Inception features for {self.n_samples} generated samples."
         )
-        for batch in tqdm(batches):
-            if exists(sampler):
-                fake_samples = sampler.sample(batch_size=batch).to(torch.float32)
-            elif exists(model):
-                nc, D = model.img_channels, model.img_resolution
-                latents = torch.randn(size=(batch, nc, D, D), device=self.device)
-                with torch.no_grad():
-                    fake_samples = sampling_scheme(model, latents).to(torch.float32)
-            fake_features = self.calculate_inception_features(fake_samples)
-            stacked_fake_features.append(fake_features)
+        profiler = ScheduledProfiler(os.path.join(self.stats_dir, "profile"), name="fid",
+                                     wait=1, warmup=1, active=3, enabled=self.profile)
+        with profiler:
+            for batch in tqdm(batches):
+                with record('fid/sample'):
+                    if exists(sampler):
+                        fake_samples = sampler.sample(batch_size=batch).to(torch.float32)
+                    elif exists(model):
+                        nc, D = model.img_channels, model.img_resolution
+                        latents = torch.randn(size=(batch, nc, D, D), device=self.device)
+                        with torch.no_grad():
+                            fake_samples = sampling_scheme(model, latents).to(torch.float32)
+                fake_features = self.calculate_inception_features(fake_samples)
+                stacked_fake_features.append(fake_features)
+                profiler.step()
         stacked_fake_features = torch.cat(stacked_fake_features, dim=0).cpu().numpy()
         m1 = np.mean(stacked_fake_features, axis=0)
         s1 = np.cov(stacked_fake_features, rowvar=False)
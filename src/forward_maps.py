@@ -1,10 +1,13 @@
 import math
 import torch
-import torchvision.transforms as transforms
 import torch.nn.functional as F
 import numpy as np
 import torch.nn as nn
 from utils import infinite_dataloader
+from projections import projection_dict
+from jpeg import JPEGEngine
+from operators import IdentityOperator, MaskOperator, GaussianBlurOperator, MotionBlurOperator, \
+    MRIOperator, ProjectionOperator, DenseProjectionOperator
 
 
 def add_gaussian_noise(epsilon: float) -> callable:
@@ -17,6 +20,7 @@ def add_gaussian_noise(epsilon: float) -> callable:
         if return_latents:
             return x_n, z
         else: return x_n
+    fwd.operator = IdentityOperator(epsilon)
     return fwd
 
 
@@ -69,34 +73,35 @@ def random_mask_image(mask_ratio: float, epsilon: float, noise_mask=0.) -> calla
         else:
             return x_n
 
+    fwd.operator = MaskOperator(epsilon, noise_mask=noise_mask)
     return fwd
 
 
-def gaussian_blur(sigma: float, epsilon: float) -> callable:
+def gaussian_blur(sigma: float, epsilon: float, use_fft=None) -> callable:
     """Returns a function that applies Gaussian blur to an input tensor."""
-    kernel_size = int(2 * math.ceil(3*sigma) + 1)
-    gaussian_blur = transforms.GaussianBlur(kernel_size=kernel_size, sigma=sigma)
+    blur = GaussianBlurOperator(sigma, epsilon, use_fft=use_fft)
 
     def fwd(x, return_latents=False, generator=None, latents=None):
-        x_b = gaussian_blur(x)
+        x_b = blur.apply(x)
         z = torch.randn(x_b.shape, generator=generator).to(x.device)
-        x_b += epsilon * z
+        x_b.add_(z, alpha=epsilon)
         if return_latents:
             return x_b, z
         else:
             return x_b
 
+    fwd.operator = blur
     return fwd
 
 
-def gaussian_blur_pnoise(sigma: float, rate: float) -> callable:
+def gaussian_blur_pnoise(sigma: float, rate: float, use_fft=None) -> callable:
     """Returns a function that applies Gaussian blur to an input tensor."""
-    kernel_size = int(2 * math.ceil(3*sigma) + 1)
-    gaussian_blur = transforms.GaussianBlur(kernel_size=kernel_size, sigma=sigma)
+    blur = GaussianBlurOperator(sigma, 0., use_fft=use_fft)
 
     def fwd(x, return_latents=False, generator=None, latents=None):
-        x_b = gaussian_blur(x)
-        rate_tensor = torch.ones(x_b.shape, device=x.device)*rate
+        x_b = blur.apply(x)
+        # constant rate broadcast as a stride-0 view instead of a full rate tensor
+        rate_tensor = torch.full((), float(rate), device=x.device).expand(x_b.shape)
         noise = torch.poisson(rate_tensor, generator=generator)
         x_b += noise
         if return_latents:
@@ -160,6 +165,7 @@ def random_block_mask(block_size, epsilon):
             return img, mask
         else:
             return img
+    fwd.operator = MaskOperator(epsilon)
     return fwd
 
 
@@ -208,22 +214,20 @@ def motion_blur(kernel_size, angle, epsilon):
             return out, k
         else:
             return out
+    fwd.operator = MotionBlurOperator(kernel_size, epsilon, latent_type='fixed', angle=angle)
     return fwd
 
 
-def random_motion(kernel_size, epsilon):
+def random_motion(kernel_size, epsilon, angle_bins=None, use_fft=False):
     """
     img: Tensor[C,H,W] or [N,C,H,W], float or double
     kernel_size: odd int
     """
-    # normalize block_size to a tuple
-    # 1) Create horizontal kernel on CPU
     kernel_size = int(kernel_size)
     assert kernel_size % 2 == 1, "kernel_size must be odd"
-    k = torch.zeros(kernel_size, kernel_size)
-    k[kernel_size // 2, :] = 1.0
-    k = k.unsqueeze(0).unsqueeze(0)  # 1×1×k×k
-    pad = kernel_size // 2
+    # exact per-sample kernels by default; angle_bins=n looks them up in a cached table of n quantized
+    # angles instead (faster, but not bit-equal to the exact kernels, see operators.MotionBlurOperator)
+    blur = MotionBlurOperator(kernel_size, epsilon, latent_type='angle', angle_bins=angle_bins, use_fft=use_fft)
 
     def fwd(img, return_latents=False, generator=None, latents=None):
         # Ensure img is batched
@@ -231,42 +235,15 @@ def random_motion(kernel_size, epsilon):
         if was_3d:
             img = img.unsqueeze(0)  # Add batch dimension
         batch_size = img.size(0)
-        N, C, H, W = img.shape
 
-        # sample angle and rotate via grid_sample
+        # sample angle
         if latents is not None:
-            angles = (latents *  torch.pi).squeeze(1).to(img.device)
-            if was_3d:
-                angles = angles.unsqueeze(0)
+            angles = (latents *  torch.pi).reshape(-1).to(img.device)
         else:        
             angles = (torch.rand(batch_size, generator=generator) - 0.5) * 360.
             angles = torch.deg2rad(angles).to(img.device)  # Convert to radians
 
-        thetas = []
-        for angle in angles:
-            theta = torch.tensor([
-                [torch.cos(angle), -torch.sin(angle), 0],
-                [torch.sin(angle),  torch.cos(angle), 0]
-            ])
-            thetas.append(theta)
-        thetas = torch.stack(thetas).to(img.device)  # Shape: [batch_size, 2, 3]
-
-        # 3) Rotate kernels in batch via grid_sample
-        #    Expand k to (N,1,Kh,Kw) for grid_sample
-        k_batch = k.expand(batch_size, 1, kernel_size, kernel_size).to(img.device)
-        grid = F.affine_grid(thetas, k_batch.size(), align_corners=False)
-        ka = F.grid_sample(k_batch, grid, align_corners=False)
-        # Normalize each kernel
-        ka = ka / ka.flatten(1).sum(dim=1).view(N, 1, 1, 1)
-
-        # 4) Depthwise conv with per-sample kernels using grouped conv
-        #    Reshape input to (1, N*C, H, W) and kernels to (N*C, 1, Kh, Kw)
-        img_reshaped = img.reshape(1, N * C, H, W)
-        # Repeat each rotated kernel C times for each channel
-        weight = ka.repeat_interleave(C, dim=0)  # (N*C,1,Kh,Kw)
-        # Convolve with groups=N*C and reshape back to (N,C,H,W)
-        out = F.conv2d(img_reshaped, weight=weight, padding=pad, groups=N*C)
-        out = out.view(N, C, H, W)
+        out = blur.blur(img, blur.kernels_from_angles(angles).to(img.dtype))
 
         z = torch.randn(img.shape, generator=generator).to(img.device)
         out += z * epsilon
@@ -278,66 +255,29 @@ def random_motion(kernel_size, epsilon):
             return out, latent
         else:
             return out
+
+    fwd.operator = blur
     return fwd
 
 
-def random_motion2(kernel_size, epsilon):
+def random_motion2(kernel_size, epsilon, angle_bins=None, use_fft=False):
     """
     img: Tensor[C,H,W] or [N,C,H,W], float or double
     kernel_size: odd int
     """
-    # normalize block_size to a tuple
-    # 1) Create horizontal kernel on CPU
     kernel_size = int(kernel_size)
     assert kernel_size % 2 == 1, "kernel_size must be odd"
-    kernel = torch.zeros(kernel_size, kernel_size)
-    kernel[kernel_size // 2, :] = 1.0
-    kernel = kernel.unsqueeze(0).unsqueeze(0)  # 1×1×k×k
-    pad = kernel_size // 2
+    blur = MotionBlurOperator(kernel_size, epsilon, latent_type='direction_map', angle_bins=angle_bins, use_fft=use_fft)
 
     def direction_map_projection(cos, sin, H: int, W: int):
         """
-        Returns a single-channel map (H,W) where each pixel's
+        Returns single-channel maps (N,H,W) where each pixel's
         value = (x, y)·(cos(theta), sin(theta)), with x,y in [-1,+1].
         """
-        # vx, vy = cos, sin
-        # build normalized coordinate grids from -1 to +1
-        xs = torch.linspace(-1.0, 1.0, W, device=cos.device).view(1, W).expand(H, W)
-        ys = torch.linspace(-1.0, 1.0, H, device=sin.device).view(H, 1).expand(H, W)
-        # project each (x,y) onto the direction vector (vx, vy)
-        proj = cos * xs + sin * ys   # shape (H, W)
-        return proj
-
-
-    def fwd_single(img, cos, sin):
-
-        was_3d = (img.dim() == 3)
-        if was_3d:
-            img = img.unsqueeze(0)
-
-        # angle = torch.deg2rad(angle).to(img.device)  # Convert to radians
-        k = kernel.to(img.device)
-        # cos = torch.cos(angle)                    # (N,)
-        # sin = torch.sin(angle)                    # (N,)
-        zeros = torch.zeros_like(cos)           # (N,)
-
-        # 3) pack into the batch of 2×3 matrices
-        row1 = torch.stack([ cos, -sin, zeros ], dim=0)  # (N, 3)
-        row2 = torch.stack([ sin,  cos, zeros ], dim=0)  # (N, 3)
-        theta = torch.stack([row1, row2], dim=0).unsqueeze(0)         # (N, 2, 3)
-
-        # need N=1,C=1,H=k,W=k
-        grid = F.affine_grid(theta, k.size(), align_corners=False)
-        k = F.grid_sample(k, grid, align_corners=False)
-        k = k / k.sum()
-
-        # pad so output same size
-        pad = kernel_size // 2
-        out = F.conv2d(img, weight=k.expand(img.size(1), -1, -1, -1).to(img.device),
-                    padding=pad, groups=img.size(1))
-        out = out.squeeze(0) if was_3d else out
-
-        return out
+        xs = torch.linspace(-1.0, 1.0, W, device=cos.device).view(1, 1, W)
+        ys = torch.linspace(-1.0, 1.0, H, device=sin.device).view(1, H, 1)
+        # project each (x,y) onto the direction vector (cos, sin)
+        return cos.view(-1, 1, 1) * xs + sin.view(-1, 1, 1) * ys
 
     def fwd(img, angles=None, return_latents=False, generator=None):
         was_3d = (img.dim() == 3)
@@ -346,136 +286,34 @@ def random_motion2(kernel_size, epsilon):
         batch_size = img.size(0)
         N, C, H, W = img.shape
 
-        # sample angle and rotate via grid_sample
+        # sample angle in degrees
         if angles is  None:
             angles = (torch.rand(batch_size, generator=generator) - 0.5) * 360.
         angles = angles.to(img.device)
         rads = torch.deg2rad(angles)
-        cos, sin = torch.cos(rads), torch.sin(rads)
-        out = torch.vmap(fwd_single, in_dims=(0, 0, 0), out_dims=(0))(img, cos, sin)
+        out = blur.blur(img, blur.kernels_from_angles(rads).to(img.dtype))
 
         z = torch.randn(img.shape, generator=generator).to(img.device)
         out += z*epsilon
         out = out.squeeze(0) if was_3d else out
 
         if return_latents:
-            latent = torch.vmap(direction_map_projection, in_dims=(0, 0, None, None), out_dims=(0))  (cos, sin, H, W)
+            latent = direction_map_projection(torch.cos(rads), torch.sin(rads), H, W)
             latent = latent.unsqueeze(1)
             latent = latent.squeeze(0) if was_3d else latent
             return out, latent
         else:
             return out
 
+    fwd.operator = blur
     return fwd
 
 
 
-def jpeg_compression(min_quality=int(1), max_quality=int(100), epsilon=0.01):
-
-    # Standard JPEG quant tables
-    _QY = torch.tensor([
-        [16,11,10,16,24,40,51,61],
-        [12,12,14,19,26,58,60,55],
-        [14,13,16,24,40,57,69,56],
-        [14,17,22,29,51,87,80,62],
-        [18,22,37,56,68,109,103,77],
-        [24,35,55,64,81,104,113,92],
-        [49,64,78,87,103,121,120,101],
-        [72,92,95,98,112,100,103,99],
-    ], dtype=torch.float32)
-    _QC = torch.tensor([
-        [17,18,24,47,99,99,99,99],
-        [18,21,26,66,99,99,99,99],
-        [24,26,56,99,99,99,99,99],
-        [47,66,99,99,99,99,99,99],
-        [99,99,99,99,99,99,99,99],
-        [99,99,99,99,99,99,99,99],
-        [99,99,99,99,99,99,99,99],
-        [99,99,99,99,99,99,99,99],
-    ], dtype=torch.float32)
-
-    # Precompute the 8×8 orthonormal DCT transform matrix
-    def _make_dct8(device):
-        N=8
-        M = torch.zeros((N,N), dtype=torch.float32, device=device)
-        for k in range(N):
-            # alpha = torch.sqrt(1/N) if k==0 else torch.sqrt(2/N)
-            alpha = math.sqrt(1/N) if k==0 else math.sqrt(2/N)
-            for n in range(N):
-                M[k,n] = alpha * np.cos(torch.pi*(2*n+1)*k/(2*N))
-        return M
-
-
-    def compress(img: torch.Tensor, quality) -> torch.Tensor:
-        """
-        img: (3,H,W) in [0,1], float32
-        quality: 1 (lowest)–100 (highest)
-        returns: (3,H,W) in [0,1], float32
-        """
-        device = img.device
-        C,H,W = img.shape
-        # 1) RGB → [0,255] → YCbCr
-        mean = torch.tensor([0.4914, 0.4822, 0.4465], device=img.device).view(-1, 1, 1)
-        std = torch.tensor([0.2470, 0.2435, 0.2616], device=img.device).view(-1, 1, 1)
-        img = img * std + mean  # Now in [0, 1]
-        x = img * 255.0
-        R, G, B = x[0], x[1], x[2]
-        Y  =  0.299   * R + 0.587   * G + 0.114   * B
-        Cb = -0.168736* R - 0.331264* G + 0.5     * B + 128
-        Cr =  0.5     * R - 0.418688* G - 0.081312* B + 128
-        channels = [Y, Cb, Cr]
-
-        # 2) Build quant tables for this quality
-        q = quality
-        # scale = 5000//q if q<50 else 200 - 2*q
-        scale = torch.where(q < 50, 5000//q, 200 - 2*q)
-        def make_Q(base):
-            Q = ((base * scale + 50) / 100).floor().clamp(min=1, max=255)
-            return Q.to(device)
-        QY = make_Q(_QY)
-        QC = make_Q(_QC)
-
-        # 3) get DCT matrix
-        M = _make_dct8(device)
-        Mt = M.t()
-
-        out_ch = []
-        for idx,ch in enumerate(channels):
-            Q  = QY if idx==0 else QC
-            # shift to [-128,127]
-            c = ch - 128.0
-            # pad to multiple of 8
-            H8 = ((H+7)//8)*8
-            W8 = ((W+7)//8)*8
-            pad = (0, W8-W, 0, H8-H)
-            c_p = F.pad(c.unsqueeze(0).unsqueeze(0), pad, mode='constant', value=0)
-            # unfold into [1,64,L]
-            blocks = F.unfold(c_p, kernel_size=8, stride=8)  # shape = 1×64×L
-            L = blocks.shape[-1]
-            blocks = blocks.view(1,64,L).permute(2,0,1).view(-1,8,8)  # [L,8,8]
-
-            # DCT -> quantize
-            D = torch.matmul(M, torch.matmul(blocks, Mt))
-            qD = (D / Q).round()
-
-            # dequant + IDCT
-            Dq = qD * Q
-            rec = torch.matmul(Mt, torch.matmul(Dq, M))
-
-            # fold back
-            rec = rec.view(L,1,64).permute(1,2,0)  # 1×64×L
-            c_rec = F.fold(rec, output_size=(H8,W8), kernel_size=8, stride=8)
-            c_rec = c_rec[0,0,:H,:W] + 128.0
-            out_ch.append(c_rec)
-
-        # stack and convert back RGB
-        Yr, Cbr, Crr = out_ch
-        r = Yr + 1.402   * (Crr - 128)
-        g = Yr - 0.344136* (Cbr - 128) - 0.714136*(Crr - 128)
-        b = Yr + 1.772   * (Cbr - 128)
-        out = torch.stack((r,g,b), dim=0).clamp(0,255) / 255.0
-        out = (out - mean) / std
-        return out
+def jpeg_compression(min_quality=int(1), max_quality=int(100), epsilon=0.01, chroma_subsampling=False):
+
+    # DCT basis and quant tables for all qualities are built once (see jpeg.py)
+    engine = JPEGEngine(chroma_subsampling=bool(chroma_subsampling))
 
     def fwd(img, return_latents=False, generator=None):
         was_3d = (img.dim() == 3)
@@ -485,7 +323,7 @@ def jpeg_compression(min_quality=int(1), max_quality=int(100), epsilon=0.01):
         # sample angle and rotate via grid_sample
         quality = torch.randint(int(min_quality), int(max_quality+1), (img.shape[0],), \
                                 generator=generator)
-        out = torch.vmap(compress, in_dims=(0, 0), out_dims=(0))(img, quality)
+        out = engine(img, quality)
         z = torch.randn(img.shape, generator=generator).to(img.device)
         out += z*epsilon
         out = out.squeeze(0) if was_3d else out
@@ -502,32 +340,38 @@ def jpeg_compression(min_quality=int(1), max_quality=int(100), epsilon=0.01):
 
 
 def mri_pix1d(r, epsilon, downscale_factor=4, mode='same_rate', \
-              noise_masked=False, interpolate_masked=False):
+              noise_masked=False, interpolate_masked=False, sparse=False):
 
     from mri_data import MRI_Subsampling_Pixel
     mri = MRI_Subsampling_Pixel(r=r, epsilon=epsilon, downscale_factor=downscale_factor,\
                                 expand_latents=False, mode=mode, \
                                 noise_masked=noise_masked, \
-                                interpolate_masked=interpolate_masked)
+                                interpolate_masked=interpolate_masked, sparse=sparse)
 
     def fwd(img, return_latents=False, generator=None):
         return mri(img, return_latents=return_latents, generator=generator)
     
+    if not interpolate_masked:
+        fwd.operator = MRIOperator(epsilon, downscale_factor=downscale_factor, \
+                                   expand_latents=False, noise_masked=noise_masked)
     return fwd
 
 
 def mri_pix3d(r, epsilon, downscale_factor=4, mode='same_rate', \
-            noise_masked=False, interpolate_masked=False):
+            noise_masked=False, interpolate_masked=False, sparse=False):
 
     from mri_data import MRI_Subsampling_Pixel
     mri = MRI_Subsampling_Pixel(r=r, epsilon=epsilon, downscale_factor=downscale_factor,\
                                 expand_latents=True, mode=mode, \
                                 noise_masked=noise_masked, \
-                                interpolate_masked=interpolate_masked)
+                                interpolate_masked=interpolate_masked, sparse=sparse)
 
     def fwd(img, return_latents=False, generator=None):
         return mri(img, return_latents=return_latents, generator=generator)
     
+    if not interpolate_masked:
+        fwd.operator = MRIOperator(epsilon, downscale_factor=downscale_factor, \
+                                   expand_latents=True, noise_masked=noise_masked)
     return fwd
 
 
@@ -557,21 +401,14 @@ def compute_At_y(A_matrix: torch.Tensor, y_vector: torch.Tensor) -> torch.Tensor
 # Helper function to compute A^TA x
 def compute_AtA_x(A: torch.Tensor, x: torch.Tensor) -> torch.Tensor:
     """
-    Computes A^T(Ax) efficiently using a single einsum call.
-    Equivalent to p_i = sum_j sum_k A_ji A_jk x_k
+    Computes A^T(Ax) as two matrix-vector products, O(M*N) per sample
+    (a single 3-operand einsum may contract A^T A first, which is O(M*N^2)).
 
     A: shape (..., M, N) - The matrix defining the subspace basis vectors (rows)
-                            (Indices represented as ...jk)
     x: shape (..., N)    - The vector (or batch of vectors) to project
-                            (Indices represented as ...k)
     Returns: shape (..., N) - The projection vector p = A^T A x
-                            (Indices represented as ...i)
-"""
-    # A (...ji) - effectively A^T
-    # A (...jk) - the regular A
-    # x (...k)  - the vector x
-    # Sum over j (size M) and k (size N). Output indexed by i (size N).
-    return torch.einsum('...ji,...jk,...k->...i', A, A, x)
+    """
+    return compute_At_y(A, compute_Ax(A, x))
 
 def random_projection_coeff(dim_out: float, epsilon: float) -> callable:
     dim_out = int(dim_out)
@@ -603,13 +440,11 @@ def random_projection_coeff(dim_out: float, epsilon: float) -> callable:
             return x_n, A
         else:
             return x_n
+    fwd.operator = DenseProjectionOperator(epsilon, observe='coeff')
     return fwd
 
 def random_projection_vec(dim_out: float, epsilon: float) -> callable:
     dim_out = int(dim_out)
-    # for testing on fixed A
-    A_base = torch.randn(1, dim_out, 2, device='cuda')
-    A_base = A_base / torch.linalg.norm(A_base, dim=-1, keepdim=True)
 
     def fwd(x: torch.Tensor, return_latents=False, generator=None):
         """
@@ -617,7 +452,6 @@ def random_projection_vec(dim_out: float, epsilon: float) -> callable:
             x: a 2-D tensor of shape (B, dim_in)
         """
         N, dim_in = x.shape
-        # A = A_base.repeat(N, 1, 1).to(x.device)
         A = torch.randn(N, dim_out, dim_in, device=x.device)
         A = A / torch.linalg.norm(A, dim=-1, keepdim=True)
         # A = (2.0*torch.rand([N, 1, dim_in], device=x.device)-1.0)
@@ -636,8 +470,51 @@ def random_projection_vec(dim_out: float, epsilon: float) -> callable:
             return x_n, A
         else:
             return x_n
+    fwd.operator = DenseProjectionOperator(epsilon, observe='vec')
     return fwd
 
+def seeded_projection_coeff(kind: str) -> callable:
+    """
+    Same observation model as random_projection_coeff, but A is an implicit operator
+    (see projections.py) and the latents are (N, 1) seeds instead of (N, dim_out, dim_in) matrices.
+    """
+    def make(dim_out: float, epsilon: float, dim_in: int = 2) -> callable:
+        projection = projection_dict[kind](dim_in, int(dim_out))
+        def fwd(x: torch.Tensor, return_latents=False, generator=None):
+            N = x.shape[0]
+            seeds = projection.sample_seeds(N, generator=generator, device=x.device)
+            x_n = projection.apply(seeds, x)
+            z = torch.randn(x_n.shape, generator=generator).to(x.device)
+            x_n += z * epsilon
+            padded = torch.randn(N, projection.dim_in - projection.dim_out, device=x.device)
+            x_n = torch.cat([x_n, padded], dim=-1)
+
+            if return_latents:
+                return x_n, seeds.float().unsqueeze(1)
+            else:
+                return x_n
+        fwd.operator = ProjectionOperator(projection, epsilon, observe='coeff')
+        return fwd
+    return make
+
+def seeded_projection_vec(kind: str) -> callable:
+    """Same observation model as random_projection_vec (A^T A x + noise) with seeded implicit operators."""
+    def make(dim_out: float, epsilon: float, dim_in: int = 2) -> callable:
+        projection = projection_dict[kind](dim_in, int(dim_out))
+        def fwd(x: torch.Tensor, return_latents=False, generator=None):
+            seeds = projection.sample_seeds(x.shape[0], generator=generator, device=x.device)
+            x_n = projection.normal(seeds, x)
+            z = torch.randn(x_n.shape, generator=generator).to(x.device)
+            x_n += z * epsilon
+
+            if return_latents:
+                return x_n, seeds.float().unsqueeze(1)
+            else:
+                return x_n
+        fwd.operator = ProjectionOperator(projection, epsilon, observe='vec')
+        return fwd
+    return make
+
 def random_projection_vec_dataset(dataloader) -> callable:
     N_dl = dataloader.batch_size
     N_total = dataloader.dataset.__len__()
@@ -662,6 +539,7 @@ def random_projection_vec_dataset(dataloader) -> callable:
             return x_n, A
         else:
             return x_n
+    fwd.operator = DenseProjectionOperator(0.01, observe='vec', noise_in_range=True)
     return fwd
 
 corruption_dict = {
@@ -680,6 +558,12 @@ corruption_dict = {
     'projection_coeff': random_projection_coeff,
     'projection_vec': random_projection_vec,
     'projection_vec_ds': random_projection_vec_dataset,
+    'projection_coeff_gaussian': seeded_projection_coeff('gaussian'),
+    'projection_coeff_sparse': seeded_projection_coeff('sparse'),
+    'projection_coeff_srht': seeded_projection_coeff('srht'),
+    'projection_vec_gaussian': seeded_projection_vec('gaussian'),
+    'projection_vec_sparse': seeded_projection_vec('sparse'),
+    'projection_vec_srht': seeded_projection_vec('srht'),
 }
 
 def parse_latents(corruption, D, s=None):
@@ -0,0 +1,100 @@
+import json
+import time
+import contextlib
+import torch
+
+from torch_utils import training_stats
+from profiling import record
+
+PHASES = ('data', 'transport', 'push_fwd', 'forward_backward', 'optimizer', 'ema', 'checkpoint', 'callback')
+
+
+class StepTimer:
+    """
+    Per-phase timings of the training loop, reported through torch_utils.training_stats.
+    phase(name) times a block: on CUDA with a pair of timing events that are only read back
+    at flush(), so the loop never syncs for them; on CPU, or with host=True, with perf_counter.
+    forward_backward includes the nested transport and push_fwd phases.
+    Each phase is also a profiler range while a profiling.ScheduledProfiler runs.
+    end_step() reports the host step time, samples/s and the model evaluations counted by
+    counted(); flush() also reports the peak device memory since the last flush.
+    All names are registered up front so every rank reports them in the same order.
+    """
+    def __init__(self, device, enabled=True):
+        self.enabled = enabled
+        self.cuda = torch.device(device).type == 'cuda'
+        self.pending = []
+        self.nfe = 0
+        self.last = None
+        self.names = [f'Timing/{p}_ms' for p in PHASES] + ['Timing/step_ms', 'Progress/nfe', 'Progress/samples_per_s']
+        if self.cuda:
+            self.names.append('Resources/peak_mem_gib')
+        for name in self.names:
+            training_stats.report(name, [])
+
+    @contextlib.contextmanager
+    def phase(self, name, host=False):
+        with record(name):
+            if not self.enabled:
+                yield
+            elif self.cuda and not host:
+                start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+                start.record()
+                yield
+                end.record()
+                self.pending.append((name, start, end))
+            else:
+                t0 = time.perf_counter()
+                yield
+                training_stats.report(f'Timing/{name}_ms', (time.perf_counter() - t0) * 1e3)
+
+    def counted(self, fn):
+        """Wraps a model so each call adds to the step's number of function evaluations."""
+        if not self.enabled or fn is None:
+            return fn
+        def wrapper(*args, **kwargs):
+            self.nfe += 1
+            return fn(*args, **kwargs)
+        return wrapper
+
+    def end_step(self, num_samples):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.last is not None:
+            step_ms = (now - self.last) * 1e3
+            training_stats.report('Timing/step_ms', step_ms)
+            training_stats.report('Progress/samples_per_s', num_samples / step_ms * 1e3)
+        training_stats.report('Progress/nfe', self.nfe)
+        self.last, self.nfe = now, 0
+
+    def flush(self):
+        """Reads back the device timings (one sync) and reports the peak memory."""
+        if not self.enabled:
+            return
+        if len(self.pending) > 0:
+            self.pending[-1][2].synchronize()
+            for name, start, end in self.pending:
+                training_stats.report(f'Timing/{name}_ms', start.elapsed_time(end))
+            self.pending = []
+        if self.cuda:
+            training_stats.report('Resources/peak_mem_gib', torch.cuda.max_memory_allocated() / 2**30)
+            torch.cuda.reset_peak_memory_stats()
+
+
+class StatsLog:
+    """Collects the training_stats every flush and appends one compact JSON line to `path`."""
+    def __init__(self, path, master=True):
+        self.path = path
+        self.master = master
+        self.collector = training_stats.Collector(regex='.*')
+
+    def write(self, step):
+        self.collector.update()
+        if not self.master:
+            return None
+        stats = {name: round(self.collector.mean(name), 4) for name in self.collector.names()
+                 if self.collector.num(name) > 0}
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({'step': step, **stats}) + '\n')
+        return stats
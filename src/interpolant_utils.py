@@ -1,6 +1,7 @@
 import torch
 import math
 from networks import MLPResNet, PositionalEmbedding
+from profiling import record
 
 class VelocityField(torch.nn.Module):
 
@@ -34,26 +35,26 @@ class MLPVelocityField(torch.nn.Module):
         self.net = MLPResNet(input_dim, hidden_dim, output_dim, depth)
         self.time_encoding = PositionalEmbedding(t_freq, max_positions=2)
 
-    def _single_forward(self, x, t, latents=None):
-        # t_encoded = fourier_encode(t, self.t_freq)  # [B, 2*n_freqs]
-        t_encoded = self.time_encoding(t.unsqueeze(0)).squeeze(0)  # [B, 2*n_freqs]
-        x_cond = torch.cat([x, t_encoded])
-        if self.latent_net is not None:
-            latents = self.latent_net(latents)
-            x_cond = torch.cat([x_cond, latents])
-        return self.net(x_cond)
-
     def forward(self, x, t, latents=None):
-        if latents is None:
-            latents = t*0.
-        return torch.vmap(self._single_forward, in_dims=(0,0,0), out_dims=(0))(x, t, latents)
+        # batched over the leading dim; same parameters as the earlier per-sample vmap version
+        t = t.reshape(-1).expand(x.shape[0]) if t.numel() == 1 else t.reshape(-1)
+        x_cond = [x, self.time_encoding(t).to(x.dtype)]  # [B, d], [B, t_freq]
+        if self.latent_net is not None:
+            x_cond.append(self.latent_net(latents))  # [B, t_freq]
+        return self.net(torch.cat(x_cond, dim=-1))
 
 
 class DeconvolvingInterpolant(torch.nn.Module):
 
-    def __init__(self, push_fwd, use_latents=False, n_steps=80, alpha=1.0, resamples=1, diffusion_coeff=0.0, gamma_scale=0.0, sampler='euler'):
+    def __init__(self, push_fwd, use_latents=False, n_steps=80, alpha=1.0, resamples=1, diffusion_coeff=0.0, gamma_scale=0.0, sampler='euler', \
+                 dc_weight=0., dc_tmax=1., dc_every=1):
         super().__init__()
         self.push_fwd = push_fwd
+        # data-consistency correction in transport for linear corruptions (see data_consistency)
+        self.operator = getattr(push_fwd, 'operator', None)
+        self.dc_weight = dc_weight
+        self.dc_tmax = dc_tmax
+        self.dc_every = dc_every
         self.n_steps = n_steps
         self.delta_t = 1 / self.n_steps
         self.sqrt_delta_t = self.delta_t**0.5
@@ -63,6 +64,7 @@ class DeconvolvingInterpolant(torch.nn.Module):
         self.diffusion_coeff = diffusion_coeff
         self.gamma_scale = gamma_scale
         self.sampler = sampler
+        self.timer = None   # optional instrumentation.StepTimer, set by the trainer
         if sampler == 'heun':
             print("Using heun sampler")
         if self.diffusion_coeff == 'gamma':
@@ -71,6 +73,12 @@ class DeconvolvingInterpolant(torch.nn.Module):
             print("WARNING: diffusion_coeff is larger than 0.25 * gamma_scale, maximum noise during training.")
         if use_latents:
             print("Using latents for deonvolving")
+        if self.dc_weight > 0:
+            if self.operator is None:
+                raise ValueError("dc_weight > 0 needs a linear forward map exposing `operator`")
+            if sampler == 'heun':
+                raise ValueError("data consistency (dc_weight > 0) is only implemented for the euler sampler")
+            print(f"Data consistency with weight {dc_weight} for t <= {dc_tmax}, every {dc_every} steps")
 
             
     def loss_fn(self, b, x, latent=None, x0=None, b_fixed=None, s=None, s_fixed=None):
@@ -81,13 +89,18 @@ class DeconvolvingInterpolant(torch.nn.Module):
         if x0 is None: # x0 is the cleandata, use if provided
             b_transport = b_fixed if b_fixed is not None else b
             s_transport = s_fixed if s_fixed is not None else s
-            if self.sampler == 'euler':
-                x0 = self.transport(b_transport, x, latent=latent, s=s_transport)
-            elif self.sampler == 'heun':
-                x0 = self.transport_heun(b_transport, x, latent=latent, s=s_transport)
+            if self.timer is not None:
+                b_transport, s_transport = self.timer.counted(b_transport), self.timer.counted(s_transport)
+            with self.phase('transport'):
+                # training targets come from the plain sampler, data consistency is for reconstructions only
+                if self.sampler == 'euler':
+                    x0 = self.transport(b_transport, x, latent=latent, s=s_transport, data_consistency=False)
+                elif self.sampler == 'heun':
+                    x0 = self.transport_heun(b_transport, x, latent=latent, s=s_transport)
 
         for i in range(self.resamples):
-            x1, latent1 = self.push_fwd(x0, return_latents=True)
+            with self.phase('push_fwd'):
+                x1, latent1 = self.push_fwd(x0, return_latents=True)
             latent1 = latent1 if self.use_latents else None
 
             # pick data with probabability 1-alpha
@@ -120,10 +133,29 @@ class DeconvolvingInterpolant(torch.nn.Module):
         else:
             return loss / self.resamples, None  # s_loss is None
 
-    def transport(self, b, x, latent=None, s=None, return_trajectory=False, return_velocity=False):
+    def phase(self, name):
+        return self.timer.phase(name) if self.timer is not None else record(name)
+
+    def data_consistency(self, Xt, v, t, y, latent=None):
+        """
+        Gradient step of size dc_weight on 0.5 * ||A x0 - y||^2 for the clean estimate x0 = Xt - t v
+        implied by the interpolant at time t, carried back into the state as (1 - t) * dx0.
+        With dc_weight=1 and A^T A a projection (masks, MRI lines) this replaces the observed
+        components of x0 by the data; use dc_weight < 1 for noisy observations.
+        """
+        x0 = Xt - t * v
+        residual = self.operator.apply(x0, latent) - y
+        return Xt - (1 - t) * self.dc_weight * self.operator.adjoint(residual, latent)
+
+    def dc_scheduled(self, i, t):
+        """Apply data consistency after step i (ending at time t) for t <= dc_tmax, every dc_every steps counted from the last."""
+        return self.dc_weight > 0 and t <= self.dc_tmax and (self.n_steps - i) % self.dc_every == 0
+
+    def transport(self, b, x, latent=None, s=None, return_trajectory=False, return_velocity=False, data_consistency=True):
+        """Euler sampler from x at t=1 to t=0; with data_consistency and dc_weight > 0 the steps are corrected (see data_consistency)."""
         traj = [x]
         vel_all = []
-        with torch.no_grad():
+        with torch.no_grad(), record('transport/euler'):
             Xt_prev = x*1.
             for i in range(1, self.n_steps+1):
                 ti_scalar = 1 - (i-1) * self.delta_t
@@ -140,6 +172,9 @@ class DeconvolvingInterpolant(torch.nn.Module):
                         diffusion_coeff = self.gamma_scale * (ti_scalar) *  (1.0 - ti_scalar)
                         Xt_prev -= s(Xt_prev, ti, latent) *  self.delta_t # score term
                         Xt_prev += math.sqrt(2. * diffusion_coeff) * self.sqrt_delta_t*torch.randn(x.shape).to(x.device) # diffusion term
+                t_next = ti_scalar - self.delta_t
+                if data_consistency and self.dc_scheduled(i, t_next):
+                    Xt_prev = self.data_consistency(Xt_prev, v, t_next, x, latent)
                 if return_trajectory:
                     traj.append(Xt_prev)
             Xt_final = Xt_prev
@@ -168,7 +203,7 @@ class DeconvolvingInterpolant(torch.nn.Module):
             a = -(v + score_scaled)
             return a
         
-        with torch.no_grad():
+        with torch.no_grad(), record('transport/heun'):
             Xt_prev = x*1.
             for i in range(1, self.n_steps+1):
                 ti_scalar = 1 - (i-1) * self.delta_t
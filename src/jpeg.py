@@ -0,0 +1,119 @@
+import torch
+import torch.nn.functional as F
+
+# Standard JPEG quant tables
+_QY = torch.tensor([
+    [16,11,10,16,24,40,51,61],
+    [12,12,14,19,26,58,60,55],
+    [14,13,16,24,40,57,69,56],
+    [14,17,22,29,51,87,80,62],
+    [18,22,37,56,68,109,103,77],
+    [24,35,55,64,81,104,113,92],
+    [49,64,78,87,103,121,120,101],
+    [72,92,95,98,112,100,103,99],
+], dtype=torch.float32)
+_QC = torch.tensor([
+    [17,18,24,47,99,99,99,99],
+    [18,21,26,66,99,99,99,99],
+    [24,26,56,99,99,99,99,99],
+    [47,66,99,99,99,99,99,99],
+    [99,99,99,99,99,99,99,99],
+    [99,99,99,99,99,99,99,99],
+    [99,99,99,99,99,99,99,99],
+    [99,99,99,99,99,99,99,99],
+], dtype=torch.float32)
+
+_RGB_TO_YCC = torch.tensor([
+    [ 0.299,     0.587,     0.114   ],
+    [-0.168736, -0.331264,  0.5     ],
+    [ 0.5,      -0.418688, -0.081312],
+])
+_YCC_TO_RGB = torch.tensor([
+    [1.,  0.,        1.402   ],
+    [1., -0.344136, -0.714136],
+    [1.,  1.772,     0.      ],
+])
+
+CIFAR_MEAN = (0.4914, 0.4822, 0.4465)
+CIFAR_STD = (0.2470, 0.2435, 0.2616)
+
+
+def dct_matrix(N=8):
+    """Orthonormal DCT-II matrix M, so that M @ block @ M.T is the 2D DCT of a block."""
+    k = torch.arange(N, dtype=torch.float64).unsqueeze(1)
+    n = torch.arange(N, dtype=torch.float64).unsqueeze(0)
+    M = torch.cos(torch.pi * (2*n + 1) * k / (2*N)) * (2. / N) ** 0.5
+    M[0] /= 2. ** 0.5
+    return M.float()
+
+
+def quant_tables(base):
+    """Quality-scaled tables for qualities 1..100, shape (100, 8, 8)."""
+    q = torch.arange(1, 101).view(-1, 1, 1)
+    scale = torch.where(q < 50, 5000 // q, 200 - 2*q)
+    return ((base * scale + 50) / 100).floor().clamp(min=1, max=255)
+
+
+class JPEGEngine:
+    """
+    Batched JPEG round trip for normalized RGB images (N, 3, H, W) with per-image qualities in 1..100.
+    The DCT basis and the quant tables for all qualities are built once and cached per device;
+    all channels and images go through a single block DCT -> quantize -> inverse DCT pass.
+    With chroma_subsampling, Cb and Cr are averaged over 2x2 pixels (4:2:0) before coding.
+    """
+    def __init__(self, chroma_subsampling=False, mean=CIFAR_MEAN, std=CIFAR_STD):
+        self.chroma_subsampling = chroma_subsampling
+        self.tables = {
+            'M': dct_matrix(8),
+            'Q': torch.stack([quant_tables(_QY), quant_tables(_QC)], dim=1),  # (100, 2, 8, 8)
+            'mean': torch.tensor(mean).view(-1, 1, 1),
+            'std': torch.tensor(std).view(-1, 1, 1),
+            'rgb2ycc': _RGB_TO_YCC,
+            'ycc2rgb': _YCC_TO_RGB,
+            'offset': torch.tensor([0., 128., 128.]).view(-1, 1, 1),
+        }
+        self._device_tables = {}
+
+    def tables_on(self, device):
+        key = str(device)
+        if key not in self._device_tables:
+            self._device_tables[key] = {k: v.to(device) for k, v in self.tables.items()}
+        return self._device_tables[key]
+
+    @staticmethod
+    def roundtrip(c, Q, M):
+        """DCT, quantize and invert the 8x8 blocks of c (N, K, H, W) with tables Q (N, K, 8, 8)."""
+        N, K, H, W = c.shape
+        H8, W8 = -(-H // 8) * 8, -(-W // 8) * 8
+        c = F.pad(c, (0, W8 - W, 0, H8 - H))
+        blocks = c.reshape(N, K, H8 // 8, 8, W8 // 8, 8).transpose(3, 4)  # (N, K, H8/8, W8/8, 8, 8)
+        Q = Q[:, :, None, None]
+        D = M @ blocks @ M.T
+        rec = M.T @ ((D / Q).round() * Q) @ M
+        rec = rec.transpose(3, 4).reshape(N, K, H8, W8)
+        return rec[..., :H, :W]
+
+    def __call__(self, img, quality):
+        """
+        img: (N, 3, H, W) normalized with (mean, std)
+        quality: (N,) integers in 1..100
+        returns: (N, 3, H, W) normalized, float32
+        """
+        T = self.tables_on(img.device)
+        H, W = img.shape[-2:]
+        x = (img.float() * T['std'] + T['mean']) * 255.0
+        # RGB -> YCbCr, shifted to [-128, 127]
+        ycc = torch.einsum('ij,njhw->nihw', T['rgb2ycc'], x) + T['offset'] - 128.0
+        Q = T['Q'][quality.to(img.device).long() - 1]  # (N, 2, 8, 8)
+        if self.chroma_subsampling:
+            y = self.roundtrip(ycc[:, :1], Q[:, :1], T['M'])
+            chroma = F.avg_pool2d(ycc[:, 1:], 2, ceil_mode=True)
+            chroma = self.roundtrip(chroma, Q[:, 1:].expand(-1, 2, -1, -1), T['M'])
+            chroma = F.interpolate(chroma, scale_factor=2, mode='bilinear', align_corners=False)[..., :H, :W]
+            ycc = torch.cat([y, chroma], dim=1)
+        else:
+            ycc = self.roundtrip(ycc, Q[:, [0, 1, 1]], T['M'])
+        # YCbCr -> RGB
+        ycc = ycc + 128.0 - T['offset']
+        out = torch.einsum('ij,njhw->nihw', T['ycc2rgb'], ycc).clamp(0, 255) / 255.0
+        return (out - T['mean']) / T['std']
@@ -3,6 +3,7 @@ the magnitude-preserving unet proposed in https://arxiv.org/abs/2312.02696 by Ka
 """
 
 import math
+import copy
 from math import sqrt, ceil
 from functools import partial
 
@@ -58,7 +59,16 @@ def l2norm(t, dim = -1, eps = 1e-12):
 # section 2.5
 
 class MPSiLU(Module):
+    def __init__(self):
+        super().__init__()
+        self.folded = False     # 1 / 0.596 moved into the next layer's weight, see fold_mp_silu
+
+    def unfold(self):
+        self.folded = False
+
     def forward(self, x):
+        if self.folded and not self.training:
+            return F.silu(x)
         return F.silu(x) / 0.596
 
 # gain - layer scaling
@@ -67,8 +77,14 @@ class Gain(Module):
     def __init__(self):
         super().__init__()
         self.gain = nn.Parameter(torch.tensor(0.))
+        self.folded = False     # gain moved into the previous layer's weight, see fold_gain
+
+    def unfold(self):
+        self.folded = False
 
     def forward(self, x):
+        if self.folded and not self.training:
+            return x
         return x * self.gain
 
 # magnitude preserving concat
@@ -100,8 +116,20 @@ class MPAdd(Module):
     def __init__(self, t):
         super().__init__()
         self.t = t
+        self.folded = False
+
+    def fold(self):
+        """Returns the factor (1 - t) / den to fold into the layer producing x."""
+        self.folded = True
+        return (1. - self.t) / sqrt((1 - self.t) ** 2 + self.t ** 2)
+
+    def unfold(self):
+        self.folded = False
 
     def forward(self, x, res):
+        if self.folded and not self.training:
+            t = self.t
+            return torch.add(x, res, alpha = t / sqrt((1 - t) ** 2 + t ** 2))
         a, b, t = x, res, self.t
         num = a * (1. - t) + b * t
         den = sqrt((1 - t) ** 2 + t ** 2)
@@ -144,17 +172,30 @@ class Conv2d(Module):
         self.weight = nn.Parameter(weight)
 
         self.eps = eps
+        self.register_buffer('folded_weight', None, persistent = False)
         self.fan_in = dim_in * kernel_size ** 2
         self.concat_ones_to_input = concat_ones_to_input
 
-    def forward(self, x):
+    @torch.no_grad()
+    def fold(self, scale = 1.):
+        """Freeze the normalized weight for eval mode, times a constant from the surrounding MP ops."""
+        if not exists(self.folded_weight):
+            self.folded_weight = normalize_weight(self.weight, eps = self.eps) / sqrt(self.fan_in)
+        self.folded_weight = self.folded_weight * scale
+
+    def unfold(self):
+        self.folded_weight = None
 
-        if self.training:
-            with torch.no_grad():
-                normed_weight = normalize_weight(self.weight, eps = self.eps)
-                self.weight.copy_(normed_weight)
+    def forward(self, x):
+        if exists(self.folded_weight) and not self.training:
+            weight = self.folded_weight
+        else:
+            if self.training:
+                with torch.no_grad():
+                    normed_weight = normalize_weight(self.weight, eps = self.eps)
+                    self.weight.copy_(normed_weight)
 
-        weight = normalize_weight(self.weight, eps = self.eps) / sqrt(self.fan_in)
+            weight = normalize_weight(self.weight, eps = self.eps) / sqrt(self.fan_in)
 
         if self.concat_ones_to_input:
             x = F.pad(x, (0, 0, 0, 0, 1, 0), value = 1.)
@@ -168,14 +209,28 @@ class Linear(Module):
         self.weight = nn.Parameter(weight)
         self.eps = eps
         self.fan_in = dim_in
+        self.register_buffer('folded_weight', None, persistent = False)
+
+    @torch.no_grad()
+    def fold(self, scale = 1.):
+        """Freeze the normalized weight for eval mode, times a constant from the surrounding MP ops."""
+        if not exists(self.folded_weight):
+            self.folded_weight = normalize_weight(self.weight, eps = self.eps) / sqrt(self.fan_in)
+        self.folded_weight = self.folded_weight * scale
+
+    def unfold(self):
+        self.folded_weight = None
 
     def forward(self, x):
-        if self.training:
-            with torch.no_grad():
-                normed_weight = normalize_weight(self.weight, eps = self.eps)
-                self.weight.copy_(normed_weight)
+        if exists(self.folded_weight) and not self.training:
+            weight = self.folded_weight
+        else:
+            if self.training:
+                with torch.no_grad():
+                    normed_weight = normalize_weight(self.weight, eps = self.eps)
+                    self.weight.copy_(normed_weight)
 
-        weight = normalize_weight(self.weight, eps = self.eps) / sqrt(self.fan_in)
+            weight = normalize_weight(self.weight, eps = self.eps) / sqrt(self.fan_in)
         return F.linear(x, weight)
 
 # mp fourier embeds
@@ -192,6 +247,18 @@ class MPFourierEmbedding(Module):
         freqs = x * rearrange(self.weights, 'd -> 1 d') * 2 * math.pi
         return torch.cat((freqs.sin(), freqs.cos()), dim = -1) * sqrt(2)
 
+# folding for inference: MP constants and gains move into the neighbouring weights
+
+def fold_mp_silu(block, scale = 1.):
+    """block is (MPSiLU, [Dropout], conv): move the 1 / 0.596 of the activation into the conv weight."""
+    block[0].folded = True
+    block[-1].fold(scale / 0.596)
+
+def fold_gain(block):
+    """block is (conv or linear, Gain): move the gain into the weight."""
+    block[0].fold(block[1].gain.item())
+    block[1].folded = True
+
 # building block modules
 
 class Encoder(Module):
@@ -252,6 +319,12 @@ class Encoder(Module):
                 flash = attn_flash
             )
 
+    def fold(self):
+        fold_mp_silu(self.block1)
+        fold_mp_silu(self.block2, self.res_mp_add.fold())
+        if exists(self.to_emb):
+            fold_gain(self.to_emb)
+
     def forward(
         self,
         x,
@@ -334,6 +407,12 @@ class Decoder(Module):
                 flash = attn_flash
             )
 
+    def fold(self):
+        fold_mp_silu(self.block1)
+        fold_mp_silu(self.block2, self.res_mp_add.fold())
+        if exists(self.to_emb):
+            fold_gain(self.to_emb)
+
     def forward(
         self,
         x,
@@ -385,6 +464,14 @@ class Attention(Module):
         self.to_out = Conv2d(hidden_dim, dim, 1)
 
         self.mp_add = MPAdd(t = mp_add_t)
+        self.register_buffer('mem_kv_normed', None, persistent = False)
+
+    def fold(self):
+        self.to_out.fold(self.mp_add.fold())
+        self.mem_kv_normed = self.pixel_norm(self.mem_kv)
+
+    def unfold(self):
+        self.mem_kv_normed = None
 
     def forward(self, x):
         res, b, c, h, w = x, *x.shape
@@ -392,10 +479,16 @@ class Attention(Module):
         qkv = self.to_qkv(x).chunk(3, dim = 1)
         q, k, v = map(lambda t: rearrange(t, 'b (h c) x y -> b h (x y) c', h = self.heads), qkv)
 
-        mk, mv = map(lambda t: repeat(t, 'h n d -> b h n d', b = b), self.mem_kv)
-        k, v = map(partial(torch.cat, dim = -2), ((mk, k), (mv, v)))
+        if exists(self.mem_kv_normed) and not self.training:
+            # memory kv are normalized once; expand is a view over the batch
+            q, k, v = map(self.pixel_norm, (q, k, v))
+            mk, mv = self.mem_kv_normed.unsqueeze(1).expand(-1, b, -1, -1, -1)
+            k, v = map(partial(torch.cat, dim = -2), ((mk, k), (mv, v)))
+        else:
+            mk, mv = map(lambda t: repeat(t, 'h n d -> b h n d', b = b), self.mem_kv)
+            k, v = map(partial(torch.cat, dim = -2), ((mk, k), (mv, v)))
 
-        q, k, v = map(self.pixel_norm, (q, k, v))
+            q, k, v = map(self.pixel_norm, (q, k, v))
 
         out = self.attend(q, k, v)
 
@@ -554,6 +647,35 @@ class KarrasUnet(Module):
     def downsample_factor(self):
         return 2 ** self.num_downsamples
 
+    @torch.no_grad()
+    def fold_for_inference(self):
+        """
+        Folds the forced weight normalization, gains and MP constants into frozen weights used
+        in eval mode, so inference skips normalize_weight. Training mode ignores the folded
+        weights; call again after the parameters change.
+        """
+        for m in self.modules():
+            if hasattr(m, 'unfold'):
+                m.unfold()
+        for m in self.modules():
+            if isinstance(m, (Conv2d, Linear)):
+                m.fold()
+        for m in self.modules():
+            if isinstance(m, (Encoder, Decoder, Attention)):
+                m.fold()
+        # the embedding activation only feeds the to_emb layers of the blocks
+        self.emb_activation.folded = True
+        for m in self.modules():
+            if isinstance(m, (Encoder, Decoder)) and exists(m.to_emb):
+                m.to_emb[0].fold(1 / 0.596)
+        fold_gain(self.output_block)
+        return self
+
+    def export_for_inference(self):
+        """Frozen eval-mode copy with folded weights."""
+        model = copy.deepcopy(self).eval().requires_grad_(False)
+        return model.fold_for_inference()
+
     def forward(
         self,
         x,
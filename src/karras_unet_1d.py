@@ -3,6 +3,7 @@ the magnitude-preserving unet proposed in https://arxiv.org/abs/2312.02696 by Ka
 """
 
 import math
+import copy
 from math import sqrt, ceil
 from functools import partial
 
@@ -104,7 +105,16 @@ class PixelUnShuffle1D(torch.nn.Module):
 
 
 class MPSiLU(Module):
+    def __init__(self):
+        super().__init__()
+        self.folded = False     # 1 / 0.596 moved into the next layer's weight, see fold_mp_silu
+
+    def unfold(self):
+        self.folded = False
+
     def forward(self, x):
+        if self.folded and not self.training:
+            return F.silu(x)
         return F.silu(x) / 0.596
 
 # gain - layer scaling
@@ -113,8 +123,14 @@ class Gain(Module):
     def __init__(self):
         super().__init__()
         self.gain = nn.Parameter(torch.tensor(0.))
+        self.folded = False     # gain moved into the previous layer's weight, see fold_gain
+
+    def unfold(self):
+        self.folded = False
 
     def forward(self, x):
+        if self.folded and not self.training:
+            return x
         return x * self.gain
 
 # magnitude preserving concat
@@ -146,8 +162,20 @@ class MPAdd(Module):
     def __init__(self, t):
         super().__init__()
         self.t = t
+        self.folded = False
+
+    def fold(self):
+        """Returns the factor (1 - t) / den to fold into the layer producing x."""
+        self.folded = True
+        return (1. - self.t) / sqrt((1 - self.t) ** 2 + self.t ** 2)
+
+    def unfold(self):
+        self.folded = False
 
     def forward(self, x, res):
+        if self.folded and not self.training:
+            t = self.t
+            return torch.add(x, res, alpha = t / sqrt((1 - t) ** 2 + t ** 2))
         a, b, t = x, res, self.t
         num = a * (1. - t) + b * t
         den = sqrt((1 - t) ** 2 + t ** 2)
@@ -194,16 +222,30 @@ class Conv1d(Module):
             nn.init.dirac_(self.weight)
 
         self.eps = eps
+        self.register_buffer('folded_weight', None, persistent = False)
         self.fan_in = dim_in * kernel_size
         self.concat_ones_to_input = concat_ones_to_input
 
+    @torch.no_grad()
+    def fold(self, scale = 1.):
+        """Freeze the normalized weight for eval mode, times a constant from the surrounding MP ops."""
+        if not exists(self.folded_weight):
+            self.folded_weight = normalize_weight(self.weight, eps = self.eps) / sqrt(self.fan_in)
+        self.folded_weight = self.folded_weight * scale
+
+    def unfold(self):
+        self.folded_weight = None
+
     def forward(self, x):
-        if self.training:
-            with torch.no_grad():
-                normed_weight = normalize_weight(self.weight, eps = self.eps)
-                self.weight.copy_(normed_weight)
+        if exists(self.folded_weight) and not self.training:
+            weight = self.folded_weight
+        else:
+            if self.training:
+                with torch.no_grad():
+                    normed_weight = normalize_weight(self.weight, eps = self.eps)
+                    self.weight.copy_(normed_weight)
 
-        weight = normalize_weight(self.weight, eps = self.eps) / sqrt(self.fan_in)
+            weight = normalize_weight(self.weight, eps = self.eps) / sqrt(self.fan_in)
 
         if self.concat_ones_to_input:
             x = F.pad(x, (0, 0, 1, 0), value = 1.)
@@ -217,14 +259,28 @@ class Linear(Module):
         self.weight = nn.Parameter(weight)
         self.eps = eps
         self.fan_in = dim_in
+        self.register_buffer('folded_weight', None, persistent = False)
+
+    @torch.no_grad()
+    def fold(self, scale = 1.):
+        """Freeze the normalized weight for eval mode, times a constant from the surrounding MP ops."""
+        if not exists(self.folded_weight):
+            self.folded_weight = normalize_weight(self.weight, eps = self.eps) / sqrt(self.fan_in)
+        self.folded_weight = self.folded_weight * scale
+
+    def unfold(self):
+        self.folded_weight = None
 
     def forward(self, x):
-        if self.training:
-            with torch.no_grad():
-                normed_weight = normalize_weight(self.weight, eps = self.eps)
-                self.weight.copy_(normed_weight)
+        if exists(self.folded_weight) and not self.training:
+            weight = self.folded_weight
+        else:
+            if self.training:
+                with torch.no_grad():
+                    normed_weight = normalize_weight(self.weight, eps = self.eps)
+                    self.weight.copy_(normed_weight)
 
-        weight = normalize_weight(self.weight, eps = self.eps) / sqrt(self.fan_in)
+            weight = normalize_weight(self.weight, eps = self.eps) / sqrt(self.fan_in)
         return F.linear(x, weight)
 
 # mp fourier embeds
@@ -241,6 +297,18 @@ class MPFourierEmbedding(Module):
         freqs = x * rearrange(self.weights, 'd -> 1 d') * 2 * math.pi
         return torch.cat((freqs.sin(), freqs.cos()), dim = -1) * sqrt(2)
 
+# folding for inference: MP constants and gains move into the neighbouring weights
+
+def fold_mp_silu(block, scale = 1.):
+    """block is (MPSiLU, [Dropout], conv): move the 1 / 0.596 of the activation into the conv weight."""
+    block[0].folded = True
+    block[-1].fold(scale / 0.596)
+
+def fold_gain(block):
+    """block is (conv or linear, Gain): move the gain into the weight."""
+    block[0].fold(block[1].gain.item())
+    block[1].folded = True
+
 # building block modules
 
 class Encoder(Module):
@@ -256,6 +324,9 @@ class Encoder(Module):
         attn_dim_head = 64,
         attn_res_mp_add_t = 0.3,
         attn_flash = False,
+        attn_backend = 'full',
+        attn_chunk_size = 1024,
+        attn_window = 64,
         downsample = False
     ):
         super().__init__()
@@ -298,9 +369,18 @@ class Encoder(Module):
                 heads = max(ceil(dim_out / attn_dim_head), 2),
                 dim_head = attn_dim_head,
                 mp_add_t = attn_res_mp_add_t,
-                flash = attn_flash
+                flash = attn_flash,
+                backend = attn_backend,
+                chunk_size = attn_chunk_size,
+                window = attn_window
             )
 
+    def fold(self):
+        fold_mp_silu(self.block1)
+        fold_mp_silu(self.block2, self.res_mp_add.fold())
+        if exists(self.to_emb):
+            fold_gain(self.to_emb)
+
     def forward(
         self,
         x,
@@ -342,6 +422,9 @@ class Decoder(Module):
         attn_dim_head = 64,
         attn_res_mp_add_t = 0.3,
         attn_flash = False,
+        attn_backend = 'full',
+        attn_chunk_size = 1024,
+        attn_window = 64,
         upsample = False
     ):
         super().__init__()
@@ -379,9 +462,18 @@ class Decoder(Module):
                 heads = max(ceil(dim_out / attn_dim_head), 2),
                 dim_head = attn_dim_head,
                 mp_add_t = attn_res_mp_add_t,
-                flash = attn_flash
+                flash = attn_flash,
+                backend = attn_backend,
+                chunk_size = attn_chunk_size,
+                window = attn_window
             )
 
+    def fold(self):
+        fold_mp_silu(self.block1)
+        fold_mp_silu(self.block2, self.res_mp_add.fold())
+        if exists(self.to_emb):
+            fold_gain(self.to_emb)
+
     def forward(
         self,
         x,
@@ -409,7 +501,46 @@ class Decoder(Module):
 
 # attention
 
+def chunked_attention(q, k, v, chunk_size):
+    """Softmax attention with the queries split into chunks; memory is O(chunk_size * k_len) per head."""
+    if q.shape[-2] <= chunk_size:
+        return F.scaled_dot_product_attention(q, k, v)
+    return torch.cat([F.scaled_dot_product_attention(qc, k, v) for qc in q.split(chunk_size, dim = -2)], dim = -2)
+
+def windowed_attention(q, k, v, mk, mv, window):
+    """
+    Local attention: the sequence is cut into blocks of `window` positions and each query attends
+    to its own block, the two neighbouring blocks and the memory kv. Cost is linear in the length.
+    q, k, v: (b, h, n, d), mk, mv: (b, h, m, d)
+    """
+    b, h, n, d = q.shape
+    w = window
+    pad = (-n) % w
+    q, k, v = (F.pad(t, (0, 0, 0, pad)) for t in (q, k, v))
+    nb = (n + pad) // w
+
+    def neighbours(t):
+        t = F.pad(t, (0, 0, w, w)).reshape(b, h, nb + 2, w, d)
+        return torch.cat((t[:, :, :-2], t[:, :, 1:-1], t[:, :, 2:]), dim = -2)
+
+    k, v = neighbours(k), neighbours(v)
+    mk, mv = (t.unsqueeze(2).expand(-1, -1, nb, -1, -1) for t in (mk, mv))
+    k, v = torch.cat((mk, k), dim = -2), torch.cat((mv, v), dim = -2)
+
+    # keys of block i sit at positions (i - 1) * w + j, j < 3w; drop those outside the sequence
+    pos = torch.arange(nb, device = q.device)[:, None] * w - w + torch.arange(3 * w, device = q.device)
+    mask = torch.cat((torch.ones(nb, mk.shape[-2], dtype = torch.bool, device = q.device), (pos >= 0) & (pos < n)), dim = -1)
+
+    out = F.scaled_dot_product_attention(q.reshape(b, h, nb, w, d), k, v, attn_mask = mask[:, None])
+    return out.reshape(b, h, nb * w, d)[:, :, :n]
+
 class Attention(Module):
+    """
+    backend selects how the (pixel normed) queries attend:
+    'full'   - quadratic attention through Attend
+    'sdpa'   - F.scaled_dot_product_attention over query chunks of chunk_size, same result as 'full'
+    'window' - local attention over blocks of `window` positions plus the memory kv
+    """
     def __init__(
         self,
         dim,
@@ -417,10 +548,17 @@ class Attention(Module):
         dim_head = 64,
         num_mem_kv = 4,
         flash = False,
-        mp_add_t = 0.3
+        mp_add_t = 0.3,
+        backend = 'full',
+        chunk_size = 1024,
+        window = 64
     ):
         super().__init__()
+        assert backend in ('full', 'sdpa', 'window'), f'unknown attention backend {backend}'
         self.heads = heads
+        self.backend = backend
+        self.chunk_size = chunk_size
+        self.window = window
         hidden_dim = dim_head * heads
 
         self.pixel_norm = PixelNorm(dim = -1)
@@ -432,19 +570,35 @@ class Attention(Module):
         self.to_out = Conv1d(hidden_dim, dim, 1)
 
         self.mp_add = MPAdd(t = mp_add_t)
+        self.register_buffer('mem_kv_normed', None, persistent = False)
+
+    def fold(self):
+        self.to_out.fold(self.mp_add.fold())
+        self.mem_kv_normed = self.pixel_norm(self.mem_kv)
+
+    def unfold(self):
+        self.mem_kv_normed = None
 
     def forward(self, x):
         res, b, c, n = x, *x.shape
 
         qkv = self.to_qkv(x).chunk(3, dim = 1)
         q, k, v = map(lambda t: rearrange(t, 'b (h c) n -> b h n c', h = self.heads), qkv)
-
-        mk, mv = map(lambda t: repeat(t, 'h n d -> b h n d', b = b), self.mem_kv)
-        k, v = map(partial(torch.cat, dim = -2), ((mk, k), (mv, v)))
-
         q, k, v = map(self.pixel_norm, (q, k, v))
 
-        out = self.attend(q, k, v)
+        # pixel norm acts per position, so the memory kv can be normalized on their own,
+        # once if folded; expand is a view over the batch
+        mem_kv = self.mem_kv_normed if exists(self.mem_kv_normed) and not self.training else self.pixel_norm(self.mem_kv)
+        mk, mv = mem_kv.unsqueeze(1).expand(-1, b, -1, -1, -1)
+
+        if self.backend == 'window' and n > self.window:
+            out = windowed_attention(q, k, v, mk, mv, self.window)
+        else:
+            k, v = map(partial(torch.cat, dim = -2), ((mk, k), (mv, v)))
+            if self.backend == 'full':
+                out = self.attend(q, k, v)
+            else:
+                out = chunked_attention(q, k, v, self.chunk_size)
 
         out = rearrange(out, 'b h n d -> b (h d) n')
         out = self.to_out(out)
@@ -473,6 +627,9 @@ class KarrasUnet1D(Module):
         fourier_dim = 16,
         attn_dim_head = 64,
         attn_flash = False,
+        attn_backend = 'full',    # 'full', 'sdpa' or 'window', or a dict {resolution: backend}
+        attn_chunk_size = 1024,
+        attn_window = 64,
         mp_cat_t = 0.5,
         mp_add_emb_t = 0.5,
         attn_res_mp_add_t = 0.3,
@@ -519,6 +676,7 @@ class KarrasUnet1D(Module):
 
         # attention
         attn_res = set(cast_tuple(attn_res))
+        backend_at = lambda res: attn_backend.get(res, 'full') if isinstance(attn_backend, dict) else attn_backend
 
         # resnet block
         block_kwargs = dict(
@@ -526,7 +684,9 @@ class KarrasUnet1D(Module):
             emb_dim = emb_dim,
             attn_dim_head = attn_dim_head,
             attn_res_mp_add_t = attn_res_mp_add_t,
-            attn_flash = attn_flash
+            attn_flash = attn_flash,
+            attn_chunk_size = attn_chunk_size,
+            attn_window = attn_window
         )
 
         # unet encoder and decoders
@@ -551,20 +711,20 @@ class KarrasUnet1D(Module):
         # stages
         for _ in range(self.num_downsamples):
             dim_out = min(dim_max, curr_dim * 2)
-            upsample = Decoder(dim_out, curr_dim, has_attn = curr_res in attn_res, upsample = True, **block_kwargs)
+            upsample = Decoder(dim_out, curr_dim, has_attn = curr_res in attn_res, attn_backend = backend_at(curr_res), upsample = True, **block_kwargs)
 
             curr_res //= 2
             has_attn = curr_res in attn_res
 
-            downsample = Encoder(curr_dim, dim_out, downsample = True, has_attn = has_attn, **block_kwargs)
+            downsample = Encoder(curr_dim, dim_out, downsample = True, has_attn = has_attn, attn_backend = backend_at(curr_res), **block_kwargs)
 
             append(self.downs, downsample)
             prepend(self.ups, upsample)
-            prepend(self.ups, Decoder(dim_out * 2, dim_out, has_attn = has_attn, **block_kwargs))
+            prepend(self.ups, Decoder(dim_out * 2, dim_out, has_attn = has_attn, attn_backend = backend_at(curr_res), **block_kwargs))
 
             for _ in range(num_blocks_per_stage):
-                enc = Encoder(dim_out, dim_out, has_attn = has_attn, **block_kwargs)
-                dec = Decoder(dim_out * 2, dim_out, has_attn = has_attn, **block_kwargs)
+                enc = Encoder(dim_out, dim_out, has_attn = has_attn, attn_backend = backend_at(curr_res), **block_kwargs)
+                dec = Decoder(dim_out * 2, dim_out, has_attn = has_attn, attn_backend = backend_at(curr_res), **block_kwargs)
 
                 append(self.downs, enc)
                 prepend(self.ups, dec)
@@ -575,8 +735,8 @@ class KarrasUnet1D(Module):
         mid_has_attn = curr_res in attn_res
 
         self.mids = ModuleList([
-            Decoder(curr_dim, curr_dim, has_attn = mid_has_attn, **block_kwargs),
-            Decoder(curr_dim, curr_dim, has_attn = mid_has_attn, **block_kwargs),
+            Decoder(curr_dim, curr_dim, has_attn = mid_has_attn, attn_backend = backend_at(curr_res), **block_kwargs),
+            Decoder(curr_dim, curr_dim, has_attn = mid_has_attn, attn_backend = backend_at(curr_res), **block_kwargs),
         ])
 
         self.out_dim = channels
@@ -586,6 +746,35 @@ class KarrasUnet1D(Module):
     def downsample_factor(self):
         return 2 ** self.num_downsamples
 
+    @torch.no_grad()
+    def fold_for_inference(self):
+        """
+        Folds the forced weight normalization, gains and MP constants into frozen weights used
+        in eval mode, so inference skips normalize_weight. Training mode ignores the folded
+        weights; call again after the parameters change.
+        """
+        for m in self.modules():
+            if hasattr(m, 'unfold'):
+                m.unfold()
+        for m in self.modules():
+            if isinstance(m, (Conv1d, Linear)):
+                m.fold()
+        for m in self.modules():
+            if isinstance(m, (Encoder, Decoder, Attention)):
+                m.fold()
+        # the embedding activation only feeds the to_emb layers of the blocks
+        self.emb_activation.folded = True
+        for m in self.modules():
+            if isinstance(m, (Encoder, Decoder)) and exists(m.to_emb):
+                m.to_emb[0].fold(1 / 0.596)
+        fold_gain(self.output_block)
+        return self
+
+    def export_for_inference(self):
+        """Frozen eval-mode copy with folded weights."""
+        model = copy.deepcopy(self).eval().requires_grad_(False)
+        return model.fold_for_inference()
+
     def forward(
         self,
         x,
@@ -0,0 +1,129 @@
+import os
+import json
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+class LossAccumulator:
+    """
+    Accumulates per-step loss values on device without host syncs.
+    Every `every` steps the block of per-step values is averaged over ranks with a single
+    all_reduce and copied to host asynchronously; it is read back at the following flush, so
+    the values returned by end_step lag by one block.
+    """
+    def __init__(self, num_values, every=10, device='cpu', ddp=False):
+        self.num_values = num_values
+        self.every = every
+        self.device = device
+        self.ddp = ddp
+        self.is_cuda = torch.device(device).type == 'cuda'
+        self.buffer = torch.zeros(every, num_values, device=device)
+        self.steps = []
+        self.pending = None     # (host block, event, steps)
+
+    def add(self, i, value):
+        """Adds value (a scalar tensor) to entry i of the current step."""
+        self.buffer[len(self.steps), i] += value.detach().float()
+
+    def end_step(self, step):
+        """Closes the current step; returns the (step, values) ready so far, possibly none."""
+        self.steps.append(step)
+        if len(self.steps) < self.every:
+            return []
+        return self.flush()
+
+    def flush(self):
+        """Starts the reduction and host copy of the current block and returns the previous one."""
+        ready = self.collect()
+        if len(self.steps) == 0:
+            return ready
+        block = self.buffer[:len(self.steps)].clone()
+        if self.ddp:
+            dist.all_reduce(block, op=dist.ReduceOp.AVG)
+        host = torch.empty(block.shape, pin_memory=self.is_cuda)
+        host.copy_(block, non_blocking=True)
+        event = None
+        if self.is_cuda:
+            event = torch.cuda.Event()
+            event.record()
+        self.pending = (host, event, self.steps)
+        self.buffer.zero_()
+        self.steps = []
+        return ready
+
+    def collect(self):
+        """Waits for the pending block, if any, and returns its (step, values)."""
+        if self.pending is None:
+            return []
+        host, event, steps = self.pending
+        self.pending = None
+        if event is not None:
+            event.synchronize()
+        return list(zip(steps, host.tolist()))
+
+    def reset(self):
+        """Drops the current and the pending block, e.g. after rolling back the model."""
+        self.buffer.zero_()
+        self.steps = []
+        self.pending = None
+
+
+class MetricsLog:
+    """
+    Append-only binary log of per-step metrics in `folder/{name}.bin`: float64 rows of
+    `columns`, with the column names in `folder/{name}.json`. Rows are buffered and
+    appended in chunks of chunk_size, so each row is written once. Read with read_metrics.
+    With resume=False an existing log is truncated.
+    """
+    def __init__(self, folder, columns, name='metrics', chunk_size=1000, resume=False):
+        self.path = os.path.join(folder, f"{name}.bin")
+        self.columns = list(columns)
+        self.chunk_size = chunk_size
+        self.rows = []
+        header = os.path.join(folder, f"{name}.json")
+        if resume and os.path.exists(header):
+            with open(header) as f:
+                assert json.load(f)['columns'] == self.columns, "metrics log has different columns"
+        else:
+            with open(header, "w") as f:
+                json.dump({'columns': self.columns, 'dtype': 'float64'}, f)
+            open(self.path, "wb").close()
+
+    def append(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.rows) == 0:
+            return
+        with open(self.path, "ab") as f:
+            np.asarray(self.rows, dtype=np.float64).tofile(f)
+        self.rows = []
+
+
+def downsample(x, max_points):
+    """Averages consecutive rows of x (n, ...) into at most max_points bins."""
+    x = np.asarray(x)
+    if max_points is None or len(x) <= max_points:
+        return x
+    k = -(-len(x) // max_points)
+    n = len(x) // k * k
+    binned = x[:n].reshape(-1, k, *x.shape[1:]).mean(1)
+    if n < len(x):
+        binned = np.concatenate([binned, x[n:].mean(0, keepdims=True)])
+    return binned
+
+
+def read_metrics(folder, name='metrics', max_points=None):
+    """Dict column -> array from a MetricsLog, bin-averaged down to max_points rows if given."""
+    with open(os.path.join(folder, f"{name}.json")) as f:
+        columns = json.load(f)['columns']
+    path = os.path.join(folder, f"{name}.bin")
+    if os.path.getsize(path) == 0:
+        return {c: np.zeros(0) for c in columns}
+    data = np.memmap(path, dtype=np.float64, mode='r')
+    data = data[:len(data) // len(columns) * len(columns)].reshape(-1, len(columns))
+    data = downsample(data, max_points)
+    return {c: np.array(data[:, i]) for i, c in enumerate(columns)}
@@ -54,24 +54,58 @@ def complex2real(x: torch.Tensor) -> torch.Tensor:
     return torch.cat((x.real, x.imag), dim=-1)
 
 
-def fft2c(x: torch.Tensor, norm: str = 'ortho') -> torch.Tensor:
+_phase_cache = {}
+
+def centered_fft_phases(shape, dtype=torch.complex64, device=None):
+    """
+    Phase tables that fold ifftshift/fftshift into a plain FFT. Per axis, with s = n//2:
+        fftshift(fft(ifftshift(x)))[k] = exp(2i*pi*(k-s)*s/n) * fft(x * exp(2i*pi*s*m/n))[k]
+    and the inverse uses the conjugate tables. Returns (pre, post, pre_inv, post_inv)
+    of shape `shape`, cached per (shape, dtype, device).
     """
-    Centered 2D FFT via: ifftshift → fft2 → fftshift on axes -3, -2.
-    Works for real or complex inputs.
+    key = (tuple(shape), dtype, str(device))
+    if key not in _phase_cache:
+        pre, post = 1., 1.
+        for i, n in enumerate(shape):
+            s = n // 2
+            m = torch.arange(n, dtype=torch.float64)
+            view = [1] * len(shape)
+            view[i] = n
+            pre = pre * torch.exp(2j * math.pi * s * m / n).view(view)
+            post = post * torch.exp(2j * math.pi * (m - s) * s / n).view(view)
+        tables = [pre, post, pre.conj(), post.conj()]
+        _phase_cache[key] = tuple(t.resolve_conj().to(dtype=dtype, device=device) for t in tables)
+    return _phase_cache[key]
+
+
+def _centered_fft(x, dim, norm, inverse):
+    dim = tuple(d if d < 0 else d - x.dim() for d in dim)
+    shape = [x.shape[d] for d in dim]
+    trailing = [1] * (-max(dim) - 1)
+    double = x.dtype in (torch.float64, torch.complex128)
+    pre, post, pre_inv, post_inv = centered_fft_phases(shape, \
+                        dtype=torch.complex128 if double else torch.complex64, device=x.device)
+    if inverse:
+        X = torch.fft.ifftn(x * pre_inv.view(*shape, *trailing), dim=dim, norm=norm)
+        return X.mul_(post_inv.view(*shape, *trailing))
+    X = torch.fft.fftn(x * pre.view(*shape, *trailing), dim=dim, norm=norm)
+    return X.mul_(post.view(*shape, *trailing))
+
+
+def fft2c(x: torch.Tensor, norm: str = 'ortho', dim=(-3, -2)) -> torch.Tensor:
     """
-    # PyTorch 1.8+ has these in torch.fft
-    x0 = torch.fft.ifftshift(x, dim=(-3, -2))
-    X  = torch.fft.fft2      (x0, dim=(-3, -2), norm=norm)
-    return torch.fft.fftshift  (X, dim=(-3, -2))
+    Centered 2D FFT, equal to ifftshift → fft2 → fftshift on axes `dim` (default -3, -2).
+    The shifts are folded into precomputed phase modulations, so no shifted copies are made.
+    Use dim=(-2, -1) for channel-first tensors. Works for real or complex inputs.
+    """
+    return _centered_fft(x, dim, norm, inverse=False)
 
 
-def ifft2c(k: torch.Tensor, norm: str = 'ortho') -> torch.Tensor:
+def ifft2c(k: torch.Tensor, norm: str = 'ortho', dim=(-3, -2)) -> torch.Tensor:
     """
-    Centered 2D inverse FFT via: ifftshift → ifft2 → fftshift on axes -3, -2.
+    Centered 2D inverse FFT, equal to ifftshift → ifft2 → fftshift on axes `dim` (default -3, -2).
     """
-    k0 = torch.fft.ifftshift(k, dim=(-3, -2))
-    x  = torch.fft.ifft2      (k0, dim=(-3, -2), norm=norm)
-    return torch.fft.fftshift  (x, dim=(-3, -2))
+    return _centered_fft(k, dim, norm, inverse=True)
 
 
 def make_mask(n, w, r, generator = None, device = None, mode='same_rate') -> torch.Tensor:
@@ -188,9 +222,9 @@ def make_mask(n, w, r, generator = None, device = None, mode='same_rate') -> tor
 
 #     return fwd
 
-def make_slices(f):
+def make_slices(f, start=10, stop=41):
     with h5py.File(f, "r") as mri:
-       slices = mri['reconstruction_rss'][10:41]
+       slices = mri['reconstruction_rss'][start:stop]
        slices = slices / slices.max()  # in [0, 1]
        slices = 4 * slices - 2  # in [-2, 2]
        # slices = slices[..., None]
@@ -201,22 +235,73 @@ def make_slices(f):
 def pix_to_fourier(x, channel_first=True):
     assert len(x.shape) == 4    
     if channel_first:
-        x = x.permute(0, 2, 3, 1).contiguous()  # (N, H, W, C)
+        assert x.shape[1] == 1
+        X = fft2c(x, dim=(-2, -1))  # (N, 1, H, W) complex
+        return torch.cat((X.real, X.imag), dim=1)  # (N, 2, H, W)
     assert x.shape[-1] == 1
-    y = complex2real(fft2c(x))
-    if channel_first:
-        y = y.permute(0, 3, 1, 2).contiguous()  # (N, C, H, W)
-    return y
+    return complex2real(fft2c(x))
 
 
 def fourier_to_pix(y, channel_first=True):
     assert len(y.shape) == 4    
     if channel_first:
-        y = y.permute(0, 2, 3, 1)
-    slices = (ifft2c(real2complex(y))).real
-    if channel_first:
-        slices = slices.permute(0, 3, 1, 2).contiguous()  # (N, C, H, W)
-    return slices
+        a, b = y.chunk(2, dim=1)  # real and imag channels
+        return ifft2c(torch.complex(a, b), dim=(-2, -1)).real  # (N, C, H, W)
+    return (ifft2c(real2complex(y))).real
+
+
+class MRI_ColumnOperator:
+    """
+    Row-subsampled centered Fourier operator for the masks from `make_mask`.
+
+    The mask keeps whole k-space lines along axis -2, so the FFT along the last
+    axis cancels in ifft2c(mask * fft2c(x)): normal() is a centered 1D FFT along
+    axis -2, the mask and the inverse 1D FFT, half the FFT passes of the 2D round
+    trip. apply() gathers the retained lines after the 1D FFT and adjoint()
+    scatters them back. Nothing is read back to the host except the number of
+    kept lines, once, on the first apply/adjoint.
+
+    Args:
+        mask: BoolTensor of shape (N, 1, D, 1) as returned by `make_mask`
+        device: device on which to apply the operator
+    """
+    def __init__(self, mask, device=None):
+        device = mask.device if device is None else device
+        self.mask = mask.to(device)  # (N, 1, D, 1)
+        self._index = None
+        self._valid = None
+
+    def lines(self):
+        """(N, 1, K, 1) indices of the kept lines first, padded with dropped lines, and the valid entries."""
+        if self._index is None:
+            keep = self.mask[:, 0, :, 0]  # (N, D)
+            K = int(keep.sum(dim=1).max())
+            order = torch.argsort((~keep).to(torch.int8), dim=1, stable=True)[:, :K]
+            self._index = order[:, None, :, None]
+            self._valid = torch.gather(keep, 1, order)[:, None, :, None]
+        return self._index, self._valid
+
+    @staticmethod
+    def fft(x, inverse=False):
+        """Centered orthonormal 1D FFT along axis -2."""
+        return _centered_fft(x, dim=(-2,), norm='ortho', inverse=inverse)
+
+    def apply(self, x):
+        """(N, C, D, W) image -> (N, C, K, W) retained k-space lines (centered FFT along axis -2)."""
+        index, valid = self.lines()
+        X = self.fft(x)
+        return torch.gather(X, 2, index.expand(-1, X.shape[1], -1, X.shape[-1])) * valid
+
+    def adjoint(self, y):
+        """(N, C, K, W) k-space lines -> (N, C, D, W) zero-filled inverse FFT along axis -2."""
+        index, valid = self.lines()
+        X = y.new_zeros(*y.shape[:2], self.mask.shape[2], y.shape[-1])
+        X.scatter_(2, index.expand(-1, y.shape[1], -1, y.shape[-1]), y * valid)
+        return self.fft(X, inverse=True)
+
+    def normal(self, x):
+        """A^H A x, equal to ifft2c(mask * fft2c(x)) on channel-first images."""
+        return self.fft(self.fft(x) * self.mask, inverse=True)
 
 
 @dataclass
@@ -228,6 +313,7 @@ class MRI_Subsampling_Pixel:
     mode: str = 'same_rate'
     noise_masked: bool = False
     interpolate_masked: bool = False
+    sparse: bool = False
 
     def __post_init__(self):
         self.downsampler = nn.PixelUnshuffle(downscale_factor=self.downscale_factor)
@@ -239,21 +325,25 @@ class MRI_Subsampling_Pixel:
             img = img.unsqueeze(0)
         img = self.upsampler(img)  # shape: [N, 1, D, D]
         assert img.shape[1] == 1
-        img = pix_to_fourier(img, channel_first=True)  # (N, 2, D, D)
         mask = make_mask(n=img.shape[0], w=img.shape[-1],  \
-                        r=self.r, generator=generator, mode=self.mode).to(img.device) # (N, 1, D, 1)
-        y = img * mask
-        if self.interpolate_masked:
-            y = inpaint_zeros_with_avg(y, kernel_size=3)
-
-        z = torch.randn(y.shape, generator=generator).to(img.device) 
-        y = y + z*self.epsilon
-        if self.noise_masked:
-            y *= mask
-            z = torch.randn_like(y, device=img.device)
-            y += (z * ~(mask))
-
-        y = fourier_to_pix(y, channel_first=True)
+                        r=self.r, generator=generator, mode=self.mode) # (N, 1, D, 1)
+        mask = mask.to(img.device)
+        if self.sparse and not self.interpolate_masked:
+            y = self.sparse_observe(img, mask, generator=generator)
+        else:
+            img = pix_to_fourier(img, channel_first=True)  # (N, 2, D, D)
+            y = img * mask
+            if self.interpolate_masked:
+                y = inpaint_zeros_with_avg(y, kernel_size=3)
+
+            z = torch.randn(y.shape, generator=generator).to(img.device) 
+            y = y + z*self.epsilon
+            if self.noise_masked:
+                y *= mask
+                z = torch.randn_like(y, device=img.device)
+                y += (z * ~(mask))
+
+            y = fourier_to_pix(y, channel_first=True)
         y = self.downsampler(y)  
 
         if return_latents:
@@ -269,6 +359,25 @@ class MRI_Subsampling_Pixel:
         else:
             return y
 
+    def sparse_observe(self, img, mask, generator=None):
+        """
+        Same distribution as the dense k-space path, with 1D instead of 2D FFTs.
+        White complex noise on the full grid maps to white noise in pixel space, so
+        eps * Re(ifft2c(z)) is drawn directly as eps * randn in pixel space.
+        The noise is drawn with different shapes than in the dense path, so for a
+        fixed generator the two paths give different noise realizations; this is
+        why the path is opt-in (sparse=True).
+        """
+        op = MRI_ColumnOperator(mask, device=img.device)
+        if self.noise_masked:
+            # noise eps on kept lines and 1 elsewhere: Re(w - (1 - eps) * P w) for white complex w
+            z = torch.randn((2, *img.shape), generator=generator).to(img.device)
+            w = torch.complex(z[0], z[1])
+            noise = (w - (1. - self.epsilon) * op.normal(w)).real
+        else:
+            noise = self.epsilon * torch.randn(img.shape, generator=generator).to(img.device)
+        return op.normal(img).real.to(img.dtype) + noise
+
 
 @dataclass
 class MRI_Subsampling_Fourier:
@@ -312,31 +421,146 @@ class MRI_Subsampling_Fourier:
 
 
 
+def _scan_volume(f, start=10, stop=41):
+    """Number of slices `make_slices` returns for file f and their (H, W), from the HDF5 metadata."""
+    with h5py.File(f, "r") as mri:
+        shape = mri['reconstruction_rss'].shape
+    return max(0, min(stop, shape[0]) - start), list(shape[1:])
+
+
+def _write_volume(task):
+    """Worker: read one volume once and copy its slice ranges into preallocated temporary shards."""
+    path, targets, kspace, start, stop = task
+    torch.set_num_threads(1)
+    # normalization uses the max over all slices of the volume, so they are read together
+    slices = make_slices(path, start, stop)  # (n, 1, H, W)
+    for tmp, offset, i0, i1 in targets:
+        x = torch.from_numpy(slices[i0:i1]).float()
+        if kspace:
+            x = pix_to_fourier(x, channel_first=True)  # (n, 2, H, W)
+        out = np.load(tmp, mmap_mode="r+")
+        out[offset : offset + len(x)] = x.numpy()
+        out.flush()
+        del out
+    return path
+
+
+def preprocess_to_shards(folder_to_read, folder_to_save, shard_size=1024, kspace=False, \
+                         num_workers=None, start=10, stop=41):
+    """
+    Convert fastMRI HDF5 volumes into fixed-size .npy shards of normalized slices,
+    readable with mmap_mode='r' (e.g. by CombinedLazyNumpyDataset).
+
+    Shards are described in `index.json`. Files already listed in an existing index keep
+    their position, new files are appended, and shards whose file exists with unchanged
+    contents are skipped, so re-running on a growing folder only writes the new shards.
+    Each volume is read once by one worker, which copies its slices into the temporary
+    `.tmp` shards; when all are written the old index is removed, the shards are moved into
+    place and the new index is written, so an interrupted run leaves either the previous
+    shards with their index or no index (and the next run rewrites everything).
+    With kspace=True, slices are stored as real/imag channels of their centered FFT.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    import json
+    os.makedirs(folder_to_save, exist_ok=True)
+    index_file = os.path.join(folder_to_save, "index.json")
+    old_index = None
+    if os.path.exists(index_file):
+        with open(index_file) as fp:
+            old_index = json.load(fp)
+        settings = dict(kspace=kspace, shard_size=shard_size, start=start, stop=stop)
+        if any(old_index[k] != v for k, v in settings.items()):
+            print("Settings differ from existing index, all shards will be rewritten")
+            old_index = None
+
+    files = sorted(f for f in os.listdir(folder_to_read) if f.endswith((".h5", ".hdf5")))
+    present = set(files)
+    known = [f for f in old_index["files"] if f in present] if old_index is not None else []
+    files = known + sorted(present - set(known))
+    paths = [os.path.join(folder_to_read, f) for f in files]
+
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        scans = list(pool.map(_scan_volume, paths, [start]*len(paths), [stop]*len(paths), chunksize=16))
+    counts = [n for n, _ in scans]
+    slice_shape = dict(zip(files, (hw for _, hw in scans)))
+    print(f"Found {sum(counts)} slices in {len(files)} files")
+
+    # assign global slice ranges to fixed-size shards
+    shards, ranges, filled = [], [], 0
+    for f, n in zip(files, counts):
+        i0 = 0
+        while i0 < n:
+            i1 = min(n, i0 + shard_size - filled)
+            ranges.append([f, i0, i1])
+            filled += i1 - i0
+            i0 = i1
+            if filled == shard_size:
+                shards.append(ranges)
+                ranges, filled = [], 0
+    if ranges:
+        shards.append(ranges)
+
+    done = {}
+    if old_index is not None:
+        done = {s["name"]: s for s in old_index["shards"]}
+    entries, written, targets = [], [], {}
+    channels = 2 if kspace else 1
+    for j, ranges in enumerate(shards):
+        name = f"train_{j}.npy"
+        path = os.path.join(folder_to_save, name)
+        entry = done.get(name)
+        if entry is not None and entry["ranges"] == ranges and os.path.exists(path):
+            entries.append(entry)
+            continue
+        hw = slice_shape[ranges[0][0]]
+        assert all(slice_shape[f] == hw for f, _, _ in ranges), f"slices of different shapes in {name}"
+        shape = [sum(i1 - i0 for _, i0, i1 in ranges), channels, *hw]
+        tmp = path + ".tmp"
+        out = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float32, shape=tuple(shape))
+        del out
+        offset = 0
+        for f, i0, i1 in ranges:
+            targets.setdefault(f, []).append((tmp, offset, i0, i1))
+            offset += i1 - i0
+        entries.append({"name": name, "ranges": ranges, "shape": shape})
+        written.append((tmp, path))
+    print(f"Writing {len(written)} of {len(shards)} shards from {len(targets)} files")
+
+    tasks = [(os.path.join(folder_to_read, f), t, kspace, start, stop) for f, t in targets.items()]
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        list(pool.map(_write_volume, tasks))
+
+    index = dict(files=files, counts=counts, kspace=kspace, shard_size=shard_size, \
+                 start=start, stop=stop, dtype="float32", shards=entries)
+    with open(index_file + ".tmp", "w") as fp:
+        json.dump(index, fp, indent=2)
+    if len(written) > 0 and os.path.exists(index_file):
+        os.remove(index_file)
+    for tmp, path in written:
+        os.replace(tmp, path)
+    os.replace(index_file + ".tmp", index_file)
+    names = {entry["name"] for entry in entries}
+    for name in os.listdir(folder_to_save):
+        if name.startswith("train_") and name.endswith(".npy") and name not in names:
+            os.remove(os.path.join(folder_to_save, name))  # stale shard from a larger previous run
+    return index
+
+
 if __name__=="__main__":
 
-    folder_to_read = "/mnt/ceph/users/cmodi/ML_data/fastMRI/knee-singlecoil-train-slices/"
-    folder_to_save = "/mnt/ceph/users/cmodi/ML_data/fastMRI/knee-singlecoil-train/"
-
-    files = os.listdir(folder_to_read)
-    print(len(files))
-    j = 0 
-    tosave = []
-    for i, f in enumerate(files):
-        print(f)
-        file = os.path.join(folder_to_read, f)
-        slices = np.load(file)
-        y = complex2real(fft2c(torch.from_numpy(slices)))
-        print(y.shape)
-        tosave.append(y.numpy())
-        if (i+1) % 40 == 0:
-            print("Save")
-            tosave = np.concatenate(tosave, axis=0)
-            print(tosave.shape)
-            print("train", j)
-            np.save(os.path.join(folder_to_save, f"train_{j}.npy"), tosave)
-            j += 1
-            tosave = []
-    tosave = np.concatenate(tosave, axis=0)
-    print(tosave.shape)
-    print("train", j)
-    np.save(os.path.join(folder_to_save, f"train_{j}.npy"), tosave)
+    import argparse
+    parser = argparse.ArgumentParser(description="Convert fastMRI HDF5 files into sharded .npy training stores")
+    parser.add_argument("--folder_to_read", type=str, required=True, help="folder with fastMRI .h5 files")
+    parser.add_argument("--folder_to_save", type=str, required=True, help="folder to write shards and index.json")
+    parser.add_argument("--shard_size", type=int, default=1024, help="number of slices per shard")
+    parser.add_argument("--kspace", action='store_true', help="store centered k-space instead of pixels")
+    parser.add_argument("--num_workers", type=int, default=None, help="number of processes, all cores if not set")
+    parser.add_argument("--start", type=int, default=10, help="first slice kept from each volume")
+    parser.add_argument("--stop", type=int, default=41, help="slice after the last one kept from each volume")
+    args = parser.parse_args()
+    print(args)
+
+    index = preprocess_to_shards(args.folder_to_read, args.folder_to_save, shard_size=args.shard_size, \
+                                 kspace=args.kspace, num_workers=args.num_workers, \
+                                 start=args.start, stop=args.stop)
+    print(f"{len(index['shards'])} shards in {args.folder_to_save}")
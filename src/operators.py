@@ -0,0 +1,383 @@
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+# Explicit linear observation models y = A(latents) x + noise for the corruptions in
+# forward_maps.py. The forward maps attach one of these as `fwd.operator`, so samplers can
+# use closed-form adjoints instead of differentiating through the sampling closure.
+# x is a batch of shape (N, ...) and latents are the per-sample latents returned by the
+# matching forward map with return_latents=True.
+
+
+class LinearCorruptionOperator:
+    """Base class: subclasses implement apply and adjoint; the noise model is N(0, epsilon^2) by default."""
+    def __init__(self, epsilon):
+        self.epsilon = epsilon
+
+    def apply(self, x, latents=None):
+        raise NotImplementedError()
+
+    def adjoint(self, y, latents=None):
+        raise NotImplementedError()
+
+    def normal(self, x, latents=None):
+        return self.adjoint(self.apply(x, latents), latents)
+
+    def require_latents(self, latents):
+        """Returns latents, or raises if the latents of the forward map were not passed."""
+        if latents is None:
+            raise ValueError(f"{type(self).__name__} needs the latents returned by its forward map with return_latents=True")
+        return latents
+
+    def noise_std(self, y, latents=None):
+        """Per-entry noise standard deviation, a scalar or a tensor broadcastable to y."""
+        return self.epsilon
+
+    def noise(self, y, latents=None, generator=None):
+        z = torch.randn(y.shape, generator=generator).to(y.device)
+        return z * self.noise_std(y, latents)
+
+    def __call__(self, x, latents=None, generator=None):
+        y = self.apply(x, latents)
+        return y + self.noise(y, latents, generator=generator)
+
+
+def adjoint_error(op, x, latents=None):
+    """Relative mismatch |<A x, y> - <x, A^T y>| / (|A x| |y|) for a random y; ~1e-7 in float32 for a correct adjoint."""
+    Ax = op.apply(x, latents)
+    y = torch.randn_like(Ax)
+    Aty = op.adjoint(y, latents)
+    assert Aty.shape == x.shape, f"adjoint returns shape {tuple(Aty.shape)} for inputs of shape {tuple(x.shape)}"
+    lhs, rhs = (Ax * y).sum().item(), (x * Aty).sum().item()
+    return abs(lhs - rhs) / (Ax.norm() * y.norm()).item()
+
+
+class IdentityOperator(LinearCorruptionOperator):
+    """Additive Gaussian noise."""
+    def apply(self, x, latents=None):
+        return x
+
+    def adjoint(self, y, latents=None):
+        return y
+
+
+class MaskOperator(LinearCorruptionOperator):
+    """Pixel masks (random_mask, noise_and_mask, block_mask); latents are masks of shape (N, 1, H, W)."""
+    def __init__(self, epsilon, noise_mask=0.):
+        super().__init__(epsilon)
+        self.noise_mask = noise_mask
+
+    def apply(self, x, latents=None):
+        return x * self.require_latents(latents).to(x.dtype)
+
+    def adjoint(self, y, latents=None):
+        return y * self.require_latents(latents).to(y.dtype)
+
+    def normal(self, x, latents=None):
+        return self.apply(x, latents)
+
+    def noise_std(self, y, latents=None):
+        if self.noise_mask > self.epsilon:
+            mask = self.require_latents(latents).to(y.dtype)
+            return self.epsilon * mask + self.noise_mask * (1. - mask)
+        return self.epsilon
+
+
+def _reflect_pad_adjoint(z, pad):
+    """Adjoint of F.pad(x, (pad, pad, pad, pad), mode='reflect') over the last two dims."""
+    for dim in (-1, -2):
+        n = z.shape[dim] - 2 * pad
+        left, x, right = z.split([pad, n, pad], dim=dim)
+        x = x.clone()
+        x.narrow(dim, 1, pad).add_(left.flip(dim))
+        x.narrow(dim, n - 1 - pad, pad).add_(right.flip(dim))
+        z = x
+    return z
+
+
+_kernel_cache = {}
+_kernel_fft_cache = {}
+
+
+def gaussian_kernel1d(sigma, dtype=torch.float32, device='cpu'):
+    """Normalized Gaussian taps of size 2 * ceil(3 sigma) + 1, cached per (sigma, dtype, device)."""
+    key = (float(sigma), dtype, str(device))
+    if key not in _kernel_cache:
+        pad = int(math.ceil(3*sigma))
+        x = torch.linspace(-pad, pad, 2*pad + 1, dtype=torch.float64)
+        k = torch.exp(-0.5 * (x / sigma) ** 2)
+        _kernel_cache[key] = (k / k.sum()).to(device=device, dtype=dtype)
+    return _kernel_cache[key]
+
+
+def gaussian_kernel_fft(sigma, shape, dtype=torch.float32, device='cpu'):
+    """
+    rfft2 of the separable Gaussian centered at the origin of a periodic (H, W) grid, cached per
+    (sigma, shape, dtype, device). The kernel is symmetric, so its spectrum is real.
+    """
+    key = (float(sigma), tuple(shape), dtype, str(device))
+    if key not in _kernel_fft_cache:
+        k = gaussian_kernel1d(sigma, torch.float64)
+        pad = k.shape[0] // 2
+        spectra = []
+        for n, fft in zip(shape, (torch.fft.fft, torch.fft.rfft)):
+            kc = torch.zeros(n, dtype=torch.float64)
+            kc[:pad + 1] = k[pad:]
+            kc[n - pad:] = k[:pad]
+            spectra.append(fft(kc).real)
+        K = spectra[0][:, None] * spectra[1][None, :]
+        _kernel_fft_cache[key] = K.to(device=device, dtype=dtype)
+    return _kernel_fft_cache[key]
+
+
+class GaussianBlurOperator(LinearCorruptionOperator):
+    """
+    Gaussian blur with the kernel and reflect padding of transforms.GaussianBlur, applied as two
+    cached 1D convolutions, or as one FFT product when sigma >= fft_sigma (or use_fft=True).
+    """
+    def __init__(self, sigma, epsilon, use_fft=None, fft_sigma=8.):
+        super().__init__(epsilon)
+        self.sigma = float(sigma)
+        self.pad = int(math.ceil(3*sigma))
+        self.kernel_size = 2*self.pad + 1
+        self.use_fft = self.sigma >= fft_sigma if use_fft is None else use_fft
+
+    def _blur_valid(self, x):
+        """Unpadded blur of a (N, C, H + 2p, W + 2p) batch to (N, C, H, W)."""
+        p = self.pad
+        if self.use_fft:
+            # circular convolution on the padded grid only wraps into the cropped border
+            H, W = x.shape[-2:]
+            K = gaussian_kernel_fft(self.sigma, (H, W), x.dtype, x.device)
+            out = torch.fft.irfft2(torch.fft.rfft2(x) * K, s=(H, W))
+            return out[..., p:H - p, p:W - p]
+        C = x.shape[1]
+        k = gaussian_kernel1d(self.sigma, x.dtype, x.device)
+        x = F.conv2d(x, k.view(1, 1, -1, 1).expand(C, -1, -1, -1), groups=C)
+        return F.conv2d(x, k.view(1, 1, 1, -1).expand(C, -1, -1, -1), groups=C)
+
+    def apply(self, x, latents=None):
+        was_3d = (x.dim() == 3)
+        x = x.unsqueeze(0) if was_3d else x
+        out = self._blur_valid(F.pad(x, (self.pad,) * 4, mode='reflect'))
+        return out.squeeze(0) if was_3d else out
+
+    def adjoint(self, y, latents=None):
+        # the kernel is symmetric: the adjoint of the valid blur is the full blur, i.e. the valid blur
+        # of y zero-padded by 2p, of size (H + 2p, W + 2p), which the reflect-pad adjoint folds back
+        was_3d = (y.dim() == 3)
+        y = y.unsqueeze(0) if was_3d else y
+        out = _reflect_pad_adjoint(self._blur_valid(F.pad(y, (2 * self.pad,) * 4)), self.pad)
+        return out.squeeze(0) if was_3d else out
+
+
+def motion_kernels(kernel_size, cos, sin):
+    """Horizontal line kernels rotated by grid_sample to the angles (cos, sin), shape (N, 1, k, k)."""
+    N = cos.shape[0]
+    k = torch.zeros(kernel_size, kernel_size, device=cos.device)
+    k[kernel_size // 2, :] = 1.0
+    zeros = torch.zeros_like(cos)
+    thetas = torch.stack([torch.stack([cos, -sin, zeros], dim=-1),
+                          torch.stack([sin,  cos, zeros], dim=-1)], dim=1)  # (N, 2, 3)
+    k = k.expand(N, 1, kernel_size, kernel_size)
+    grid = F.affine_grid(thetas.to(k.dtype), k.size(), align_corners=False)
+    k = F.grid_sample(k, grid, align_corners=False)
+    return k / k.flatten(1).sum(dim=1).view(N, 1, 1, 1)
+
+
+_motion_table_cache = {}
+
+
+def motion_kernel_table(kernel_size, angle_bins, device='cpu'):
+    """Kernels for the angles 2 pi j / angle_bins, j < angle_bins, from one batched grid_sample; cached per device."""
+    key = (kernel_size, angle_bins, str(device))
+    if key not in _motion_table_cache:
+        rads = torch.arange(angle_bins, device=device) * (2 * torch.pi / angle_bins)
+        _motion_table_cache[key] = motion_kernels(kernel_size, torch.cos(rads), torch.sin(rads))
+    return _motion_table_cache[key]
+
+
+class MotionBlurOperator(LinearCorruptionOperator):
+    """
+    Zero-padded motion blur. `latent_type` selects how kernels are defined:
+        'fixed':  one angle in degrees (motion_blur), latents unused
+        'angle':  latents are angles / pi of shape (N, 1) (random_motion)
+        'direction_map': latents are (N, 1, H, W) maps x cos + y sin on [-1, 1]^2 (random_motion2)
+    Per-sample kernels are rotated exactly with angle_bins=None (the default), or looked up in a table
+    of `angle_bins` quantized angles, off by at most pi / angle_bins from the sampled angle, and applied
+    with one grouped conv, or one batched FFT product with use_fft.
+    """
+    def __init__(self, kernel_size, epsilon, latent_type='fixed', angle=None, angle_bins=None, use_fft=False):
+        super().__init__(epsilon)
+        self.kernel_size = int(kernel_size)
+        self.pad = self.kernel_size // 2
+        self.latent_type = latent_type
+        self.angle_bins = angle_bins
+        self.use_fft = use_fft
+        if latent_type == 'fixed':
+            rad = torch.deg2rad(torch.tensor([float(angle)]))
+            self.kernel = motion_kernels(self.kernel_size, torch.cos(rad), torch.sin(rad))
+
+    def kernels_from_angles(self, rads):
+        """(N,) angles in radians -> (N, 1, k, k) normalized kernels."""
+        if self.angle_bins is None:
+            return motion_kernels(self.kernel_size, torch.cos(rads), torch.sin(rads))
+        table = motion_kernel_table(self.kernel_size, self.angle_bins, rads.device)
+        idx = torch.round(rads * (self.angle_bins / (2 * torch.pi))).long() % self.angle_bins
+        return table[idx]
+
+    def kernels(self, latents, x):
+        if self.latent_type == 'fixed':
+            return self.kernel.to(x.device, x.dtype).expand(x.shape[0], -1, -1, -1)
+        latents = self.require_latents(latents).to(x.device, torch.float32)
+        if self.latent_type == 'angle':
+            rads = latents.reshape(-1) * torch.pi
+        else:
+            cos = (latents[:, 0, 0, -1] - latents[:, 0, 0, 0]) / 2
+            sin = (latents[:, 0, -1, 0] - latents[:, 0, 0, 0]) / 2
+            rads = torch.atan2(sin, cos)
+        return self.kernels_from_angles(rads).to(x.dtype)
+
+    def blur(self, x, kernels, transpose=False):
+        """Per-sample blur of x (N, C, H, W) with kernels (N, 1, k, k); transpose=True applies the adjoint."""
+        N, C, H, W = x.shape
+        p = self.pad
+        if self.use_fft:
+            # circular correlation on the zero-padded grid, cropped to the linear result
+            L = (H + 2*p, W + 2*p)
+            Kf = torch.fft.rfft2(torch.roll(F.pad(kernels, (0, L[1] - 2*p - 1, 0, L[0] - 2*p - 1)), (-p, -p), (-2, -1)))
+            Kf = Kf if transpose else Kf.conj()
+            out = torch.fft.irfft2(torch.fft.rfft2(F.pad(x, (p,) * 4)) * Kf, s=L)
+            return out[..., p:p + H, p:p + W]
+        weight = kernels.expand(N, C, -1, -1).reshape(N * C, 1, *kernels.shape[-2:])  # (N*C, 1, k, k)
+        conv = F.conv_transpose2d if transpose else F.conv2d
+        out = conv(x.reshape(1, N * C, H, W), weight, padding=p, groups=N * C)
+        return out.view(N, C, H, W)
+
+    def apply(self, x, latents=None):
+        return self.blur(x, self.kernels(latents, x))
+
+    def adjoint(self, y, latents=None):
+        return self.blur(y, self.kernels(latents, y), transpose=True)
+
+
+class MRIOperator(LinearCorruptionOperator):
+    """
+    Real part of the masked centered Fourier projection on pixel-shuffled images, as in the sparse
+    path of mri_data.MRI_Subsampling_Pixel. The map is self-adjoint on real images.
+    Latents are (N, D) line masks (mri_pix1d) or the pixel-unshuffled (N, s^2, D/s, D/s) masks (mri_pix3d).
+    """
+    def __init__(self, epsilon, downscale_factor=4, expand_latents=False, noise_masked=False):
+        super().__init__(epsilon)
+        self.expand_latents = expand_latents
+        self.noise_masked = noise_masked
+        self.downsampler = nn.PixelUnshuffle(downscale_factor=downscale_factor)
+        self.upsampler = nn.PixelShuffle(upscale_factor=downscale_factor)
+        self._latents, self._op = None, None
+
+    def column_operator(self, latents, device):
+        """MRI_ColumnOperator for the latents, reused while the same latents tensor is passed."""
+        from mri_data import MRI_ColumnOperator
+        self.require_latents(latents)
+        if latents is not self._latents:
+            if self.expand_latents:
+                mask = self.upsampler(latents.float())[:, :, :, :1] > 0.5  # (N, 1, D, 1)
+            else:
+                mask = (latents > 0.5)[:, None, :, None]
+            self._latents, self._op = latents, MRI_ColumnOperator(mask, device=device)
+        return self._op
+
+    def apply(self, x, latents=None):
+        op = self.column_operator(latents, x.device)
+        return self.downsampler(op.normal(self.upsampler(x)).real.to(x.dtype))
+
+    def adjoint(self, y, latents=None):
+        return self.apply(y, latents)
+
+    def noise(self, y, latents=None, generator=None):
+        if not self.noise_masked:
+            return super().noise(y, latents, generator=generator)
+        # noise eps on kept lines and 1 elsewhere, as in MRI_Subsampling_Pixel.sparse_observe
+        op = self.column_operator(latents, y.device)
+        z = torch.randn((2, *y.shape), generator=generator).to(y.device)
+        w = self.upsampler(torch.complex(z[0], z[1]))
+        return self.downsampler((w - (1. - self.epsilon) * op.normal(w)).real)
+
+
+class ProjectionOperator(LinearCorruptionOperator):
+    """
+    Random projections with seed latents (projections.SeededProjection).
+        observe='vec':   y = A^T A x + eps z
+        observe='coeff': y = [A x + eps z, z'], padded to dim_in with unit noise
+    """
+    def __init__(self, projection, epsilon, observe='vec'):
+        super().__init__(epsilon)
+        self.projection = projection
+        self.observe = observe
+
+    def matrix(self, latents):
+        return self.projection.matrix(latents)
+
+    def apply(self, x, latents=None):
+        self.require_latents(latents)
+        if self.observe == 'vec':
+            return self.projection.normal(latents, x)
+        y = self.projection.apply(latents, x)
+        return F.pad(y, (0, self.projection.dim_in - self.projection.dim_out))
+
+    def adjoint(self, y, latents=None):
+        self.require_latents(latents)
+        if self.observe == 'vec':
+            return self.projection.normal(latents, y)
+        return self.projection.adjoint(latents, y[..., :self.projection.dim_out])
+
+    def noise_std(self, y, latents=None):
+        if self.observe == 'vec':
+            return self.epsilon
+        std = torch.ones(y.shape[-1], device=y.device, dtype=y.dtype)
+        std[:self.projection.dim_out] = self.epsilon
+        return std
+
+
+class DenseProjectionOperator(LinearCorruptionOperator):
+    """Same observation models as ProjectionOperator, with latents the matrices A of shape (N, dim_out, dim_in)."""
+    def __init__(self, epsilon, observe='vec', noise_in_range=False):
+        super().__init__(epsilon)
+        self.observe = observe
+        self.noise_in_range = noise_in_range
+
+    def matrix(self, latents):
+        return latents
+
+    def _Ax(self, A, x):
+        return torch.einsum('...ij,...j->...i', A.to(x.dtype), x)
+
+    def _Aty(self, A, y):
+        return torch.einsum('...ij,...i->...j', A.to(y.dtype), y)
+
+    def apply(self, x, latents=None):
+        y = self._Ax(self.require_latents(latents), x)
+        if self.observe == 'vec':
+            return self._Aty(latents, y)
+        return F.pad(y, (0, latents.shape[-1] - latents.shape[-2]))
+
+    def adjoint(self, y, latents=None):
+        self.require_latents(latents)
+        if self.observe == 'vec':
+            return self._Aty(latents, self._Ax(latents, y))
+        return self._Aty(latents, y[..., :latents.shape[-2]])
+
+    def noise_std(self, y, latents=None):
+        if self.observe == 'vec':
+            return self.epsilon
+        std = torch.ones(y.shape[-1], device=y.device, dtype=y.dtype)
+        std[:latents.shape[-2]] = self.epsilon
+        return std
+
+    def noise(self, y, latents=None, generator=None):
+        if not self.noise_in_range:
+            return super().noise(y, latents, generator=generator)
+        # A^T (eps z), as in random_projection_vec_dataset
+        z = torch.randn(latents.shape[:-1], generator=generator).to(y.device, y.dtype)
+        return self._Aty(latents, z * self.epsilon)
@@ -0,0 +1,78 @@
+import os
+import contextlib
+import torch
+
+_active = 0     # number of running profilers; record() is free while this is zero
+
+
+def profiling_enabled(flag=None):
+    """The flag if given, else the SI_PROFILE environment variable (any value but '', '0', 'false')."""
+    if flag is not None:
+        return bool(flag)
+    return os.getenv('SI_PROFILE', '').lower() not in ('', '0', 'false')
+
+
+def record(name):
+    """A torch.profiler.record_function range named `name` while a profiler runs, else a no-op."""
+    if _active == 0:
+        return contextlib.nullcontext()
+    return torch.profiler.record_function(name)
+
+
+class ScheduledProfiler:
+    """
+    torch.profiler over a window of steps: after `wait` steps it warms up for `warmup` steps and
+    records `active` steps, `repeat` times. Call step() once per step. For each recorded window it
+    writes a Chrome trace `{name}_trace_{step}.json` (open in chrome://tracing or Perfetto) and the
+    top_k operators by self time `{name}_top{top_k}_{step}.txt` to `folder`.
+    CUDA activity is recorded when available, so it also runs on CPU-only machines.
+    With enabled=None it follows profiling_enabled(); disabled, it does nothing.
+    """
+    def __init__(self, folder, name='train', wait=5, warmup=2, active=5, repeat=1, top_k=30,
+                 record_shapes=False, with_stack=False, enabled=None):
+        self.enabled = profiling_enabled(enabled)
+        self.folder = folder
+        self.name = name
+        self.top_k = top_k
+        self.prof = None
+        if not self.enabled:
+            return
+        os.makedirs(folder, exist_ok=True)
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.sort_by = 'self_cuda_time_total' if torch.cuda.is_available() else 'self_cpu_time_total'
+        self.prof = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=repeat),
+            on_trace_ready=self.export,
+            record_shapes=record_shapes,
+            with_stack=with_stack,
+        )
+
+    def export(self, prof):
+        step = prof.step_num
+        trace = os.path.join(self.folder, f"{self.name}_trace_{step}.json")
+        prof.export_chrome_trace(trace)
+        table = prof.key_averages().table(sort_by=self.sort_by, row_limit=self.top_k)
+        with open(os.path.join(self.folder, f"{self.name}_top{self.top_k}_{step}.txt"), "w") as f:
+            f.write(table)
+        print(f"Profiler trace for {self.name} at step {step} written to {trace}")
+
+    def __enter__(self):
+        global _active
+        if self.prof is not None:
+            self.prof.__enter__()
+            _active += 1
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        if self.prof is not None:
+            _active -= 1
+            self.prof.__exit__(*exc)
+        return False
+
+    def step(self):
+        if self.prof is not None:
+            self.prof.step()
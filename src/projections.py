@@ -0,0 +1,153 @@
+import math
+import torch
+
+# Implicit random projection operators A of shape (dim_out, dim_in), one per sample.
+# Each A is regenerated from a per-sample integer seed with a counter-based hash, so
+# corruptions can pass (N, 1) seeds as latents instead of (N, dim_out, dim_in) matrices.
+
+MAX_SEED = 2**24  # seeds stay exact when latents are mixed/cast as float32
+
+_MASK32 = 0xFFFFFFFF
+
+
+def _hash32(x):
+    """Integer hash on int64 tensors holding 32-bit values; multipliers < 2**31 avoid overflow."""
+    x = x & _MASK32
+    x = x ^ (x >> 16)
+    x = (x * 0x7feb352d) & _MASK32
+    x = x ^ (x >> 15)
+    x = (x * 0x2c1b3c6d) & _MASK32
+    return x ^ (x >> 16)
+
+
+def seeded_uniform(seeds, n, stream=0):
+    """Uniforms in (0, 1) of shape (N, n), a deterministic function of (seed, stream, index)."""
+    seeds = seeds.reshape(-1)
+    seeds = (seeds.round() if seeds.is_floating_point() else seeds).long()
+    base = _hash32(_hash32(seeds) ^ (stream * 0x632be5ab))
+    idx = torch.arange(n, device=seeds.device)
+    h = _hash32(base.unsqueeze(1) ^ _hash32(idx + 0x9e3779b9).unsqueeze(0))
+    return (h.double() + 0.5) / 2**32
+
+
+def seeded_normal(seeds, n, stream=0):
+    """Standard normals of shape (N, n) from two seeded uniform streams (Box-Muller)."""
+    u1 = seeded_uniform(seeds, n, stream=2*stream)
+    u2 = seeded_uniform(seeds, n, stream=2*stream + 1)
+    return torch.sqrt(-2 * torch.log(u1)) * torch.cos(2 * math.pi * u2)
+
+
+def fwht(x):
+    """Orthonormal fast Walsh-Hadamard transform over the last dim (a power of 2)."""
+    n = x.shape[-1]
+    lead = x.shape[:-1]
+    h = 1
+    while h < n:
+        x = x.reshape(*lead, n // (2*h), 2, h)
+        a, b = x[..., 0, :], x[..., 1, :]
+        x = torch.stack((a + b, a - b), dim=-2)
+        h *= 2
+    return x.reshape(*lead, n) / math.sqrt(n)
+
+
+class SeededProjection:
+    """
+    Base class: per-sample operators A (dim_out x dim_in) defined by seeds of shape (N,) or (N, 1).
+    x has shape (N, ..., dim_in) and y has shape (N, ..., dim_out).
+    """
+    def __init__(self, dim_in, dim_out):
+        self.dim_in = int(dim_in)
+        self.dim_out = int(dim_out)
+
+    def sample_seeds(self, n, generator=None, device=None):
+        seeds = torch.randint(0, MAX_SEED, (n,), generator=generator)
+        return seeds.to(device)
+
+    def matrix(self, seeds):
+        raise NotImplementedError()
+
+    def apply(self, seeds, x):
+        A = self.matrix(seeds).to(x.dtype)
+        A = A.view(A.shape[0], *([1] * (x.dim() - 2)), *A.shape[1:])
+        return (A @ x.unsqueeze(-1)).squeeze(-1)
+
+    def adjoint(self, seeds, y):
+        A = self.matrix(seeds).to(y.dtype)
+        A = A.view(A.shape[0], *([1] * (y.dim() - 2)), *A.shape[1:])
+        return (A.transpose(-1, -2) @ y.unsqueeze(-1)).squeeze(-1)
+
+    def normal(self, seeds, x):
+        return self.adjoint(seeds, self.apply(seeds, x))
+
+
+class GaussianProjection(SeededProjection):
+    """Gaussian rows normalized to unit norm, the same law as the dense random_projection maps."""
+    def matrix(self, seeds):
+        A = seeded_normal(seeds, self.dim_out * self.dim_in).float()
+        A = A.view(-1, self.dim_out, self.dim_in)
+        return A / torch.linalg.norm(A, dim=-1, keepdim=True)
+
+
+class AchlioptasProjection(SeededProjection):
+    """Sparse Achlioptas entries sqrt(3/dim_in) * {+1, 0, -1} w.p. {1/6, 2/3, 1/6}; rows have unit norm on average."""
+    def matrix(self, seeds):
+        u = seeded_uniform(seeds, self.dim_out * self.dim_in)
+        A = (u < 1/6).float() - (u > 5/6).float()
+        return math.sqrt(3 / self.dim_in) * A.view(-1, self.dim_out, self.dim_in)
+
+
+class SRHTProjection(SeededProjection):
+    """
+    Subsampled randomized Hadamard transform A = sqrt(n/dim_in) * P H D restricted to the first
+    dim_in columns, with n the next power of 2, D random signs and P a choice of dim_out rows.
+    Rows have unit norm, and are orthonormal when dim_in is a power of 2.
+    A x and A^T y cost O(n log n) per sample without forming A.
+    """
+    def __init__(self, dim_in, dim_out):
+        super().__init__(dim_in, dim_out)
+        self.n = 1 << (self.dim_in - 1).bit_length()
+        assert self.dim_out <= self.n, "dim_out must not exceed the padded dimension"
+        self.scale = math.sqrt(self.n / self.dim_in)
+
+    def _signs_rows(self, seeds, x):
+        signs = 1. - 2. * (seeded_uniform(seeds, self.n, stream=0) < 0.5).to(x.dtype)
+        rows = seeded_uniform(seeds, self.n, stream=1).argsort(dim=-1)[:, :self.dim_out]
+        view = (signs.shape[0], *([1] * (x.dim() - 2)), -1)
+        return signs.view(view), rows.view(view)
+
+    def apply(self, seeds, x):
+        signs, rows = self._signs_rows(seeds, x)
+        x = torch.nn.functional.pad(x, (0, self.n - self.dim_in)) * signs
+        y = fwht(x)
+        return self.scale * torch.gather(y, -1, rows.expand(*y.shape[:-1], -1))
+
+    def adjoint(self, seeds, y):
+        signs, rows = self._signs_rows(seeds, y)
+        z = y.new_zeros(*y.shape[:-1], self.n)
+        z = z.scatter(-1, rows.expand(*y.shape[:-1], -1), y)
+        return self.scale * (fwht(z) * signs)[..., :self.dim_in]
+
+    def matrix(self, seeds):
+        N = seeds.reshape(-1).shape[0]
+        eye = torch.eye(self.dim_in, device=seeds.device).expand(N, -1, -1)  # (N, dim_in, dim_in)
+        return self.apply(seeds, eye).transpose(-1, -2)  # (N, dim_out, dim_in)
+
+
+projection_dict = {
+    'gaussian': GaussianProjection,
+    'sparse': AchlioptasProjection,
+    'srht': SRHTProjection,
+}
+
+
+class SeededLatentModel(torch.nn.Module):
+    """Wraps a network conditioned on flattened projection matrices so it can take seed latents."""
+    def __init__(self, model, operator):
+        super().__init__()
+        self.model = model
+        self.operator = operator
+
+    def forward(self, x, t, latents=None):
+        if latents is not None:
+            latents = self.operator.matrix(latents).flatten(1).to(x.dtype)
+        return self.model(x, t, latents)
@@ -1,5 +1,5 @@
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Dataset
 from utils import infinite_dataloader
 import os
 import numpy as np
@@ -287,16 +287,37 @@ def qso_model(wavelength, mean_spectra=None, std_spectra=None, downsample_factor
     radius = get_radius(inv_delta_loglambda)
     print("radius of the kernel corresponding to this resolution: ", radius.item())
 
+    # Kernel support for the lowest resolution that can be drawn, fixed once so that
+    # no per-batch host sync is needed. Each sample's kernel is truncated at its own radius.
+    max_radius = int(get_radius((1 - vary_delta_loglambda) * inv_delta_loglambda).item())
+    kernel_idx = torch.arange(-max_radius, max_radius + 1, dtype=torch.float32)
+    lam_mid = 0.5 * (wavelength[0] + wavelength[-1])
+    half_range = 0.5 * (wavelength[-1] - wavelength[0])
+    calibration_slope = ((wavelength - lam_mid) / half_range).float()
+    shuffle, unshuffle = PixelShuffle1D(downsample_factor), PixelUnShuffle1D(downsample_factor)
+    constants = {}  # device -> constants above, copied there once
 
-    def qso_corruption_single(flux, delta_z, n_features, amp, idloglamb, snr, z_noise, radius):
-        # _, flux, meta = apply_redshift(wavelength, flux, delta_z=delta_z)
-        # _, flux, meta = add_absorption_features(wavelength, flux, n_features=n_features.item(), meta=meta)
-        _, flux, meta = add_flux_calibration_error(wavelength.to(flux.device), flux, amplitude=amp)        
-        _, flux, meta = degrade_resolution(wavelength.to(flux.device), flux, dloglambda=1/idloglamb, radius=radius)
-        # _, flux, meta = add_gaussian_noise(wavelength.to(flux.device), flux, SNR=snr)        
-        noise_stddev = torch.mean(flux) / snr  + 1e-4 # Estimate noise standard deviation based on SNR
-        flux = flux + z_noise * noise_stddev
-        return flux
+    def on_device(device):
+        if device not in constants:
+            constants[device] = tuple(t.to(device) for t in (calibration_slope, kernel_idx, delta_loglambda))
+        return constants[device]
+
+
+    def qso_corruption(flux, amp, idloglamb, snr, z_noise):
+        """Batched calibration error, resolution degradation and noise for flux of shape (B, L)."""
+        batch_size = flux.shape[0]
+        slope, idx, dloglamb = on_device(flux.device)
+        # flux calibration error, as in add_flux_calibration_error
+        flux = flux * (1 + amp.unsqueeze(1) * slope)
+        # per-sample gaussian kernels as in degrade_resolution, applied with one grouped conv
+        sigma_pixels = (1 / idloglamb / dloglamb).unsqueeze(1)
+        kernel = torch.exp(-0.5 * (idx / sigma_pixels) ** 2)
+        kernel = kernel * (idx.abs() <= torch.ceil(4 * sigma_pixels))
+        kernel = kernel / kernel.sum(dim=1, keepdim=True)
+        flux = torch.conv1d(flux.unsqueeze(0), kernel.unsqueeze(1).to(flux.dtype), \
+                            padding=max_radius, groups=batch_size).squeeze(0)
+        noise_stddev = torch.mean(flux, dim=1, keepdim=True) / snr.unsqueeze(1) + 1e-4 # Estimate noise standard deviation based on SNR
+        return flux + z_noise * noise_stddev
 
 
     def fwd(flux, return_latents = False, generator=None):
@@ -307,7 +328,7 @@ def qso_model(wavelength, mean_spectra=None, std_spectra=None, downsample_factor
             was_2d = True
             flux = flux.unsqueeze(0)
         if downsample_factor != 1:
-            flux = PixelShuffle1D(downsample_factor)(flux)
+            flux = shuffle(flux)
         assert flux.shape[1] == 1
         flux = flux.squeeze(1)
 
@@ -315,25 +336,22 @@ def qso_model(wavelength, mean_spectra=None, std_spectra=None, downsample_factor
             flux = flux*std_spectra + mean_spectra
         batch_size = flux.shape[0]
 
-        # generate random parameters
+        # generate random parameters; delta_z and n_features are drawn to keep the random stream unchanged
         delta_z = torch.rand(batch_size, device=device, generator=generator)*0.01 - 0.005    # U(-0.005,0.005)
         n_features = torch.randint(0, 5, (batch_size, ), device=device, generator=generator)
         amp = torch.rand(batch_size, device=device, generator=generator)*0.1 - 0.05          # U(-0.05, 0.05)
         scatter_idloglamb = (torch.rand(batch_size, device=device, generator=generator) - 0.5)*2*vary_delta_loglambda
         idloglamb = (1 + scatter_idloglamb) * inv_delta_loglambda
         snr = torch.rand(batch_size, device=device, generator=generator)*(max_snr - min_snr) + min_snr
-        radius = int(get_radius(idloglamb).max().item())
         z_noise = torch.randn(flux.shape, device=device, generator=generator)
 
-        #vmap
-        new_flux = torch.vmap(qso_corruption_single, (0, 0, 0, 0, 0, 0, 0, None),\
-             randomness='different')(flux, delta_z, n_features, amp, idloglamb, snr, z_noise, radius)
+        new_flux = qso_corruption(flux, amp, idloglamb, snr, z_noise)
 
         if mean_spectra is not None:
             new_flux = (new_flux - mean_spectra)/std_spectra
         new_flux = new_flux.unsqueeze(1)
         if downsample_factor != 1:
-            new_flux = PixelUnShuffle1D(downsample_factor)(new_flux)
+            new_flux = unshuffle(new_flux)
 
         if was_2d:
             new_flux = new_flux.squeeze(0)
@@ -346,6 +364,101 @@ def qso_model(wavelength, mean_spectra=None, std_spectra=None, downsample_factor
     return fwd
 
 
+class SpectraStore(Dataset):
+    """
+    Lazy view over `spectra{i}.npy` shards of shape (n_i, C, L) with log10-wavelength
+    in channel 0. Shards are memory-mapped; the flux channel is selected and cropped/strided
+    to D pixels only for the rows of each requested batch.
+
+    Args:
+        files: list of .npy shard paths
+        D: number of pixels to keep, with the same centered crop and stride as before. All if None.
+        channel: flux channel
+        transform: applied to each (D,) spectrum after optional normalization
+        normalize: if True, compute per-pixel mean/std with a streaming pass and standardize samples
+    """
+    def __init__(self, files, D=None, channel=1, transform=None, normalize=False):
+        self.files = list(files)
+        self.channel = channel
+        self.transform = transform
+        self._arrays = None
+        lengths = [a.shape[0] for a in self.arrays]
+        self.cumsum = np.cumsum(lengths)
+        self.offsets = self.cumsum - np.asarray(lengths)
+        L = self.arrays[0].shape[-1]
+        if D is None:
+            self.sl = slice(None)
+        else:
+            subs = L // D
+            i0, i1 = (L % D)//2, -(L % D)//2
+            self.sl = slice(i0, i1 if i1 != 0 else None, subs)
+        self.wavelength = torch.from_numpy(10**np.array(self.arrays[0][0, 0, self.sl]))
+        self.D = len(self.wavelength)
+        self.mean_spectra, self.std_spectra = None, None
+        if normalize:
+            self.mean_spectra, self.std_spectra = self.moments()
+
+    @property
+    def arrays(self):
+        # opened lazily so that each dataloader worker maps the files itself
+        if self._arrays is None:
+            self._arrays = [np.load(f, mmap_mode='r') for f in self.files]
+        return self._arrays
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    @property
+    def shape(self):
+        return (int(self.cumsum[-1]), self.D)
+
+    def __len__(self):
+        return int(self.cumsum[-1])
+
+    def read(self, indices):
+        """Flux of the given global indices as a float32 array of shape (len(indices), D)."""
+        indices = np.asarray(indices)
+        file_idx = np.searchsorted(self.cumsum, indices, side='right')
+        local = indices - self.offsets[file_idx]
+        out = np.empty((len(indices), self.D), dtype=np.float32)
+        for f in np.unique(file_idx):
+            pos = np.nonzero(file_idx == f)[0]
+            order = np.argsort(local[pos])  # read rows in file order
+            out[pos[order]] = self.arrays[f][local[pos][order], self.channel, self.sl]
+        return out
+
+    def moments(self, chunk_size=4096):
+        """Per-pixel mean and std of the flux in one streaming pass (Chan et al. parallel update)."""
+        n, mean, m2 = 0, np.zeros(self.D), np.zeros(self.D)
+        for a in self.arrays:
+            for i in range(0, a.shape[0], chunk_size):
+                x = np.asarray(a[i:i+chunk_size, self.channel, self.sl], dtype=np.float64)
+                nb, mean_b = x.shape[0], x.mean(axis=0)
+                m2_b = ((x - mean_b)**2).sum(axis=0)
+                delta = mean_b - mean
+                mean = mean + delta * nb / (n + nb)
+                m2 = m2 + m2_b + delta**2 * n * nb / (n + nb)
+                n += nb
+        std = np.sqrt(m2 / max(n - 1, 1))
+        return torch.from_numpy(mean).float(), torch.from_numpy(std).float()
+
+    def _finish(self, x):
+        if self.mean_spectra is not None:
+            x = (x - self.mean_spectra)/self.std_spectra
+        if self.transform is not None:
+            x = self.transform(x)
+        return x
+
+    def __getitem__(self, idx):
+        return self._finish(torch.from_numpy(self.read([idx])[0]))
+
+    def __getitems__(self, indices):
+        # batched fetch used by DataLoader: one fancy-index read per shard
+        return [self._finish(x) for x in torch.from_numpy(self.read(indices))]
+
+
 class qso_dataloader(torch.nn.Module):
     def __init__(self, wavelength, ds, batch_size=32, downsample=1, mean_spectra=None, std_spectra=None, generator=None):
         super().__init__()
@@ -357,14 +470,16 @@ class qso_dataloader(torch.nn.Module):
         self.downsample = downsample
         self.mean_spectra = mean_spectra
         self.std_spectra = std_spectra
+        self.shuffle = PixelShuffle1D(downsample)
+        self.unshuffle = PixelUnShuffle1D(downsample)
 
     def transform(self, x):
         x = x.unsqueeze(1)
-        x = PixelUnShuffle1D(self.downsample)(x)
+        x = self.unshuffle(x)
         return x
         
     def inv_transform(self, x):
-        x = PixelShuffle1D(self.downsample)(x)
+        x = self.shuffle(x)
         x = x.squeeze(1)
         return x
     
@@ -387,6 +502,8 @@ class qso_dataloader(torch.nn.Module):
 
 def qso_callback(idx, b, deconvolver, dataloader, device, results_folder, losses=None, qdataloader=None, validation_data=None, s=None):
 
+    if hasattr(b, 'export_for_inference'):
+        b = b.export_for_inference()
     err, err2 = 0, 0
     ns, bs = 10, 256
     for _ in range(ns):
@@ -416,13 +533,13 @@ def qso_callback(idx, b, deconvolver, dataloader, device, results_folder, losses
             ax[j].set_ylabel('Flux')
             ax[j].grid(lw=0.3)
 
-        plt.legend()
-        plt.xlabel("Wavelength")
-        plt.savefig(os.path.join(results_folder, f"sample-{idx}.png"), dpi=300)
+        ax[-1].legend()
+        ax[-1].set_xlabel("Wavelength")
+        fig.savefig(os.path.join(results_folder, f"sample-{idx}.png"), dpi=300)
         for axis in ax:
             axis.set_xlim(4300, 5500)
-        plt.savefig(os.path.join(results_folder, f"sample-zoom-{idx}.png"), dpi=300)
-        plt.close()
+        fig.savefig(os.path.join(results_folder, f"sample-zoom-{idx}.png"), dpi=300)
+        plt.close(fig)
 
     except Exception as e:
         print(e)
@@ -0,0 +1,169 @@
+import copy
+import torch
+
+
+class SnapshotRing:
+    """
+    In-memory ring of the `size` most recent snapshots of module, optimizer and scheduler states.
+    Snapshots are copied into preallocated buffers (pinned host memory if pin_memory, else on the
+    device) on a side CUDA stream, so taking one does not stall the host. Restoring copies the
+    values back into the live tensors in place, so compiled and DDP wrappers stay valid.
+
+    modules, optimizers, schedulers: dicts name -> object; schedulers may hold None. schedulers are
+    any objects with small state_dicts, which are deep-copied (e.g. LR schedulers, ema.EMACounters).
+    """
+    def __init__(self, modules, optimizers, schedulers={}, size=2, pin_memory=True):
+        self.modules = modules
+        self.optimizers = optimizers
+        self.schedulers = {k: v for k, v in schedulers.items() if v is not None}
+        self.size = size
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+        self.slots = []     # oldest first, each a dict with step, buffers, layout, extra, event
+
+    def __len__(self):
+        return len(self.slots)
+
+    def _optimizer_layout(self, opt):
+        """Tensors of the optimizer state in a fixed order and the keys/python values per parameter."""
+        tensors, layout = [], []
+        for group in opt.param_groups:
+            for p in group['params']:
+                state = opt.state.get(p, {})
+                keys = sorted(k for k, v in state.items() if torch.is_tensor(v))
+                tensors += [state[k] for k in keys]
+                layout.append((keys, {k: copy.deepcopy(v) for k, v in state.items() if not torch.is_tensor(v)}))
+        groups = [{k: v for k, v in g.items() if k != 'params'} for g in opt.param_groups]
+        return tensors, (layout, copy.deepcopy(groups))
+
+    def _live(self):
+        tensors, layouts = [], {}
+        for module in self.modules.values():
+            tensors += list(module.state_dict().values())
+        for name, opt in self.optimizers.items():
+            opt_tensors, layouts[name] = self._optimizer_layout(opt)
+            tensors += opt_tensors
+        return tensors, layouts
+
+    def _buffers(self, slot, tensors):
+        """Reuse the buffers of a recycled slot when the shapes still match."""
+        old = slot.get('buffers') if slot is not None else None
+        if old is not None and len(old) == len(tensors) and \
+           all(b.shape == t.shape and b.dtype == t.dtype for b, t in zip(old, tensors)):
+            return old
+        if self.pin_memory:
+            return [torch.empty(t.shape, dtype=t.dtype, pin_memory=t.is_cuda) for t in tensors]
+        return [torch.empty_like(t) for t in tensors]
+
+    @torch.no_grad()
+    def snapshot(self, step):
+        slot = self.slots.pop(0) if len(self.slots) == self.size else None
+        if slot is not None and slot['event'] is not None:
+            slot['event'].synchronize()
+        # small states first: saving EMA counters applies a pending host update to the EMA models
+        schedulers = {k: copy.deepcopy(s.state_dict()) for k, s in self.schedulers.items()}
+        tensors, layouts = self._live()
+        buffers = self._buffers(slot, tensors)
+        if self.stream is not None:
+            # the side stream reads the live tensors; the default stream waits for it before the next update
+            self.stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(self.stream):
+                for b, t in zip(buffers, tensors):
+                    b.copy_(t, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record(self.stream)
+            torch.cuda.current_stream().wait_event(event)
+        else:
+            for b, t in zip(buffers, tensors):
+                b.copy_(t)
+            event = None
+        self.slots.append({
+            'step': step,
+            'buffers': buffers,
+            'devices': [t.device for t in tensors],
+            'layouts': layouts,
+            'schedulers': schedulers,
+            'event': event,
+        })
+
+    @torch.no_grad()
+    def restore(self, before=None):
+        """
+        Copies the newest snapshot (taken before step `before`, if given) back into the live states
+        and drops it and any newer ones from the ring, so a repeated spike rolls back further.
+        Returns its step, or None if there is no such snapshot.
+        """
+        if before is not None:
+            while len(self.slots) > 0 and self.slots[-1]['step'] >= before:
+                self.slots.pop()
+        if len(self.slots) == 0:
+            return None
+        slot = self.slots.pop()
+        if slot['event'] is not None:
+            slot['event'].synchronize()
+        # small states first, as in snapshot: loading EMA counters waits for a pending host update
+        for k, s in self.schedulers.items():
+            s.load_state_dict(slot['schedulers'][k])
+        buffers, devices = iter(slot['buffers']), iter(slot['devices'])
+
+        for module in self.modules.values():
+            for t in module.state_dict().values():
+                t.copy_(next(buffers), non_blocking=True)
+                next(devices)
+
+        for name, opt in self.optimizers.items():
+            layout, groups = slot['layouts'][name]
+            params = [p for group in opt.param_groups for p in group['params']]
+            for p, (keys, values) in zip(params, layout):
+                if len(keys) == 0 and len(values) == 0:
+                    opt.state.pop(p, None)
+                    continue
+                state = opt.state[p]
+                for k in keys:
+                    b, device = next(buffers), next(devices)
+                    if k in state and torch.is_tensor(state[k]) and state[k].shape == b.shape:
+                        state[k].copy_(b, non_blocking=True)
+                    else:
+                        state[k] = b.to(device, copy=True)
+                state.update(copy.deepcopy(values))
+            for group, saved in zip(opt.param_groups, groups):
+                group.update(saved)
+        return slot['step']
+
+
+class FrozenCopy:
+    """
+    Frozen eval-mode copy of `source` for no-grad use, e.g. the fixed transport map.
+    The copy keeps persistent parameter and buffer storage; refresh() copies the source
+    values into it with a single fused torch._foreach_copy_. With dtype (e.g. torch.bfloat16)
+    the floating point tensors are stored in that precision and floating point inputs are
+    cast to it, with outputs cast back. Modules with fold_for_inference are refolded on refresh.
+    """
+    def __init__(self, source, dtype=None):
+        self.source = source
+        self.dtype = dtype
+        self.module = copy.deepcopy(source).eval().requires_grad_(False)
+        if dtype is not None:
+            self.module.to(dtype)
+        self.dst = list(self.module.state_dict().values())
+        self.refresh()
+
+    @torch.no_grad()
+    def refresh(self):
+        src = [t.detach() for t in self.source.state_dict().values()]
+        if hasattr(torch, '_foreach_copy_'):
+            torch._foreach_copy_(self.dst, src)
+        else:
+            for d, t in zip(self.dst, src):
+                d.copy_(t)
+        if hasattr(self.module, 'fold_for_inference'):
+            self.module.fold_for_inference()
+        return self
+
+    def __call__(self, *args, **kwargs):
+        if self.dtype is None:
+            return self.module(*args, **kwargs)
+        cast = lambda t: t.to(self.dtype) if torch.is_tensor(t) and t.is_floating_point() else t
+        out_dtype = next((t.dtype for t in args if torch.is_tensor(t) and t.is_floating_point()), None)
+        out = self.module(*map(cast, args), **{k: cast(v) for k, v in kwargs.items()})
+        return out.to(out_dtype) if out_dtype is not None else out
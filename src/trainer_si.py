@@ -1,4 +1,6 @@
 import os
+import math
+import contextlib
 import numpy as np
 from pathlib import Path
 from multiprocessing import cpu_count
@@ -10,11 +12,18 @@ from torch.utils.data import DataLoader
 
 from torch.optim import Adam, AdamW
 from tqdm.auto import tqdm
-from ema_pytorch import EMA
 
 from transformers import get_cosine_schedule_with_warmup
 from utils import infinite_dataloader, divisible_by, push_to_device, remove_all_prefix
 from callbacks import save_losses_fig
+from snapshots import SnapshotRing, FrozenCopy
+from checkpointing import AsyncCheckpointer
+from metrics import LossAccumulator, MetricsLog, read_metrics
+from eval_worker import EvalWorker
+from ema import FusedEMA
+from instrumentation import StepTimer, StatsLog
+from profiling import ScheduledProfiler
+from torch_utils import training_stats
 
 typedict = {"fp16":torch.float16, "fp32":torch.float32, "bf16":torch.bfloat16}
 
@@ -50,12 +59,15 @@ class Trainer:
             train_batch_size = 16,
             gradient_accumulate_every = 1,
             update_transport_every = 1,
+            transport_dtype = None,   # e.g. 'bf16' to keep the fixed transport map in bfloat16
             train_lr = 1e-4,
             lr_scheduler = False,
             warmup_fraction = 0.10,
             train_num_steps = 100000,
             ema_update_every = 10,
             ema_decay = 0.995,
+            ema_extra_decays = (),    # more EMA decay rates tracked alongside ema_decay
+            ema_host = False,         # keep the EMA weights in host memory
             adam_betas = (0.9, 0.999),
             weight_decay = 0.00,
             save_and_sample_every = 1000,
@@ -68,7 +80,21 @@ class Trainer:
             callback_fn = None,
             validation_data = None,
             callback_kwargs = {},
-            s_model = None
+            s_model = None,
+            snapshot_every = 100,     # in-memory snapshots for spike rollback, 0 to disable
+            snapshot_ring = 2,
+            snapshot_pin_memory = True,
+            async_checkpoint = True,
+            metrics_every = 10,       # steps between host reads of the losses
+            eval_offload = None,      # run callbacks in a 'thread' or (CPU-only runs) 'process' worker, None runs them inline
+            eval_device = None,
+            eval_batches = 1,         # batches from the dataloader handed to an offloaded callback
+            instrument = True,        # per-phase timings through training_stats
+            stats_every = 100,
+            profile = None,           # torch.profiler traces of a window of steps, None reads SI_PROFILE
+            profile_wait = 10,
+            profile_warmup = 2,
+            profile_active = 5
     ):
         super().__init__()
 
@@ -100,10 +126,12 @@ class Trainer:
         self.max_grad_norm = max_grad_norm
         self.mixed_precision_type = mixed_precision_type
         self.update_transport_every = update_transport_every
+        self.transport_dtype = typedict[transport_dtype] if transport_dtype is not None else None
         self.clean_data_steps = clean_data_steps
         self.callback_fn = callback_fn
         self.validation_data = validation_data
         self.callback_kwargs = callback_kwargs
+        self.metrics_every = metrics_every
 
         # dataset and dataloader
         if (dataset is None) and (dataloader is None):
@@ -153,14 +181,57 @@ class Trainer:
 
         # for logging results in a folder periodically
         if self.master_process:
-            self.ema = EMA(self.raw_model, beta = ema_decay, update_every = ema_update_every)
+            ema_betas = (ema_decay, *ema_extra_decays)
+            self.ema = FusedEMA(self.raw_model, betas = ema_betas, update_every = ema_update_every, host = ema_host)
             self.ema.to(self.device)
             if self.s_model is not None:
-                self.s_ema = EMA(self.raw_s_model, beta = ema_decay, update_every = ema_update_every)
+                self.s_ema = FusedEMA(self.raw_s_model, betas = ema_betas, update_every = ema_update_every, host = ema_host)
                 self.s_ema.to(self.device)
 
+        # evaluation callbacks on EMA snapshots in a worker, created before any other thread is started
+        self.evaluator = None
+        if self.master_process and (eval_offload is not None) and (callback_fn is not None):
+            eval_device = eval_device if eval_device is not None else ('cpu' if eval_offload == 'process' else self.device)
+            self.evaluator = EvalWorker(callback_fn, self.ema.ema_model, deconvolver,
+                                        s_model = self.s_ema.ema_model if self.s_model is not None else None,
+                                        device = eval_device, mode = eval_offload, num_batches = eval_batches,
+                                        dtype = typedict[mixed_precision_type], callback_kwargs = callback_kwargs)
+            print(f"Evaluation callbacks run in a {eval_offload} worker on {eval_device}")
+
+        # in-memory snapshots to roll back to on loss spikes
+        self.snapshot_every = snapshot_every
+        self.snapshots = None
+        if snapshot_every > 0:
+            modules, optimizers = {'model': self.raw_model}, {'opt': self.opt}
+            schedulers = {'scheduler': self.lr_scheduler}
+            if self.s_model is not None:
+                modules['s_model'], optimizers['s_opt'] = self.raw_s_model, self.s_opt
+                schedulers['s_scheduler'] = self.s_lr_scheduler
+            # spikes are detected a metrics block late, so the EMAs updated meanwhile are rolled back too
+            if self.master_process:
+                emas = {'ema': self.ema, 's_ema': self.s_ema if self.s_model is not None else None}
+                for name, ema in emas.items():
+                    if ema is not None:
+                        modules.update({f'{name}.{i}': m for i, m in enumerate(ema.ema_models)})
+                        schedulers[f'{name}.counters'] = ema.counters()
+            self.snapshots = SnapshotRing(modules, optimizers, schedulers,
+                                          size = snapshot_ring, pin_memory = snapshot_pin_memory)
+
         self.results_folder = Path(results_folder)
         self.results_folder.mkdir(exist_ok = True)
+        self.checkpointer = AsyncCheckpointer(async_write = async_checkpoint) if self.master_process else None
+
+        # per-phase instrumentation, attached after the evaluation worker copied the deconvolver
+        if self.ddp and instrument:
+            training_stats.init_multiprocessing(self.rank, torch.device(self.device))
+        self.stats_every = stats_every
+        self.timer = StepTimer(self.device, enabled = instrument)
+        self.stats_log = StatsLog(self.results_folder / 'stats.jsonl', master = self.master_process) if instrument else None
+        self.deconvolver.timer = self.timer if instrument else None
+        self.profiler = ScheduledProfiler(self.results_folder / 'profile',
+                                          name = f'train_rank{self.rank}' if self.ddp else 'train',
+                                          wait = profile_wait, warmup = profile_warmup, active = profile_active,
+                                          enabled = profile)
 
         # step counter state
         self.step = 0
@@ -188,11 +259,15 @@ class Trainer:
             if self.s_lr_scheduler is not None:
                 data['s_scheduler'] = self.s_lr_scheduler.state_dict()
 
-        torch.save(data, str(self.results_folder / f'model-{milestone}.pt'))
+        # checkpoints of the same step share one snapshot and one file
+        self.checkpointer.save(data, self.results_folder / f'model-{milestone}.pt', key = self.step)
 
 
     def load(self, milestone):
         device = self.device
+        if self.checkpointer is not None:
+            self.checkpointer.wait()
+            self.checkpointer.invalidate()
         # Load data
         try:
             data = torch.load(milestone, \
@@ -242,22 +317,57 @@ class Trainer:
         print("Successfully loaded model from milestone", milestone)
 
 
+    def run_callback(self, idx, losses, block = False):
+        """Runs callback_fn on the EMA models, inline or through the evaluation worker."""
+        if self.callback_fn is None:
+            return
+        if self.evaluator is not None:
+            # the worker copies the weights itself
+            self.evaluator.submit(self.ema.ema_model, self.s_ema.ema_model if self.s_model is not None else None,
+                                  dataloader = self.dl, block = block,
+                                  idx = idx, validation_data = self.validation_data,
+                                  results_folder = self.results_folder)
+            return
+        model_to_use = self.ema.ema_model_on(self.device)
+        s_model_to_use = self.s_ema.ema_model_on(self.device) if self.s_model is not None else None
+        try:
+            if self.s_model is not None:
+                self.s_model.eval()
+            with torch.no_grad(), torch.autocast(device_type=self.device, dtype=typedict[self.mixed_precision_type]):
+                self.callback_fn(idx = idx,
+                                b = model_to_use, s = s_model_to_use, deconvolver = self.deconvolver,
+                                dataloader = self.dl, validation_data = self.validation_data,
+                                losses = losses, device = self.device,
+                                results_folder = self.results_folder, **self.callback_kwargs)
+        except Exception as e:
+            print("Exception in executing callback function\n", e)
+
+
+    def no_sync(self, skip_sync):
+        """Context without DDP gradient all-reduce, for all but the last accumulation micro-step."""
+        stack = contextlib.ExitStack()
+        if skip_sync and self.ddp:
+            stack.enter_context(self.model.no_sync())
+            if self.s_model is not None:
+                stack.enter_context(self.s_model.no_sync())
+        return stack
+
+
     def train(self, loss_threshold=10.0, window=11):
         device = self.device
         losses = []
         min_loss = 1e10
         recent_losses = []
-        import copy
+        metrics = LossAccumulator(2, every=self.metrics_every, device=device, ddp=self.ddp)
+        log = MetricsLog(self.results_folder, ['step', 'loss', 'dloss', 'sloss'], resume=self.step > 0) \
+                if self.master_process else None
         transport_map = None
         transport_score = None
         if self.update_transport_every > 1:
             print(f"Setting up transport map to be updated every {self.update_transport_every} steps")
-            transport_map = copy.deepcopy(self.model.module) if isinstance(self.model, DDP) \
-                        else copy.deepcopy(self.model)
-            transport_map.eval()
+            transport_map = FrozenCopy(self.raw_model, dtype=self.transport_dtype)
             if self.s_model is not None:
-                transport_score = copy.deepcopy(self.s_model)
-                transport_score.eval()
+                transport_score = FrozenCopy(self.raw_s_model, dtype=self.transport_dtype)
 
         if not bool(os.getenv('SLURM_JOB_ID')): # interactive environment like Jupyter
             miniters = 1
@@ -268,162 +378,165 @@ class Trainer:
             mininterval = 60.0
             pbar_refresh = False
 
-        with tqdm(initial=self.step, total=self.train_num_steps, disable=not self.master_process, miniters=miniters, mininterval=mininterval) as pbar:
+        with self.profiler, tqdm(initial=self.step, total=self.train_num_steps, disable=not self.master_process, miniters=miniters, mininterval=mininterval) as pbar:
             while self.step < self.train_num_steps:
                 self.model.train()
                 if self.s_model is not None:
                     self.s_model.train()
 
-                total_loss, total_dloss, total_sloss = 0., 0., 0.
-                for _ in range(self.gradient_accumulate_every):
-                    data, obs, latents = next(self.dl)
-                    data, obs = push_to_device(data, obs, device=device)
-                    latents = latents.to(self.device) if self.deconvolver.use_latents else None
-                    with torch.autocast(device_type=device, dtype=typedict[self.mixed_precision_type]):
-                        if self.step < self.clean_data_steps:
-                            loss, s_loss = self.deconvolver.loss_fn(self.model, obs, latents, x0=data, s=self.s_model)
-                        else:
-                            loss, s_loss = self.deconvolver.loss_fn(self.model, obs, latents, b_fixed=transport_map, s=self.s_model, s_fixed=transport_score)
-                        loss = loss.mean()
-                        loss = loss / self.gradient_accumulate_every
-                        if s_loss is not None:
-                            s_loss = s_loss.mean()
-                            s_loss = s_loss / self.gradient_accumulate_every
-
-                    curr_loss = loss.detach()
-                    if self.ddp : dist.all_reduce(curr_loss, op=dist.ReduceOp.AVG)
-                    total_dloss += curr_loss.item()
+                for i in range(self.gradient_accumulate_every):
+                    with self.timer.phase('data', host=True):
+                        data, obs, latents = next(self.dl)
+                        data, obs = push_to_device(data, obs, device=device)
+                        latents = latents.to(self.device) if self.deconvolver.use_latents else None
 
-                    if s_loss is not None:
-                        curr_sloss = s_loss.detach() 
-                        if self.ddp : dist.all_reduce(curr_sloss, op=dist.ReduceOp.AVG)
-                        total_sloss = total_sloss + curr_sloss.item() 
-                    total_loss += total_dloss + total_sloss
+                    with self.no_sync(i < self.gradient_accumulate_every - 1), self.timer.phase('forward_backward'):
+                        with torch.autocast(device_type=device, dtype=typedict[self.mixed_precision_type]):
+                            if self.step < self.clean_data_steps:
+                                loss, s_loss = self.deconvolver.loss_fn(self.model, obs, latents, x0=data, s=self.s_model)
+                            else:
+                                loss, s_loss = self.deconvolver.loss_fn(self.model, obs, latents, b_fixed=transport_map, s=self.s_model, s_fixed=transport_score)
+                            loss = loss.mean()
+                            loss = loss / self.gradient_accumulate_every
+                            if s_loss is not None:
+                                s_loss = s_loss.mean()
+                                s_loss = s_loss / self.gradient_accumulate_every
+
+                        # accumulated on device, reduced over ranks every metrics_every steps
+                        metrics.add(0, loss)
+                        if s_loss is not None:
+                            metrics.add(1, s_loss)
 
-                    if self.s_model is not None:
-                        s_loss.backward(retain_graph=True)
-                    loss.backward()
+                        # one backward through both graphs gives the same gradients as two
+                        if self.s_model is not None:
+                            (loss + s_loss).backward()
+                        else:
+                            loss.backward()
 
                     for p in self.model.parameters():
                         if p.grad is not None and not p.grad.is_contiguous():
                             p.grad = p.grad.contiguous()
 
-                pbar.set_description(f'loss: {total_loss:.4f}', refresh=pbar_refresh)
-                losses.append([total_loss, total_dloss, total_sloss])
-
-                torch.cuda.synchronize()
-                _ = torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.max_grad_norm)
-                self.opt.step()
-                self.opt.zero_grad()
-                if self.s_model is not None:
-                    _ = torch.nn.utils.clip_grad_norm_(self.s_model.parameters(), self.max_grad_norm)
-                    self.s_opt.step()
-                    self.s_opt.zero_grad()
-                if self.lr_scheduler is not None:
-                    self.lr_scheduler.step()
-                if self.s_lr_scheduler is not None:
-                    self.s_lr_scheduler.step()
-                torch.cuda.synchronize()
-
-                # If loss spikes, reset model and optimizer
+                with self.timer.phase('optimizer'):
+                    _ = torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.max_grad_norm)
+                    self.opt.step()
+                    self.opt.zero_grad()
+                    if self.s_model is not None:
+                        _ = torch.nn.utils.clip_grad_norm_(self.s_model.parameters(), self.max_grad_norm)
+                        self.s_opt.step()
+                        self.s_opt.zero_grad()
+                    if self.lr_scheduler is not None:
+                        self.lr_scheduler.step()
+                    if self.s_lr_scheduler is not None:
+                        self.s_lr_scheduler.step()
+
+                # Losses arrive one block late; if one spikes, reset model and optimizer
+                # to a snapshot taken before that step
                 reset_model = False
-                recent_losses.append(total_loss)
-                if len(recent_losses) > window:
-                    recent_losses.pop(0)
-                if len(recent_losses) == window:
-                    mean_loss = sum(recent_losses[:-1]) / (window-1)
-                    if total_loss > loss_threshold * mean_loss or not torch.isfinite(loss):
-                        print("Loss spike detected. Resetting model and optimizer.")
-                        try:
-                            self.load("best")
-                            recent_losses.clear()
-                            self.opt.zero_grad()
-                            reset_model = True
-                        except Exception as e:
-                            print("Exception in loading best model after spike", e)
-                            print("Continuing training without resetting model.")
+                for loss_step, (total_dloss, total_sloss) in metrics.end_step(self.step):
+                    total_loss = total_dloss + total_sloss
+                    losses.append([total_loss, total_dloss, total_sloss])
+                    if log is not None:
+                        log.append([loss_step, total_loss, total_dloss, total_sloss])
+                    pbar.set_description(f'loss: {total_loss:.4f}', refresh=pbar_refresh)
+                    recent_losses.append(total_loss)
+                    if len(recent_losses) > window:
+                        recent_losses.pop(0)
+                    if len(recent_losses) == window:
+                        mean_loss = sum(recent_losses[:-1]) / (window-1)
+                        if total_loss > loss_threshold * mean_loss or not math.isfinite(total_loss):
+                            print(f"Loss spike detected at step {loss_step}. Resetting model and optimizer.")
+                            snapshot_step = self.snapshots.restore(before=loss_step) if self.snapshots is not None else None
+                            if snapshot_step is not None:
+                                print(f"Rolled back to in-memory snapshot from step {snapshot_step}")
+                                self.step = snapshot_step
+                                if self.checkpointer is not None:
+                                    self.checkpointer.invalidate()
+                                recent_losses.clear()
+                                self.opt.zero_grad()
+                                reset_model = True
+                            else:
+                                try:
+                                    self.load("best")
+                                    recent_losses.clear()
+                                    self.opt.zero_grad()
+                                    reset_model = True
+                                except Exception as e:
+                                    print("Exception in loading best model after spike", e)
+                                    print("Continuing training without resetting model.")
+                            if reset_model:
+                                metrics.reset()
+                                # the frozen transport maps may hold weights from after the snapshot
+                                if transport_map is not None:
+                                    transport_map.refresh()
+                                if transport_score is not None:
+                                    transport_score.refresh()
+                                break
 
                 if not reset_model:
                     self.step += 1
 
+                    if self.master_process:
+                        with self.timer.phase('ema'):
+                            self.ema.update()
+                            if self.s_model is not None:
+                                self.s_ema.update()
+
+                    # after the EMA update, so a restored EMA step counter matches the restored step
+                    if (self.snapshots is not None) and divisible_by(self.step, self.snapshot_every):
+                        self.snapshots.snapshot(self.step)
+
                     # Update transport map if needed
                     if (self.step % self.update_transport_every == 0) & (transport_map is not None):
-                        if isinstance(self.model, DDP) :
-                            transport_map.load_state_dict(self.model.module.state_dict())
-                        else:
-                            transport_map.load_state_dict(self.model.state_dict())
-                        transport_map.eval()
+                        transport_map.refresh()
                         if transport_score is not None:
-                            transport_score.load_state_dict(self.s_model.state_dict())
-                            transport_score.eval()
+                            transport_score.refresh()
 
                     if self.master_process:
-                        self.ema.update()
-                        if self.s_model is not None:
-                            self.s_ema.update()
-
                         if self.step % 5000 == 0:
-                            self.save(self.step)
+                            with self.timer.phase('checkpoint'):
+                                self.save(self.step)
 
                         if divisible_by(self.step, self.save_and_sample_every):
-                            np.save(f"{self.results_folder}/losses", losses)
-                            self.save("latest")
-                            if losses[-1][0] < min_loss:
-                                min_loss = losses[-1][0]
-                                self.save("best")
-                                print(f"New best model at step {self.step} with loss {min_loss:.4f}")
-
-                            self.ema.ema_model.eval()
-                            # model_to_use = self.ema.ema_model
-                            model_to_use = self.ema.ema_model.module if isinstance(self.ema.ema_model, DDP) \
-                                                else self.ema.ema_model
-                            if self.s_model is not None:
-                                s_model_to_use = self.s_ema.ema_model.module if isinstance(self.s_ema.ema_model, DDP) \
-                                                else self.s_ema.ema_model
-                            else:
-                                s_model_to_use = None
-                            try:
-                                if self.s_model is not None:
-                                    self.s_model.eval()
-                                with torch.no_grad(), torch.autocast(device_type=device, dtype=typedict[self.mixed_precision_type]):
-                                    if self.callback_fn is not None:
-                                        milestone=self.step // self.save_and_sample_every
-                                        self.callback_fn(idx = milestone,
-                                                        b = model_to_use, s = s_model_to_use, deconvolver = self.deconvolver,
-                                                        dataloader = self.dl, validation_data = self.validation_data,
-                                                        losses = losses, device = self.device,
-                                                        results_folder = self.results_folder, **self.callback_kwargs)
-                            except Exception as e:
-                                print("Exception in executing callback function\n", e)
+                            with self.timer.phase('checkpoint'):
+                                log.flush()
+                                self.save("latest")
+                                if len(losses) > 0 and losses[-1][0] < min_loss:
+                                    min_loss = losses[-1][0]
+                                    self.save("best")
+                                    print(f"New best model at step {self.step} with loss {min_loss:.4f}")
+
+                            with self.timer.phase('callback'):
+                                self.run_callback(self.step // self.save_and_sample_every, losses)
                             print(f"Saved model at step {self.step}")
 
+                # per-phase timings, NFEs, samples/s and peak memory into stats.jsonl
+                self.timer.end_step(self.batch_size * self.gradient_accumulate_every)
+                if self.timer.enabled and not reset_model and divisible_by(self.step, self.stats_every):
+                    self.timer.flush()
+                    self.stats_log.write(self.step)
+
                 pbar.update(1)
-                torch.cuda.synchronize()
+                self.profiler.step()
+
+        # Losses still in flight
+        for loss_step, (total_dloss, total_sloss) in metrics.flush() + metrics.collect():
+            losses.append([total_dloss + total_sloss, total_dloss, total_sloss])
+            if log is not None:
+                log.append([loss_step, total_dloss + total_sloss, total_dloss, total_sloss])
 
         # Save final model
         if self.master_process:
+            log.flush()
             np.save(f"{self.results_folder}/losses", losses)
             self.save("latest")
-            save_losses_fig(losses, self.results_folder)
-            self.ema.ema_model.eval()
-            model_to_use = self.ema.ema_model.module if isinstance(self.ema.ema_model, DDP) \
-                                else self.ema.ema_model
-            if self.s_model is not None:
-                s_model_to_use = self.s_ema.ema_model.module if isinstance(self.s_ema.ema_model, DDP) \
-                                else self.s_ema.ema_model
-            else:
-                s_model_to_use = None
-            try:
-                with torch.no_grad(), torch.autocast(device_type=device, dtype=typedict[self.mixed_precision_type]):
-                    if self.callback_fn is not None:
-                        self.callback_fn(idx = "fin",
-                                        b = model_to_use, s = s_model_to_use, deconvolver = self.deconvolver,
-                                        dataloader = self.dl, validation_data = self.validation_data,
-                                        losses = losses, device=self.device,
-                                        results_folder = self.results_folder, **self.callback_kwargs)
-            except Exception as e:
-                print("Exception in executing callback function\n", e)
+            self.run_callback("fin", losses, block = True)
+            if self.evaluator is not None:
+                self.evaluator.close()
+            # plotted after the evaluation worker is drained, pyplot is not thread-safe
+            save_losses_fig(read_metrics(self.results_folder), self.results_folder)
 
+            self.checkpointer.wait()
             print('training complete')
 
         return losses